@@ -0,0 +1,260 @@
+# Benchmarks for each stage of the pipeline, run on a synthetic PSSM/RR corpus
+import os
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import numpy as np
+import utils
+import cache
+import scoring
+import train
+import test
+
+# Order of the amino acid columns in PSI-BLAST .pssm files
+pssm_header_order = ['A', 'R', 'N', 'D', 'C', 'Q', 'E', 'G', 'H', 'I', 'L', 'K', 'M', 'F', 'P', 'S', 'T', 'W', 'Y', 'V']
+
+# Defaults
+LENGTHS = [50, 100, 200, 500, 1000]
+CONTACTS_PER_RESIDUE = 1.0
+REPEAT = 3
+GRADIENT_STEPS = 100
+LEGACY_MAX_LENGTH = 200
+
+
+def main():
+    args = parse_args()
+    report = run(args.lengths, args.proteins, args.contacts_per_residue, args.repeat, args.seed,
+                 args.gradient_steps, args.legacy_max_length, args.data_dir)
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    for result in report['results']:
+        print('{:>6} {:<30} {:.6f}s'.format(result['length'], result['stage'], result['seconds']))
+    print('Benchmark results written to ' + args.output)
+
+
+def run(lengths, proteins=1, contacts_per_residue=CONTACTS_PER_RESIDUE, repeat=REPEAT, seed=0,
+        gradient_steps=GRADIENT_STEPS, legacy_max_length=LEGACY_MAX_LENGTH, data_dir=None):
+    """
+    Generate a corpus and time every stage on it
+    :return: dictionary with run metadata and one result per (length, stage)
+    """
+    # Time the parsers themselves, not the feature cache
+    cache.configure(use_cache=False)
+    random.seed(seed)
+    # Temporary directories are removed afterwards; a given data_dir is kept
+    temp_dirs = []
+    if not data_dir:
+        data_dir = tempfile.mkdtemp(prefix='project4-benchmark-')
+        temp_dirs.append(data_dir)
+    try:
+        pssm_dir, rr_dir, corpus = generate_corpus(data_dir, lengths, proteins, contacts_per_residue, seed)
+        output_dir = tempfile.mkdtemp(prefix='project4-benchmark-output-')
+        temp_dirs.append(output_dir)
+        model = utils.Model(np.random.default_rng(seed).normal(0, 0.01, 201))
+
+        results = []
+        for length in lengths:
+            pssm_files = corpus[length]
+            stages = benchmark_stages(pssm_files, pssm_dir, rr_dir, output_dir, model, gradient_steps,
+                                      length <= legacy_max_length)
+            for stage, function in stages:
+                runs = []
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    function()
+                    runs.append(time.perf_counter() - start)
+                results.append({'length': length, 'proteins': len(pssm_files), 'stage': stage,
+                                'seconds': float(np.median(runs)), 'runs': runs})
+    finally:
+        for temp_dir in temp_dirs:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    return {'meta': run_metadata(lengths, proteins, contacts_per_residue, repeat, seed, gradient_steps),
+            'results': results}
+
+
+def benchmark_stages(pssm_files, pssm_dir, rr_dir, output_dir, model, gradient_steps, legacy):
+    """
+    :return: list of (stage name, function running that stage over every protein in pssm_files)
+    """
+    rr_files = [pssm_file.replace('.pssm', '.rr') for pssm_file in pssm_files]
+    pssms = [utils.read_pssm_array(pssm_file, pssm_dir)[0] for pssm_file in pssm_files]
+    contact_maps = [utils.read_contact_map(rr_file, rr_dir) for rr_file in rr_files]
+    features, labels = train.build_feature_arrays(pssm_files, pssm_dir, rr_dir)
+    feature_matrix = train.build_feature_matrix(pssm_files, pssm_dir, rr_dir)
+    scored = [scoring.score_pairs(model, pssm) for pssm in pssms]
+    ranked = [scoring.select_top(i, j, p) for i, j, p in scored]
+
+    def parse_pssm():
+        for pssm_file in pssm_files:
+            utils.read_pssm(pssm_file, pssm_dir)
+
+    def parse_pssm_array():
+        for pssm_file in pssm_files:
+            utils.read_pssm_array(pssm_file, pssm_dir)
+
+    def parse_rr():
+        for rr_file in rr_files:
+            utils.read_rr(rr_file, rr_dir)
+
+    def parse_contact_map():
+        for rr_file in rr_files:
+            utils.read_contact_map(rr_file, rr_dir)
+
+    def build_small_matrix():
+        for pssm in pssms:
+            train.build_small_matrix(pssm)
+
+    def get_five():
+        for pssm in pssms:
+            for i in range(len(pssm)):
+                test.get_five(pssm, i)
+
+    def calc_gradient():
+        w_vector = [0.0] * 201
+        for _ in range(gradient_steps):
+            gradient_vector = train.calc_gradient(w_vector, feature_matrix)
+            w_vector = train.update_w(w_vector, gradient_vector)
+
+    def fit_vectorized():
+        train.fit_vectorized(features, labels, [0.0] * 201, epochs=1)
+
+    def calculate_contact_probability():
+        for pssm_file in pssm_files:
+            test_matrix = test.build_test_matrix(pssm_file, pssm_dir)
+            for pair in test_matrix:
+                test.calculate_contact_probability(model, pair)
+
+    def score_pairs():
+        for pssm in pssms:
+            scoring.score_pairs(model, pssm)
+
+    def score_pairs_blocked():
+        for pssm in pssms:
+            scoring.score_pairs_blocked(model, pssm)
+
+    def sort():
+        for i, j, p in scored:
+            scoring.select_top(i, j, p)
+
+    def sort_top_l2():
+        for (i, j, p), pssm in zip(scored, pssms):
+            scoring.select_top(i, j, p, int(len(pssm) / 2))
+
+    def write_rr():
+        for (i, j, p), contact_map, rr_file in zip(ranked, contact_maps, rr_files):
+            utils.write_rr(os.path.join(output_dir, rr_file), i, j, p, contact_map.sequence)
+
+    def write_rows():
+        for (i, j, p), contact_map, rr_file in zip(ranked, contact_maps, rr_files):
+            rr_rows = [[a, b, 0, 8, c] for a, b, c in zip(i.tolist(), j.tolist(), p.tolist())]
+            with open(os.path.join(output_dir, rr_file), 'w') as file:
+                file.write(contact_map.sequence + "\n")
+                for row in rr_rows:
+                    file.write(" ".join([str(x) for x in row]) + "\n")
+
+    stages = [('parse_pssm', parse_pssm), ('parse_pssm_array', parse_pssm_array),
+              ('parse_rr', parse_rr), ('parse_contact_map', parse_contact_map),
+              ('build_small_matrix', build_small_matrix), ('get_five', get_five),
+              ('calc_gradient', calc_gradient), ('fit_vectorized', fit_vectorized)]
+    if legacy:
+        # The per-pair path is O(L^2 * 200) in pure Python, so it is only timed on short proteins
+        stages.append(('calculate_contact_probability', calculate_contact_probability))
+    stages += [('score_pairs', score_pairs), ('score_pairs_blocked', score_pairs_blocked), ('sort', sort),
+               ('sort_top_l2', sort_top_l2), ('write_rows', write_rows), ('write_rr', write_rr)]
+    return stages
+
+
+def generate_corpus(directory, lengths, proteins=1, contacts_per_residue=CONTACTS_PER_RESIDUE, seed=0):
+    """
+    Writes synthetic .pssm and .rr files for every length into directory/pssm and directory/rr
+    :return: (pssm directory, rr directory, dictionary of length -> list of .pssm file names)
+    """
+    rng = random.Random(seed)
+    pssm_dir = os.path.join(directory, 'pssm')
+    rr_dir = os.path.join(directory, 'rr')
+    os.makedirs(pssm_dir, exist_ok=True)
+    os.makedirs(rr_dir, exist_ok=True)
+
+    corpus = {}
+    for length in lengths:
+        corpus[length] = []
+        for number in range(proteins):
+            name = 'synthetic-{}-{}'.format(length, number)
+            sequence = write_synthetic_pssm(os.path.join(pssm_dir, name + '.pssm'), length, rng)
+            write_synthetic_rr(os.path.join(rr_dir, name + '.rr'), sequence, int(contacts_per_residue * length), rng)
+            corpus[length].append(name + '.pssm')
+    return pssm_dir, rr_dir, corpus
+
+
+def write_synthetic_pssm(file_path, length, rng):
+    """
+    Writes a random PSI-BLAST style .pssm file
+    :return: the random sequence
+    """
+    sequence = ''.join(rng.choice(pssm_header_order) for _ in range(length))
+    with open(file_path, 'w') as f:
+        f.write('\nLast position-specific scoring matrix computed, weighted observed percentages rounded down, '
+                'information per position, and relative weight of gapped match to pseudocounts\n')
+        f.write('           ' + '   '.join(pssm_header_order) + '   ' + '   '.join(pssm_header_order) + '\n')
+        for position, residue in enumerate(sequence):
+            scores = [rng.randint(-7, 9) for _ in range(20)]
+            percentages = [max(0, score * 8) for score in scores]
+            f.write('{:>5} {}   '.format(position + 1, residue) + ' '.join('{:>3}'.format(x) for x in scores) + ' ' +
+                    ' '.join('{:>3}'.format(x) for x in percentages) + '  {:.2f} {:.2f}\n'.format(rng.random(), rng.random()))
+        f.write('\n                      K         Lambda\nStandard Ungapped    0.1324     0.3173\n')
+    return sequence
+
+
+def write_synthetic_rr(file_path, sequence, num_contacts, rng):
+    """
+    Writes a random .rr file with num_contacts pairs at a sequence separation of at least 5
+    """
+    length = len(sequence)
+    num_pairs = (length - 5) * (length - 4) // 2 if length > 5 else 0
+    pairs = set()
+    while len(pairs) < min(num_contacts, num_pairs):
+        i = rng.randint(1, length - 5)
+        j = rng.randint(i + 5, length)
+        pairs.add((i, j))
+    with open(file_path, 'w') as f:
+        f.write(sequence + '\n')
+        for i, j in sorted(pairs):
+            f.write('{} {} 0 8 {:.3f}\n'.format(i, j, rng.uniform(3.5, 8.0)))
+
+
+def run_metadata(lengths, proteins, contacts_per_residue, repeat, seed, gradient_steps):
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=utils.parent_directory,
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+            'numpy': np.__version__, 'machine': platform.machine(), 'cpus': os.cpu_count(),
+            'lengths': lengths, 'proteins': proteins, 'contacts_per_residue': contacts_per_residue,
+            'repeat': repeat, 'seed': seed, 'gradient_steps': gradient_steps}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Time each stage of the pipeline on synthetic proteins.')
+    parser.add_argument('--lengths', type=int, nargs='+', default=LENGTHS, help='protein lengths to generate')
+    parser.add_argument('--proteins', type=int, default=1, help='proteins per length')
+    parser.add_argument('--contacts-per-residue', type=float, default=CONTACTS_PER_RESIDUE,
+                        help='number of contacts in each .rr file, as a multiple of the length')
+    parser.add_argument('--repeat', type=int, default=REPEAT, help='runs of each stage; the median is reported')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--gradient-steps', type=int, default=GRADIENT_STEPS, help='calc_gradient steps to time')
+    parser.add_argument('--legacy-max-length', type=int, default=LEGACY_MAX_LENGTH,
+                        help='longest protein to time the per-pair calculate_contact_probability path on')
+    parser.add_argument('--data-dir', default=None, help='where to write the synthetic corpus (a temp dir by default)')
+    parser.add_argument('--output', default='benchmark.json', help='JSON file for the results')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
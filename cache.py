@@ -0,0 +1,192 @@
+# On-disk cache of parsed PSSM/RR files and their window features
+import os
+import shutil
+import hashlib
+import tempfile
+import threading
+import numpy as np
+import utils
+import instrument
+
+# Get the parent directory of this code
+this_script = os.path.abspath(__file__)
+parent_directory = os.path.dirname(this_script)
+
+# Bump this whenever the parsing or featurization changes, so old entries are not reused
+CACHE_VERSION = 2
+WINDOW_SIZE = 5
+
+# Cache settings, changed with configure()
+cache_directory = parent_directory + "/feature-cache"
+max_cache_bytes = 2 * 1024 ** 3
+enabled = True
+
+# Eviction frees space down to this fraction of the cap, so a full cache is not scanned again on every write
+EVICT_TARGET = 0.9
+
+# Bytes in the cache directory as counted by this process: scanned once, then kept up to date as entries are
+# written. None until the first write.
+cache_bytes = None
+
+# Guards cache_bytes and eviction: entries are loaded from the reader threads of pipeline.run
+lock = threading.Lock()
+
+
+def configure(directory=None, max_bytes=None, use_cache=None):
+    """
+    Change where the cache lives, how large it may grow, and whether it is used at all
+    """
+    global cache_directory, max_cache_bytes, enabled, cache_bytes
+    if directory is not None:
+        with lock:
+            if directory != cache_directory:
+                cache_bytes = None
+            cache_directory = directory
+    if max_bytes is not None:
+        max_cache_bytes = max_bytes
+    if use_cache is not None:
+        enabled = use_cache
+
+
+def settings():
+    """
+    :return: the current settings as keyword arguments for configure(), e.g. to pass on to worker processes
+    """
+    return {'directory': cache_directory, 'max_bytes': max_cache_bytes, 'use_cache': enabled}
+
+
+def load_pssm(pssm_file, pssm_dir=None):
+    """
+    Loads a parsed .pssm file and its window features, from the cache when possible
+    :return: (L x 20 pssm array, array of residue letters, L x 100 window array)
+    """
+    file_path = os.path.join(pssm_dir, pssm_file) if pssm_dir else pssm_file
+    with instrument.stage('parse_pssm', pssm_file):
+        if not enabled:
+            return parse_pssm(file_path)
+
+        key = content_key(file_path, 'pssm', ','.join(utils.acids_list), str(WINDOW_SIZE))
+        entry = read_entry(key, ['pssm', 'residues', 'windows'])
+        if entry is None:
+            entry = parse_pssm(file_path)
+            write_entry(key, {'pssm': entry[0], 'residues': entry[1], 'windows': entry[2]})
+        return entry
+
+
+def load_rr(rr_file, rr_dir=None):
+    """
+    Loads a parsed .rr file, from the cache when possible
+    :return: utils.ContactMap
+    """
+    file_path = os.path.join(rr_dir, rr_file) if rr_dir else rr_file
+    with instrument.stage('parse_rr', rr_file):
+        if not enabled:
+            return utils.read_contact_map(file_path)
+
+        key = content_key(file_path, 'rr')
+        entry = read_entry(key, ['sequence', 'i', 'j', 'distances', 'bitmap', 'length'])
+        if entry is None:
+            contact_map = utils.read_contact_map(file_path)
+            write_entry(key, {'sequence': np.array(contact_map.sequence), 'i': contact_map.i, 'j': contact_map.j,
+                              'distances': contact_map.distances, 'bitmap': contact_map.bitmap,
+                              'length': np.array(contact_map.length)})
+            return contact_map
+        sequence, i, j, distances, bitmap, length = entry
+        return utils.ContactMap(str(sequence), i, j, distances, int(length), bitmap)
+
+
+def parse_pssm(file_path):
+    pssm, residues = utils.read_pssm_array(file_path)
+    return pssm, residues, utils.window_matrix(pssm)
+
+
+def content_key(file_path, *params):
+    """
+    :return: hash of the file contents together with the cache version and featurization parameters
+    """
+    digest = hashlib.sha256()
+    for param in (str(CACHE_VERSION),) + params:
+        digest.update(param.encode() + b'\0')
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return params[0] + '-' + digest.hexdigest()
+
+
+def read_entry(key, names):
+    """
+    Memory-maps the arrays of a cache entry and marks it as recently used
+    :return: tuple of arrays in the order of names, or None if the entry is not cached
+    """
+    entry_path = os.path.join(cache_directory, key)
+    try:
+        arrays = tuple(np.load(os.path.join(entry_path, name + '.npy'), mmap_mode='r') for name in names)
+        os.utime(entry_path)
+    except (OSError, ValueError):
+        return None
+    return arrays
+
+
+def write_entry(key, arrays):
+    """
+    Writes the arrays of a cache entry, then evicts the least recently used entries if that takes the cache
+    over the size cap. The cache directory is only scanned on the first write of a process and when the cap
+    is crossed; otherwise the size of the new entry is added to a running total.
+    Safe to call from several threads: the entry files are written unlocked, then moved into place and
+    counted under the lock, so eviction never runs while another thread updates the total.
+    """
+    global cache_bytes
+    os.makedirs(cache_directory, exist_ok=True)
+    entry_path = os.path.join(cache_directory, key)
+    # Write into a temporary directory first so other processes never see a half-written entry
+    temp_path = tempfile.mkdtemp(prefix='.tmp-', dir=cache_directory)
+    size = 0
+    for name, array in arrays.items():
+        file_path = os.path.join(temp_path, name + '.npy')
+        np.save(file_path, array)
+        size += os.path.getsize(file_path)
+    with lock:
+        try:
+            os.rename(temp_path, entry_path)
+        except OSError:
+            # Another process or thread cached the same entry first
+            shutil.rmtree(temp_path, ignore_errors=True)
+            size = 0
+        if cache_bytes is None or cache_bytes + size > max_cache_bytes:
+            cache_bytes = evict(keep=key)
+        else:
+            cache_bytes += size
+
+
+def evict(keep=None, target_bytes=None):
+    """
+    Removes the least recently used entries until the cache is under target_bytes
+    (EVICT_TARGET of max_cache_bytes by default), if it is over max_cache_bytes.
+    Called with the lock held (see write_entry).
+    :return: the size of the cache afterwards, in bytes
+    """
+    if target_bytes is None:
+        target_bytes = EVICT_TARGET * max_cache_bytes
+    entries = []
+    total_bytes = 0
+    for key in os.listdir(cache_directory):
+        entry_path = os.path.join(cache_directory, key)
+        if key.startswith('.') or not os.path.isdir(entry_path):
+            continue
+        try:
+            size = sum(os.path.getsize(os.path.join(entry_path, name)) for name in os.listdir(entry_path))
+            entries.append((os.path.getmtime(entry_path), size, key))
+        except OSError:
+            continue
+        total_bytes += size
+
+    if total_bytes <= max_cache_bytes:
+        return total_bytes
+    for last_used, size, key in sorted(entries):
+        if total_bytes <= target_bytes:
+            break
+        if key == keep:
+            continue
+        shutil.rmtree(os.path.join(cache_directory, key), ignore_errors=True)
+        total_bytes -= size
+    return total_bytes
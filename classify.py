@@ -1,12 +1,14 @@
 
 import utils
+import scoring
+import cache
+import instrument
+import pipeline
+import manifest
 import os
-from random import sample
-import sys
-from math import exp
-
-empty_row = [-1] * 20
-acids_list = ['A', 'C', 'E', 'D', 'G', 'I', 'H', 'K', 'F', 'M', 'L', 'N', 'Q', 'P', 'S', 'R', 'T', 'W', 'V', 'Y']
+import argparse
+import heapq
+from concurrent.futures import ProcessPoolExecutor
 
 # Get the parent directory of this code
 this_script = os.path.abspath(__file__)
@@ -15,82 +17,205 @@ parent_directory = os.path.dirname(this_script)
 # Set the directory for testing output
 rr_output_directory = parent_directory + "/classified-rr-output"
 
-def main(pssm_files, pssm_dir, rr_dir):
-    classify(pssm_files, pssm_dir, rr_dir)
+def main(pssm_files, pssm_dir, rr_dir, top_k=None, model=None, compress=False, prefetch=0, band=None, quantize=False,
+         blocked=False):
+    classify(pssm_files, pssm_dir, rr_dir, top_k, model, compress=compress, prefetch=prefetch, band=band,
+             quantize=quantize, blocked=blocked)
     print("Done classifying. classified rr output is available in the following directory: " + rr_output_directory)
 
-def classify(pssm_files, pssm_dir, rr_dir):
+def batch_main():
+    """
+    Classify a directory of PSSM files with an existing model, without training
+    """
+    args = parse_args()
+    cache.configure(use_cache=not args.no_cache)
+    lengths = None
+    if args.manifest:
+        dataset = manifest.load(args.pssm_dir, args.rr_dir, args.manifest)
+        pssm_files, lengths = manifest.pssm_files(dataset, paired=False), manifest.lengths(dataset)
+    else:
+        pssm_files = utils.read_directory_contents(args.pssm_dir, '.pssm')
+    classify_parallel(pssm_files, args.pssm_dir, args.rr_dir, args.output_dir, os.path.abspath(args.model),
+                      args.workers, args.top_k, args.resume, args.gzip, args.prefetch, args.band,
+                      args.quantize, lengths, args.feature_blocks)
+    print("Done classifying. classified rr output is available in the following directory: " + args.output_dir)
+
+def classify(pssm_files, pssm_dir, rr_dir, top_k=None, model=None, output_dir=rr_output_directory, resume=False,
+             compress=False, prefetch=0, band=None, quantize=False, blocked=False):
     """
     Test the model. Generate contact probabilities and save them in .rr format sorted in descending order.
+    :param rr_dir: directory of .rr files to take the sequence header from, or None to use the PSSM residues
+    :param top_k: only write the top K pairs of each protein ('L/2', 'L/5', a count), or None for all of them
+    :param model: utils.Model to score with, or None to load the default model file
+    :param resume: keep existing output and skip proteins that already have an output file
+    :param compress: write gzip-compressed .rr.gz files
+    :param prefetch: proteins to read ahead in background threads while scoring (see pipeline.run), 0 for none
+    :param band: sequence separation band to score (see scoring.parse_band), None for every pair
+    :param quantize: score with integer arithmetic (see scoring.score_pairs_quantized)
+    :param blocked: score blocks of full pair features, keeping only the top K between blocks; without a top K
+                    every probability is still kept to be sorted
     """
     print("classifying...")
-    model = utils.read_model()
-    rr_rows = []
+    if model is None:
+        model = utils.load_model()
     # create directory for .rr files created by classification
     try:
-        os.mkdir(rr_output_directory)
+        os.mkdir(output_dir)
     except FileExistsError:
-        print("Removing old .rr files...")
-        old_rr_files = utils.read_directory_contents(rr_output_directory, '.rr')
-        for old_rr_file in old_rr_files:
-            os.remove(os.path.join(rr_output_directory, old_rr_file))
-    for pssm_file in pssm_files:
-        # get the feature values of every pair
-        classifier_matrix = build_classifier_matrix(pssm_file, pssm_dir)
-        # get the sequence associated with this pssm
-        rr = utils.read_rr(pssm_file.replace('.pssm', '.rr'), rr_dir)
-        for pair in range(len(classifier_matrix)):
-            contact_probability = calculate_contact_probability(model, classifier_matrix[pair])
-            # create row
-            i, j = list(classifier_matrix[pair].keys())[0][0], list(classifier_matrix[pair].keys())[0][1]
-            rr_row = [i, j, 0, 8, contact_probability]
-            # rr_rows.append(" ".join([str(x) for x in rr_row]))
-            rr_rows.append(rr_row)
-        # sort rows
-        rr_rows.sort(key = lambda row: row[4], reverse = True)
-        # write to file
-        file_name = os.path.join(rr_output_directory, pssm_file.replace('.pssm', '.rr'))
-        with open(file_name, 'w') as file:
-            # stringify all rows and put in file
-            for row in rr_rows:
-                file.write(" ".join([str(x) for x in row]) + "\n")
-
-def calculate_contact_probability(model, pair):
-    """
-    :return: the probability that the given pair is in contact
-    """
-    feature_values = list(pair.values())[0]
-    n = exp(model[0] + sum([model[i + 1] * feature_values[i] for i in range(200)]))
-    return n / (1 + n)
-
-def build_classifier_matrix(pssm_file, pssm_dir):
-    """
-    :return: a list of dictionaries with key = (i, j) and value = a list of feature values
-    """
-    pssm = utils.read_pssm(pssm_file, pssm_dir)
-    classifier_matrix = []
-    for i in range(len(pssm)):
-        for j in range(i + 5, len(pssm)):
-            feature = {}
-            row = get_five(pssm, i)
-            row.extend(get_five(pssm, j))
-            feature[(i, j)] = row
-            classifier_matrix.append(feature)
-    return classifier_matrix
-
-def get_five(pssm, i):
-    """
-    :return: a list of the 100 feature values in the sliding window around i
-    """
-    values = []
-    for row_offset in range(-2, 3):
-        if i + row_offset < 0:
-            values.extend(empty_row)
-        elif i + row_offset >= len(pssm):
-            values.extend(empty_row)
-        else:
-            values.extend([pssm[i + row_offset][k] for k in acids_list])
-    return values
-
-if __name__ == "__main()__":
-    main()
+        if not resume:
+            print("Removing old .rr files...")
+            old_rr_files = utils.read_directory_contents(output_dir, ('.rr', '.rr.gz'))
+            for old_rr_file in old_rr_files:
+                os.remove(os.path.join(output_dir, old_rr_file))
+    if resume:
+        pssm_files = [pssm_file for pssm_file in pssm_files
+                      if not os.path.exists(output_file_name(pssm_file, output_dir, compress))]
+    classify_proteins(pssm_files, pssm_dir, rr_dir, output_dir, model, top_k, compress, prefetch, band, quantize,
+                      blocked)
+
+def output_file_name(pssm_file, output_dir, compress=False):
+    """
+    :return: path of the .rr (or .rr.gz) output for a .pssm file
+    """
+    return os.path.join(output_dir, pssm_file.replace('.pssm', '.rr.gz' if compress else '.rr'))
+
+def classify_proteins(pssm_files, pssm_dir, rr_dir, output_dir, model, top_k=None, compress=False, prefetch=0,
+                      band=None, quantize=False, blocked=False):
+    """
+    Score every protein and write its pairs to output_dir in .rr format, reading and writing in
+    background threads when prefetch > 0
+    """
+    pipeline.run(pssm_files, lambda pssm_file: read_protein(pssm_file, pssm_dir, rr_dir),
+                 lambda pssm_file, data: score_protein(pssm_file, data, model, top_k, band, quantize,
+                                                                     blocked),
+                 lambda pssm_file, rows: write_protein(pssm_file, rows, output_dir, compress), prefetch)
+
+def read_protein(pssm_file, pssm_dir, rr_dir):
+    """
+    :return: (pssm, windows, sequence) of one protein
+    """
+    pssm, residues, windows = cache.load_pssm(pssm_file, pssm_dir)
+    # get the sequence associated with this pssm
+    if rr_dir:
+        sequence = cache.load_rr(pssm_file.replace('.pssm', '.rr'), rr_dir).sequence
+    else:
+        sequence = ''.join(residues.tolist())
+    return pssm, windows, sequence
+
+def score_protein(pssm_file, data, model, top_k=None, band=None, quantize=False, blocked=False):
+    """
+    :param data: (pssm, windows, sequence) from read_protein
+    :param band: sequence separation band to score (see scoring.parse_band), None for every pair
+    :param quantize: score with integer arithmetic (see scoring.score_pairs_quantized)
+    :param blocked: score blocks of full pair features (see scoring.pair_feature_blocks)
+    :return: (i_list, j_list, probabilities, sequence) of the pairs to write, most probable first
+    """
+    pssm, windows, sequence = data
+    min_separation, max_separation = scoring.parse_band(band)
+    # scoring and sorting consume the chunks together: with a top K, only the pairs kept so far outlive a chunk
+    with instrument.stage('score', pssm_file):
+        chunks = scoring.scored_chunks(model, pssm, min_separation, max_separation, windows, quantize, blocked)
+        k = scoring.top_k_count(top_k, len(pssm))
+        i_list, j_list, probabilities = scoring.select_top_blocks(chunks, k)
+    return i_list, j_list, probabilities, sequence
+
+def write_protein(pssm_file, rows, output_dir, compress=False):
+    """
+    Write the pairs from score_protein to the output file of pssm_file
+    """
+    with instrument.stage('write', pssm_file):
+        # written under a temporary name first, so a resumed run never sees a half-written output
+        utils.write_rr(output_file_name(pssm_file, output_dir, compress), *rows, compress=compress)
+
+def classify_parallel(pssm_files, pssm_dir, rr_dir, output_dir, model_path, workers=1, top_k=None, resume=False,
+                      compress=False, prefetch=0, band=None, quantize=False, lengths=None, blocked=False):
+    """
+    Classify proteins across worker processes. Shards are balanced by L^2, since that is how the cost of a
+    protein grows, and each shard runs its longest proteins first.
+    :param model_path: model file each worker loads
+    :param prefetch: proteins each worker reads ahead (see pipeline.run)
+    :param lengths: sequence length of each .pssm file, e.g. from manifest.lengths; without it the length is
+                    estimated from the file size
+    :param blocked: score blocks of full pair features (see score_protein)
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    if resume:
+        pssm_files = [pssm_file for pssm_file in pssm_files
+                      if not os.path.exists(output_file_name(pssm_file, output_dir, compress))]
+    if lengths is not None:
+        costs = {pssm_file: lengths[pssm_file] ** 2 for pssm_file in pssm_files}
+    else:
+        costs = {pssm_file: os.path.getsize(os.path.join(pssm_dir, pssm_file)) ** 2 for pssm_file in pssm_files}
+    shards = balance_shards(pssm_files, costs, workers)
+    print("classifying {} proteins in {} shards...".format(len(pssm_files), len(shards)))
+
+    if workers <= 1:
+        for shard in shards:
+            classify_shard(shard, pssm_dir, rr_dir, output_dir, model_path, top_k, compress, cache.settings(),
+                           prefetch, band, quantize, blocked)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(classify_shard, shard, pssm_dir, rr_dir, output_dir, model_path, top_k,
+                                   compress, cache.settings(), prefetch, band, quantize,
+                                   blocked) for shard in shards]
+        for future in futures:
+            # Raise any error from the workers
+            future.result()
+
+def balance_shards(pssm_files, costs, num_shards):
+    """
+    Split the files into shards of about equal total cost: most expensive first, each into the cheapest shard
+    :return: list of shards (lists of file names)
+    """
+    num_shards = max(1, min(num_shards, len(pssm_files)))
+    heap = [(0, shard_num) for shard_num in range(num_shards)]
+    shards = [[] for _ in range(num_shards)]
+    for pssm_file in sorted(pssm_files, key=lambda name: costs[name], reverse=True):
+        total, shard_num = heapq.heappop(heap)
+        shards[shard_num].append(pssm_file)
+        heapq.heappush(heap, (total + costs[pssm_file], shard_num))
+    return [shard for shard in shards if shard]
+
+def classify_shard(pssm_files, pssm_dir, rr_dir, output_dir, model_path, top_k, compress, cache_settings,
+                   prefetch=0, band=None, quantize=False, blocked=False):
+    """
+    Worker entry point for classify_parallel
+    """
+    cache.configure(**cache_settings)
+    model = utils.load_model(model_path, None)
+    classify_proteins(pssm_files, pssm_dir, rr_dir, output_dir, model, top_k, compress, prefetch, band, quantize,
+                      blocked)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Classify every .pssm file in a directory with an existing model.')
+    parser.add_argument('pssm_dir', help='directory with the .pssm files')
+    parser.add_argument('output_dir', help='directory to write the .rr predictions to')
+    parser.add_argument('--model', default=os.path.join(parent_directory, utils.MODEL_FILE), help='model file')
+    parser.add_argument('--rr-dir', default=None,
+                        help='directory of .rr files to take the sequence header from (default: the PSSM residues)')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes')
+    parser.add_argument('--top-k', default=None,
+                        help="only write the top K pairs of each protein: 'L/2', 'L/5', a count, or 'all' (default)")
+    parser.add_argument('--gzip', action='store_true', help='write gzip-compressed .rr.gz files')
+    parser.add_argument('--resume', action='store_true', help='skip proteins that already have an output file')
+    parser.add_argument('--manifest', default=None,
+                        help='list the proteins and their lengths from this manifest file, refreshing it '
+                             '(see manifest.py)')
+    parser.add_argument('--no-cache', action='store_true', help='parse every file instead of using the feature cache')
+    parser.add_argument('--band', default=None,
+                        help="sequence separation band to score: 'short', 'medium', 'long', 'all' (default), "
+                             "MIN-MAX or MIN-")
+    parser.add_argument('--quantize', action='store_true',
+                        help='score with int8 features and fixed-point weights instead of floats')
+    parser.add_argument('--feature-blocks', action='store_true',
+                        help='score blocks of full pair features, keeping only the top K pairs between blocks '
+                             '(without --top-k every probability is still kept to be sorted); not with --quantize')
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='proteins to read ahead while scoring, in background threads (default: none)')
+    args = parser.parse_args()
+    if args.quantize and args.feature_blocks:
+        parser.error('--quantize and --feature-blocks are different scoring paths; choose one')
+    return args
+
+if __name__ == "__main__":
+    batch_main()
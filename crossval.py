@@ -0,0 +1,257 @@
+# k-fold cross-validation: every protein is featurized once, then the folds are trained and evaluated in parallel
+import os
+import csv
+import json
+import random
+import shutil
+import argparse
+import tempfile
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import utils
+import cache
+import scoring
+import feature_store
+import manifest
+import train
+import test
+
+# Defaults
+FOLDS = 5
+
+
+def main():
+    args = parse_args()
+    cache.configure(args.cache_dir, use_cache=not args.no_cache)
+    dataset = None
+    if args.manifest:
+        dataset = manifest.load(args.pssm_dir, args.rr_dir, args.manifest)
+        pssm_list, rr_list = manifest.pssm_files(dataset, paired=False), manifest.rr_files(dataset)
+    else:
+        pssm_list = sorted(utils.read_directory_contents(args.pssm_dir, '.pssm'))
+        rr_list = utils.read_directory_contents(args.rr_dir, '.rr')
+    utils.test_correct_pssm_files(pssm_list, rr_list)
+
+    report = cross_validate(pssm_list, args.pssm_dir, args.rr_dir, args.folds, args.seed, args.workers,
+                            args.feature_store, args.store_dtype, args.negative_ratio, args.batch_size, args.epochs,
+                            args.learning_rate, args.schedule, args.decay, args.band, dataset)
+    print_report(report)
+    if args.report:
+        write_report(report, args.report)
+
+
+def cross_validate(pssm_list, pssm_dir, rr_dir, folds=FOLDS, seed=None, workers=1, store_dir=None,
+                   store_dtype='int8', negative_ratio=train.NEGATIVE_RATIO, batch_size=train.BATCH_SIZE,
+                   epochs=train.EPOCHS, learning_rate=train.LEARNING_RATE, schedule='constant', decay=0.0,
+                   band=None, dataset=None):
+    """
+    Splits the proteins into folds; each fold is evaluated with a model trained on all the other folds.
+    The training rows of every protein are built once, into a feature store that all folds read from.
+    :param store_dir: directory for the feature store; a store already built there from the same files,
+                      seed and negative ratio is reused. When None, a temporary directory is used and removed
+                      afterwards.
+    :param dataset: manifest of the files (see manifest.load), if there is one. The store is then built longest
+                    protein first and keyed on the file hashes rather than on sizes and mtimes.
+    :return: dictionary with the fold assignment, per-fold precision reports and their mean and standard deviation
+    """
+    if folds < 2 or len(pssm_list) < folds:
+        raise Exception('Cannot split {} proteins into {} folds'.format(len(pssm_list), folds))
+    # A temporary store is removed afterwards; a given store_dir is kept for later runs
+    temp_dir = None
+    if not store_dir:
+        store_dir = temp_dir = tempfile.mkdtemp(prefix='project4-crossval-')
+    try:
+        store_list = manifest.longest_first(pssm_list, dataset) if dataset else pssm_list
+        row_counts = build_store(store_dir, store_list, pssm_dir, rr_dir, seed, workers, negative_ratio, store_dtype,
+                                 dataset)
+        offsets = np.concatenate([[0], np.cumsum(row_counts)])
+        store_rows = {pssm_file: np.arange(offsets[index], offsets[index + 1])
+                      for index, pssm_file in enumerate(store_list)}
+
+        # Deal the shuffled proteins out to the folds
+        order = list(range(len(pssm_list)))
+        random.Random(seed).shuffle(order)
+        assignment = [sorted(order[fold::folds]) for fold in range(folds)]
+
+        jobs = []
+        for fold, held_out in enumerate(assignment):
+            held_out_set = set(held_out)
+            training = [index for index in range(len(pssm_list)) if index not in held_out_set]
+            rows = np.sort(np.concatenate([store_rows[pssm_list[index]] for index in training]))
+            jobs.append((fold, store_dir, rows, [pssm_list[index] for index in held_out], pssm_dir, rr_dir,
+                         (batch_size, epochs, learning_rate, schedule, decay, None if seed is None else seed + fold),
+                         band, cache.settings()))
+
+        print('Running {} folds...'.format(folds))
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=min(workers, folds)) as executor:
+                fold_reports = list(executor.map(run_fold, jobs))
+        else:
+            fold_reports = [run_fold(job) for job in jobs]
+    finally:
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    return {'folds': fold_reports, 'aggregate': aggregate(fold_reports),
+            'settings': {'folds': folds, 'seed': seed, 'negative_ratio': negative_ratio, 'batch_size': batch_size,
+                         'epochs': epochs, 'learning_rate': learning_rate, 'schedule': schedule, 'decay': decay,
+                         'band': band}}
+
+
+def build_store(store_dir, pssm_list, pssm_dir, rr_dir, seed, workers, negative_ratio, store_dtype, dataset=None):
+    """
+    Builds the training rows of every protein into a feature store, unless store_dir already holds them
+    :param dataset: manifest of the files, whose hashes identify them; without it, their sizes and mtimes do
+    :return: number of rows of each protein, in pssm_list order
+    """
+    files = manifest.hashes(dataset, pssm_list) if dataset else file_stamps(pssm_list, pssm_dir, rr_dir)
+    description = {'proteins': pssm_list, 'files': files, 'seed': seed, 'negative_ratio': negative_ratio,
+                   'dtype': store_dtype}
+    description_file = os.path.join(store_dir, 'crossval.json')
+    if os.path.exists(description_file):
+        with open(description_file, 'r') as file:
+            existing = json.load(file)
+        if {key: existing.get(key) for key in description} == description:
+            print('Reusing the feature store in ' + store_dir)
+            return existing['row_counts']
+
+    print('Building feature matrix...')
+    random.seed(seed)
+    row_counts = []
+
+    def chunks():
+        for features, labels in train.iter_protein_features(pssm_list, pssm_dir, rr_dir, workers, negative_ratio):
+            row_counts.append(len(labels))
+            yield features, labels
+
+    feature_store.write_store(store_dir, chunks(), store_dtype)
+    description['row_counts'] = row_counts
+    with open(description_file, 'w') as file:
+        json.dump(description, file)
+    return row_counts
+
+
+def file_stamps(pssm_list, pssm_dir, rr_dir):
+    """
+    :return: [size, mtime_ns] of the .pssm and .rr file of every protein, so that a store built before
+             any of them changed is not reused
+    """
+    stamps = []
+    for pssm_file in pssm_list:
+        for file_path in (os.path.join(pssm_dir, pssm_file), os.path.join(rr_dir, pssm_file.replace('.pssm', '.rr'))):
+            stat = os.stat(file_path)
+            stamps.append([stat.st_size, stat.st_mtime_ns])
+    return stamps
+
+
+def run_fold(job):
+    """
+    Trains on the given rows of the store and evaluates on the held-out proteins
+    :param job: (fold, store_dir, training rows, held-out .pssm files, pssm_dir, rr_dir,
+                 (batch_size, epochs, learning_rate, schedule, decay, seed), band, cache settings)
+    :return: precision report of the fold (see test.summarize)
+    """
+    fold, store_dir, rows, held_out, pssm_dir, rr_dir, fit_settings, band, cache_settings = job
+    cache.configure(**cache_settings)
+    features, labels = feature_store.open_store(store_dir)
+    batch_size, epochs, learning_rate, schedule, decay, seed = fit_settings
+    # batches are read from the memory-mapped store by row index, so the fold's rows are never copied whole
+    w_vector = train.fit_vectorized(features, labels, train.new_w_vector(), batch_size, epochs, learning_rate,
+                                    schedule, decay, seed, rows)
+    model = utils.Model(w_vector)
+
+    min_separation, max_separation = scoring.parse_band(band)
+    results = []
+    for pssm_file in held_out:
+        pssm, residues, windows = cache.load_pssm(pssm_file, pssm_dir)
+        contact_map = cache.load_rr(pssm_file.replace('.pssm', '.rr'), rr_dir)
+        chunks = scoring.iter_scored_pairs(model, pssm, min_separation, max_separation, windows)
+        result = {'protein': pssm_file.replace('.pssm', '')}
+        result.update(test.evaluate(chunks, contact_map, (min_separation, max_separation)))
+        results.append(result)
+
+    report = test.summarize(results)
+    report['fold'] = fold
+    report['training_rows'] = len(rows)
+    return report
+
+
+def aggregate(fold_reports):
+    """
+    :return: mean and standard deviation over the folds of each precision value
+    """
+    result = {'mean': {}, 'std': {}}
+    for name in test.precision_columns():
+        values = [report['aggregate'][name] for report in fold_reports if report['aggregate'][name] is not None]
+        result['mean'][name] = float(np.mean(values)) if values else None
+        result['std'][name] = float(np.std(values)) if values else None
+    return result
+
+
+def print_report(report):
+    names = [name for name, divisor in test.PRECISION_CUTOFFS]
+    print('fold  proteins  ' + '  '.join('{:>8}'.format(name) for name in names))
+    for fold_report in report['folds']:
+        print('{:>4}  {:>8}  '.format(fold_report['fold'], fold_report['aggregate']['proteins']) +
+              '  '.join('{:>8.4f}'.format(fold_report['aggregate'][name]) for name in names))
+    for statistic in ['mean', 'std']:
+        print('{:>4}  {:>8}  '.format(statistic, '') +
+              '  '.join('{:>8.4f}'.format(report['aggregate'][statistic][name]) for name in names))
+
+
+def write_report(report, file_name):
+    """
+    Write the cross-validation report: one row per fold plus 'mean' and 'std' rows for .csv files, JSON otherwise
+    """
+    columns = ['fold', 'proteins'] + test.precision_columns()
+    with open(file_name, 'w', newline='') as file:
+        if not file_name.endswith('.csv'):
+            json.dump(report, file, indent=2)
+            return
+        writer = csv.DictWriter(file, fieldnames=columns)
+        writer.writeheader()
+        for fold_report in report['folds']:
+            row = {'fold': fold_report['fold'], 'proteins': fold_report['aggregate']['proteins']}
+            row.update({name: fold_report['aggregate'][name] for name in test.precision_columns()})
+            writer.writerow(row)
+        for statistic in ['mean', 'std']:
+            row = {'fold': statistic, 'proteins': ''}
+            row.update(report['aggregate'][statistic])
+            writer.writerow(row)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='k-fold cross-validation of the contact model.')
+    parser.add_argument('pssm_dir', help='directory with the .pssm files')
+    parser.add_argument('rr_dir', help='directory with the .rr files')
+    parser.add_argument('--folds', type=int, default=FOLDS)
+    parser.add_argument('--seed', type=int, default=None, help='seed for the folds, sampling and batches')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='processes used to build the feature matrix and to run the folds')
+    parser.add_argument('--feature-store', default=None,
+                        help='directory for the shared training rows; reused by later runs with the same data')
+    parser.add_argument('--store-dtype', choices=['int8', 'int16'], default='int8',
+                        help='integer type of the features in the store')
+    parser.add_argument('--negative-ratio', type=float, default=train.NEGATIVE_RATIO,
+                        help='non-contact pairs sampled per contact for training')
+    parser.add_argument('--batch-size', type=int, default=train.BATCH_SIZE)
+    parser.add_argument('--epochs', type=int, default=train.EPOCHS)
+    parser.add_argument('--learning-rate', type=float, default=train.LEARNING_RATE)
+    parser.add_argument('--schedule', choices=['constant', 'inverse', 'exponential'], default='constant')
+    parser.add_argument('--decay', type=float, default=0.0,
+                        help='decay rate of the learning rate schedule: lr / (1 + decay * epoch) for inverse, '
+                             'lr * exp(-decay * epoch) for exponential (default 0: no decay)')
+    parser.add_argument('--band', default=None,
+                        help="sequence separation band to evaluate: 'short', 'medium', 'long', 'all' (default), "
+                             "MIN-MAX or MIN-")
+    parser.add_argument('--report', default=None,
+                        help='write per-fold and mean precision to this file (.csv, otherwise JSON)')
+    parser.add_argument('--manifest', default=None,
+                        help='list the dataset from this manifest file, refreshing it (see manifest.py)')
+    parser.add_argument('--no-cache', action='store_true', help='parse every file instead of using the feature cache')
+    parser.add_argument('--cache-dir', default=cache.cache_directory, help='directory of the feature cache')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
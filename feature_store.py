@@ -0,0 +1,68 @@
+# On-disk, memory-mapped store of training rows, so training data does not have to fit in RAM
+import os
+import json
+import numpy as np
+import utils
+
+# Rows are written to disk once this many have been buffered
+CHUNK_ROWS = 65536
+
+
+def write_store(directory, chunks, dtype='int8'):
+    """
+    Writes feature rows and labels to directory as raw arrays, chunk by chunk, with a JSON file describing them
+    :param chunks: iterable of (N x 200 feature array, array of N class labels)
+    :param dtype: integer type of the stored features ('int8' or 'int16')
+    :return: (features, labels) memory-mapped from the store
+    """
+    os.makedirs(directory, exist_ok=True)
+    dtype = np.dtype(dtype)
+    limits = np.iinfo(dtype)
+    num_rows = 0
+    num_features = None
+    buffered_features, buffered_labels, buffered_rows = [], [], 0
+
+    with open(os.path.join(directory, 'features.bin'), 'wb') as feature_file, \
+            open(os.path.join(directory, 'labels.bin'), 'wb') as label_file:
+        def flush():
+            if buffered_rows:
+                feature_file.write(np.concatenate(buffered_features).tobytes())
+                label_file.write(np.concatenate(buffered_labels).tobytes())
+            del buffered_features[:]
+            del buffered_labels[:]
+
+        for features, labels in chunks:
+            if len(features) == 0:
+                continue
+            if features.min() < limits.min or features.max() > limits.max:
+                raise Exception('Feature values do not fit in {}; store them as a wider type'.format(dtype))
+            num_features = features.shape[1]
+            buffered_features.append(features.astype(dtype))
+            buffered_labels.append(labels.astype(np.int8))
+            buffered_rows += len(features)
+            num_rows += len(features)
+            if buffered_rows >= CHUNK_ROWS:
+                flush()
+                buffered_rows = 0
+        flush()
+
+    with open(os.path.join(directory, 'store.json'), 'w') as file:
+        json.dump({'rows': num_rows, 'num_features': num_features or utils.feature_layout()['num_features'],
+                   'dtype': dtype.name, 'layout': utils.feature_layout()}, file)
+    return open_store(directory)
+
+
+def open_store(directory):
+    """
+    :return: (N x 200 feature array, array of N class labels), memory-mapped read-only from the store
+    """
+    with open(os.path.join(directory, 'store.json'), 'r') as file:
+        meta = json.load(file)
+    if meta['layout'] != utils.feature_layout():
+        raise Exception('Feature store {} was built for a different feature layout'.format(directory))
+    if meta['rows'] == 0:
+        return np.zeros((0, meta['num_features']), dtype=meta['dtype']), np.zeros(0, dtype=np.int8)
+    features = np.memmap(os.path.join(directory, 'features.bin'), dtype=meta['dtype'], mode='r',
+                         shape=(meta['rows'], meta['num_features']))
+    labels = np.memmap(os.path.join(directory, 'labels.bin'), dtype=np.int8, mode='r', shape=(meta['rows'],))
+    return features, labels
@@ -0,0 +1,152 @@
+# Timing and memory instrumentation for the stages of train/test/classify
+import os
+import csv
+import json
+import time
+import resource
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+# Instrumentation settings, changed with configure()
+enabled = False
+log_interval = 0
+
+# One record per finished stage, and one per progress event (e.g. gradient iterations)
+records = []
+progress = []
+
+# Stages that are currently running in each thread, innermost last
+local = threading.local()
+
+
+def configure(use_instrumentation=None, interval=None):
+    """
+    Turn instrumentation on or off, and set how many gradient iterations go between progress reports
+    """
+    global enabled, log_interval
+    if use_instrumentation is not None:
+        enabled = use_instrumentation
+        if enabled and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        elif not enabled and tracemalloc.is_tracing():
+            tracemalloc.stop()
+    if interval is not None:
+        log_interval = interval
+
+
+def settings():
+    """
+    :return: the current settings as keyword arguments for configure(), e.g. to pass on to worker processes
+    """
+    return {'use_instrumentation': enabled, 'interval': log_interval}
+
+
+@contextmanager
+def stage(name, protein=None):
+    """
+    Records wall time, CPU time and peak traced memory of the code inside the with block.
+    Stages nest per thread; traced memory is per process, so the peak of a stage that runs alongside
+    other threads includes their allocations.
+    """
+    if not enabled:
+        yield
+        return
+
+    if not hasattr(local, 'running'):
+        local.running = []
+    running = local.running
+
+    # Keep the peak of the enclosing stage before resetting it for this one
+    if running:
+        running[-1]['peak'] = max(running[-1]['peak'], tracemalloc.get_traced_memory()[1])
+    tracemalloc.reset_peak()
+    current = {'peak': 0}
+    running.append(current)
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+        peak = max(current['peak'], tracemalloc.get_traced_memory()[1])
+        running.pop()
+        if running:
+            running[-1]['peak'] = max(running[-1]['peak'], peak)
+        tracemalloc.reset_peak()
+        records.append({'stage': name, 'protein': protein, 'wall_seconds': wall, 'cpu_seconds': cpu,
+                        'peak_memory_bytes': peak, 'max_rss_bytes': max_rss()})
+
+
+def should_log(iteration):
+    """
+    :return: whether a progress report is due at this iteration
+    """
+    return enabled and log_interval > 0 and iteration % log_interval == 0
+
+
+def report_progress(stage_name, iteration, **values):
+    """
+    Records and prints a progress event, e.g. the likelihood after a number of gradient iterations
+    """
+    event = {'stage': stage_name, 'iteration': iteration}
+    event.update(values)
+    progress.append(event)
+    print(stage_name + ': ' + ', '.join('{} = {}'.format(key, value) for key, value in event.items()
+                                        if key != 'stage'))
+
+
+def take_records():
+    """
+    Removes and returns everything recorded so far, e.g. to send from a worker process to the parent
+    """
+    taken = (records[:], progress[:])
+    del records[:]
+    del progress[:]
+    return taken
+
+
+def add_records(taken):
+    """
+    Adds records returned by take_records in another process
+    """
+    records.extend(taken[0])
+    progress.extend(taken[1])
+
+
+def summary():
+    """
+    :return: total wall/CPU time, the number of runs and the largest peak memory of each stage
+    """
+    stages = {}
+    for record in records:
+        total = stages.setdefault(record['stage'], {'count': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0,
+                                                    'peak_memory_bytes': 0})
+        total['count'] += 1
+        total['wall_seconds'] += record['wall_seconds']
+        total['cpu_seconds'] += record['cpu_seconds']
+        total['peak_memory_bytes'] = max(total['peak_memory_bytes'], record['peak_memory_bytes'])
+    return stages
+
+
+def write_report(file_name):
+    """
+    Write the run report: every stage record for .csv files, otherwise JSON with the records, progress and summary
+    """
+    with open(file_name, 'w', newline='') as file:
+        if file_name.endswith('.csv'):
+            columns = ['stage', 'protein', 'wall_seconds', 'cpu_seconds', 'peak_memory_bytes', 'max_rss_bytes']
+            writer = csv.DictWriter(file, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(records)
+        else:
+            json.dump({'pid': os.getpid(), 'summary': summary(), 'records': records, 'progress': progress},
+                      file, indent=2)
+
+
+def max_rss():
+    """
+    :return: peak resident memory of this process in bytes
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return usage if os.uname().sysname == 'Darwin' else usage * 1024
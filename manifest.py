@@ -0,0 +1,161 @@
+# Dataset manifest: one scan of the PSSM and RR directories, recording pairing, sizes, mtimes, hashes and lengths.
+# It is saved to an index file and only files that changed since the last scan are read again.
+import os
+import io
+import json
+import hashlib
+import argparse
+import utils
+
+MANIFEST_VERSION = 2
+MANIFEST_FILE = os.path.join(utils.parent_directory, 'manifest.json')
+
+
+def load(pssm_dir, rr_dir=None, manifest_file=MANIFEST_FILE):
+    """
+    Refreshes the manifest of pssm_dir and rr_dir and saves it to manifest_file
+    :return: the manifest dictionary (see scan)
+    """
+    previous = None
+    if manifest_file and os.path.exists(manifest_file):
+        with open(manifest_file, 'r') as file:
+            previous = json.load(file)
+    manifest = scan(pssm_dir, rr_dir, previous)
+    if manifest_file:
+        temp_name = manifest_file + '.tmp'
+        with open(temp_name, 'w') as file:
+            json.dump(manifest, file)
+        os.replace(temp_name, manifest_file)
+    return manifest
+
+
+def scan(pssm_dir, rr_dir=None, previous=None):
+    """
+    Lists both directories once. Files whose size, mtime and ctime match the previous manifest keep their entry;
+    the others are read again, once each, to hash them and parse their sequence length.
+    :return: dictionary with the directories and, per protein name, the entries of its .pssm and .rr file
+             ({'file', 'size', 'mtime_ns', 'ctime_ns', 'sha256', 'length'}, or None when the file is missing)
+    """
+    pssm_dir = os.path.abspath(pssm_dir)
+    rr_dir = os.path.abspath(rr_dir) if rr_dir else None
+    reusable = {}
+    if previous and previous.get('version') == MANIFEST_VERSION:
+        for protein, entry in previous['proteins'].items():
+            for kind, directory in (('pssm', previous['pssm_dir']), ('rr', previous['rr_dir'])):
+                if entry.get(kind) and directory:
+                    reusable[os.path.join(directory, entry[kind]['file'])] = entry[kind]
+
+    proteins = {}
+    for kind, directory, extension in (('pssm', pssm_dir, '.pssm'), ('rr', rr_dir, '.rr')):
+        if directory is None:
+            continue
+        if not os.path.isdir(directory):
+            raise Exception('Not a valid directory!')
+        with os.scandir(directory) as entries:
+            for dir_entry in entries:
+                if not dir_entry.name.endswith(extension) or not dir_entry.is_file():
+                    continue
+                protein = dir_entry.name[:-len(extension)]
+                stat = dir_entry.stat()
+                entry = reusable.get(dir_entry.path)
+                if entry is None or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns \
+                        or entry['ctime_ns'] != stat.st_ctime_ns:
+                    entry = file_entry(dir_entry.path, kind, stat)
+                proteins.setdefault(protein, {'pssm': None, 'rr': None})[kind] = entry
+
+    return {'version': MANIFEST_VERSION, 'pssm_dir': pssm_dir, 'rr_dir': rr_dir, 'proteins': proteins}
+
+
+def file_entry(file_path, kind, stat):
+    """
+    :return: manifest entry of one .pssm or .rr file
+    """
+    # read once: the same bytes are hashed and parsed
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    try:
+        if kind == 'pssm':
+            length = len(utils.parse_pssm_array(io.StringIO(data.decode()))[0])
+        else:
+            length = len(io.StringIO(data.decode()).readline().strip())
+    except (ValueError, IndexError):
+        raise Exception('Not a valid .{} file: {}'.format(kind, file_path))
+    return {'file': os.path.basename(file_path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+            'ctime_ns': stat.st_ctime_ns, 'sha256': hashlib.sha256(data).hexdigest(), 'length': length}
+
+
+def pssm_files(manifest, paired=True):
+    """
+    :param paired: only the .pssm files that have a matching .rr file
+    :return: sorted list of .pssm file names
+    """
+    return sorted(entry['pssm']['file'] for entry in manifest['proteins'].values()
+                  if entry['pssm'] and (entry['rr'] or not paired))
+
+
+def rr_files(manifest):
+    """
+    :return: sorted list of .rr file names
+    """
+    return sorted(entry['rr']['file'] for entry in manifest['proteins'].values() if entry['rr'])
+
+
+def unpaired(manifest):
+    """
+    :return: sorted names of the files without a partner in the other directory
+    """
+    return sorted((entry['pssm'] or entry['rr'])['file'] for entry in manifest['proteins'].values()
+                  if not (entry['pssm'] and entry['rr']))
+
+
+def lengths(manifest):
+    """
+    :return: dictionary of .pssm file name -> sequence length
+    """
+    return {entry['pssm']['file']: entry['pssm']['length'] for entry in manifest['proteins'].values()
+            if entry['pssm']}
+
+
+def hashes(manifest, pssm_list):
+    """
+    :return: [.pssm sha256, .rr sha256 or None] of every protein in pssm_list, to tell whether anything built
+             from the files is still current
+    """
+    entries = {entry['pssm']['file']: entry for entry in manifest['proteins'].values() if entry['pssm']}
+    return [[entries[name]['pssm']['sha256'], entries[name]['rr']['sha256'] if entries[name]['rr'] else None]
+            for name in pssm_list]
+
+
+def longest_first(pssm_list, manifest):
+    """
+    Orders proteins longest first, so the most expensive work is started first and parallel workers finish together
+    :return: sorted copy of pssm_list
+    """
+    protein_lengths = lengths(manifest)
+    return sorted(pssm_list, key=lambda name: (-protein_lengths.get(name, 0), name))
+
+
+def main():
+    args = parse_args()
+    manifest = load(args.pssm_dir, args.rr_dir, args.manifest)
+    protein_lengths = sorted(lengths(manifest).values())
+    print('{} .pssm files, {} .rr files, {} paired'.format(len(pssm_files(manifest, False)), len(rr_files(manifest)),
+                                                           len(pssm_files(manifest))))
+    if protein_lengths:
+        print('lengths {} to {}, {} residues in total'.format(protein_lengths[0], protein_lengths[-1],
+                                                              sum(protein_lengths)))
+    for name in unpaired(manifest):
+        print('unpaired: ' + name)
+    print('Manifest written to ' + args.manifest)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Build or refresh the manifest of a PSSM/RR dataset.')
+    parser.add_argument('pssm_dir', help='directory with the .pssm files')
+    parser.add_argument('rr_dir', nargs='?', default=None, help='directory with the .rr files')
+    parser.add_argument('--manifest', default=MANIFEST_FILE, help='index file to refresh')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,265 @@
+# Optimizers for the conditional log likelihood: full-batch L-BFGS and mini-batch Adam, with convergence checks
+import numpy as np
+import scoring
+import instrument
+import feature_store
+
+# Stopping defaults
+MAX_ITERATIONS = 500
+GRADIENT_TOLERANCE = 1e-5
+RELATIVE_TOLERANCE = 1e-7
+PATIENCE = 5
+
+# L-BFGS defaults
+HISTORY = 10
+
+# Adam defaults
+BETA1 = 0.9
+BETA2 = 0.999
+EPSILON = 1e-8
+
+
+def likelihood_and_gradient(w, features, labels):
+    """
+    Mean conditional log likelihood of the rows and its gradient, in one pass over the rows
+    :return: (likelihood, gradient array of length 201)
+    """
+    likelihood, gradient = chunked_likelihood(w, features, labels, with_gradient=True)
+    num_rows = max(len(labels), 1)
+    return likelihood / num_rows, gradient / num_rows
+
+
+def chunked_likelihood(w, features, labels, rows=None, with_gradient=False):
+    """
+    Conditional log likelihood summed over the rows (see train.calc_max_conditional_likelihood)
+    :param rows: sorted indices of the rows to sum over, or None for every row
+    :param with_gradient: also sum the gradient (see batch_gradient)
+    :return: likelihood, or (likelihood, gradient array of length 201) with with_gradient
+    """
+    w = np.asarray(w, dtype=np.float64)
+    total, gradient = 0.0, np.zeros(len(w))
+    # Go through the rows in blocks, so a memory-mapped store is never loaded all at once
+    for start in range(0, len(labels) if rows is None else len(rows), feature_store.CHUNK_ROWS):
+        block = slice(start, start + feature_store.CHUNK_ROWS)
+        if rows is not None:
+            block = rows[block]
+        if with_gradient:
+            block_gradient, likelihood = batch_gradient(w, features, labels, block, with_likelihood=True)
+            gradient += block_gradient
+        else:
+            likelihood = summed_likelihood(labels[block], w[0] + features[block].astype(np.float64) @ w[1:])
+        total += likelihood
+    return (total, gradient) if with_gradient else total
+
+
+def batch_gradient(w, features, labels, rows, with_likelihood=False):
+    """
+    Gradient of the conditional log likelihood summed over some of the rows, from two matrix-vector products
+    :param w: weight array of length 201
+    :param rows: sorted index array or slice of the rows
+    :param with_likelihood: also return the likelihood of the rows, from the same products
+    :return: gradient array of length 201 (not divided by the number of rows), or (gradient, likelihood)
+    """
+    x = features[rows].astype(np.float64)
+    y = labels[rows]
+    feature_sum = w[0] + x @ w[1:]
+    # y - P(Y=1|X,w) for every row
+    error = y - scoring.sigmoid(feature_sum)
+    gradient = np.empty(len(w))
+    gradient[0] = error.sum()
+    gradient[1:] = x.T @ error
+    if with_likelihood:
+        return gradient, summed_likelihood(y, feature_sum)
+    return gradient
+
+
+def summed_likelihood(labels, feature_sum):
+    """
+    log(1 + exp(sum)) is computed with logaddexp so large sums do not overflow
+    :return: conditional log likelihood summed over rows with these labels and weighted feature sums
+    """
+    return float(np.sum(labels * feature_sum - np.logaddexp(0, feature_sum)))
+
+
+def epoch_batches(num_rows, batch_size, rng):
+    """
+    Shuffles the rows into the batches of one epoch of mini-batch training
+    :return: list of sorted row index arrays
+    """
+    order = rng.permutation(num_rows)
+    # Sorted indices read a memory-mapped store front to back
+    return [np.sort(order[start:start + batch_size]) for start in range(0, num_rows, batch_size)]
+
+
+def stopping_reason(iteration, likelihood, previous_likelihood, gradient, max_iterations=MAX_ITERATIONS,
+                    gradient_tolerance=GRADIENT_TOLERANCE, relative_tolerance=RELATIVE_TOLERANCE):
+    """
+    :return: why training should stop after this iteration, or None to keep going
+    """
+    if gradient_tolerance and np.linalg.norm(gradient) <= gradient_tolerance:
+        return 'gradient_norm'
+    if relative_tolerance and previous_likelihood is not None and \
+            abs(likelihood - previous_likelihood) <= relative_tolerance * max(abs(previous_likelihood), 1e-12):
+        return 'relative_change'
+    if iteration >= max_iterations:
+        return 'max_iterations'
+    return None
+
+
+def early_stopping(w, validation, best, patience=PATIENCE):
+    """
+    Tracks the held-out likelihood for early stopping
+    :param validation: (features, labels) of held-out rows, or None to not use early stopping
+    :param best: dictionary kept between calls, with the best weights, their held-out likelihood and the
+                 number of checks since they improved
+    :return: whether the held-out likelihood has not improved for patience checks
+    """
+    if validation is None:
+        return False
+    likelihood = likelihood_and_gradient(w, *validation)[0]
+    if 'likelihood' not in best or likelihood > best['likelihood']:
+        best.update({'w': np.array(w), 'likelihood': likelihood, 'stale': 0})
+    else:
+        best['stale'] += 1
+    return best['stale'] >= patience
+
+
+def lbfgs(features, labels, w_vector, max_iterations=MAX_ITERATIONS, gradient_tolerance=GRADIENT_TOLERANCE,
+          relative_tolerance=RELATIVE_TOLERANCE, validation=None, patience=PATIENCE, history=HISTORY):
+    """
+    Maximizes the mean conditional log likelihood with full-batch L-BFGS (two-loop recursion over the last
+    history steps) and a backtracking line search
+    :param validation: (features, labels) of held-out rows for early stopping, or None
+    :return: (w_vector as a list of length 201, dictionary with the iterations, likelihood and stopping reason)
+    """
+    w = np.array(w_vector, dtype=np.float64)
+    # L-BFGS minimizes, so work with the negative likelihood
+    likelihood, gradient = likelihood_and_gradient(w, features, labels)
+    loss, loss_gradient = -likelihood, -gradient
+    steps, changes = [], []
+    best = {}
+    iteration, reason = 0, None
+
+    with instrument.stage('gradient_iterations'):
+        while reason is None:
+            direction = -two_loop(loss_gradient, steps, changes)
+            slope = float(loss_gradient @ direction)
+            if slope >= 0:
+                # not a descent direction: start again from steepest descent
+                steps, changes = [], []
+                direction, slope = -loss_gradient, -float(loss_gradient @ loss_gradient)
+            # the first step has no curvature information, so keep it short
+            step_size = 1.0 if steps else min(1.0, 1.0 / max(np.linalg.norm(loss_gradient), 1e-12))
+            # backtrack until the Armijo condition holds
+            for _ in range(50):
+                new_w = w + step_size * direction
+                new_likelihood, new_gradient = likelihood_and_gradient(new_w, features, labels)
+                if -new_likelihood <= loss + 1e-4 * step_size * slope:
+                    break
+                step_size /= 2
+            else:
+                reason = 'line_search'
+                break
+
+            step, change = new_w - w, -new_gradient - loss_gradient
+            # the likelihood is concave, so s.y > 0 except by rounding; such pairs are skipped
+            if float(step @ change) > 1e-12:
+                steps.append(step)
+                changes.append(change)
+                if len(steps) > history:
+                    steps.pop(0)
+                    changes.pop(0)
+
+            previous_likelihood = -loss
+            w, loss, loss_gradient = new_w, -new_likelihood, -new_gradient
+            iteration += 1
+            if instrument.should_log(iteration):
+                instrument.report_progress('lbfgs', iteration, likelihood=-loss,
+                                           gradient_norm=float(np.linalg.norm(loss_gradient)))
+            reason = stopping_reason(iteration, -loss, previous_likelihood, loss_gradient, max_iterations,
+                                     gradient_tolerance, relative_tolerance)
+            if reason is None and early_stopping(w, validation, best, patience):
+                reason = 'early_stopping'
+
+    return finish(w, best, iteration, reason, features, labels)
+
+
+def two_loop(gradient, steps, changes):
+    """
+    L-BFGS two-loop recursion
+    :param steps: the last weight changes s
+    :param changes: the matching gradient changes y of the function being minimized
+    :return: the approximate inverse Hessian times gradient
+    """
+    q = gradient.copy()
+    alphas = []
+    for s, y in reversed(list(zip(steps, changes))):
+        alpha = float(s @ q) / float(y @ s)
+        q -= alpha * y
+        alphas.append(alpha)
+    if steps:
+        s, y = steps[-1], changes[-1]
+        q *= float(s @ y) / float(y @ y)
+    for (s, y), alpha in zip(zip(steps, changes), reversed(alphas)):
+        beta = float(y @ q) / float(y @ s)
+        q += s * (alpha - beta)
+    return q
+
+
+def adam(features, labels, w_vector, batch_size=256, learning_rate=0.01, max_iterations=MAX_ITERATIONS,
+         gradient_tolerance=GRADIENT_TOLERANCE, relative_tolerance=RELATIVE_TOLERANCE, validation=None,
+         patience=PATIENCE, seed=None, beta1=BETA1, beta2=BETA2, epsilon=EPSILON):
+    """
+    Maximizes the mean conditional log likelihood with Adam on mini-batches.
+    Convergence and early stopping are checked once per epoch, on the likelihood of all rows;
+    max_iterations counts epochs.
+    :param validation: (features, labels) of held-out rows for early stopping, or None
+    :return: (w_vector as a list of length 201, dictionary with the epochs, likelihood and stopping reason)
+    """
+    rng = np.random.default_rng(seed)
+    w = np.array(w_vector, dtype=np.float64)
+    first, second = np.zeros(len(w)), np.zeros(len(w))
+    num_rows = len(labels)
+    step = 0
+    best = {}
+    previous_likelihood = likelihood_and_gradient(w, features, labels)[0]
+    epoch, reason = 0, None
+
+    with instrument.stage('gradient_iterations'):
+        while reason is None and num_rows:
+            for batch in epoch_batches(num_rows, batch_size, rng):
+                gradient = batch_gradient(w, features, labels, batch) / len(batch)
+                step += 1
+                first = beta1 * first + (1 - beta1) * gradient
+                second = beta2 * second + (1 - beta2) * gradient * gradient
+                corrected_first = first / (1 - beta1 ** step)
+                corrected_second = second / (1 - beta2 ** step)
+                # ascent, since the likelihood is maximized
+                w += learning_rate * corrected_first / (np.sqrt(corrected_second) + epsilon)
+
+            epoch += 1
+            likelihood, gradient = likelihood_and_gradient(w, features, labels)
+            if instrument.should_log(epoch):
+                instrument.report_progress('adam', epoch, likelihood=likelihood,
+                                           gradient_norm=float(np.linalg.norm(gradient)))
+            reason = stopping_reason(epoch, likelihood, previous_likelihood, gradient, max_iterations,
+                                     gradient_tolerance, relative_tolerance)
+            if reason is None and early_stopping(w, validation, best, patience):
+                reason = 'early_stopping'
+            previous_likelihood = likelihood
+
+    return finish(w, best, epoch, reason, features, labels)
+
+
+def finish(w, best, iterations, reason, features, labels):
+    """
+    :return: the weights to keep (the best held-out ones when early stopping was used) and a summary of the run
+    """
+    if 'w' in best:
+        w = best['w']
+    info = {'iterations': iterations, 'stopped': reason or 'no_rows',
+            'likelihood': likelihood_and_gradient(w, features, labels)[0]}
+    if 'likelihood' in best:
+        info['held_out_likelihood'] = best['likelihood']
+    print('Stopped after {} iterations ({})'.format(iterations, info['stopped']))
+    return w.tolist(), info
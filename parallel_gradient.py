@@ -0,0 +1,136 @@
+# Data-parallel gradient ascent: worker processes compute partial gradients over shards of the training rows
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import instrument
+import optimize
+
+# Arrays attached in a worker process, by handle, so each worker maps the training rows only once
+attached = {}
+
+# Fewest rows a worker gets per step. Below this, sending the weights out and the partial gradient back costs
+# more than computing it, so a step is split over fewer workers, or computed in this process when it is smaller
+# than two shards.
+MIN_SHARD_ROWS = 32768
+
+
+def share_array(array):
+    """
+    Makes array readable from worker processes without copying it into every task.
+    A memory-mapped array (e.g. from a feature store) is opened again by the workers; anything else is copied
+    into shared memory once.
+    :return: (handle to pass to the workers, SharedMemory block to release afterwards or None)
+    """
+    if isinstance(array, np.memmap) and array.filename:
+        return ('file', array.filename, array.dtype.str, array.shape, array.offset), None
+    block = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+    return ('shm', block.name, array.dtype.str, array.shape), block
+
+
+def attach_array(handle):
+    """
+    :return: the array behind a handle from share_array
+    """
+    if handle not in attached:
+        if handle[0] == 'file':
+            kind, file_name, dtype, shape, offset = handle
+            attached[handle] = np.memmap(file_name, dtype=dtype, mode='r', shape=shape, offset=offset)
+        else:
+            kind, name, dtype, shape = handle
+            block = shared_memory.SharedMemory(name=name)
+            # keep the block open for as long as the array is used
+            attached[handle] = (np.ndarray(shape, dtype=dtype, buffer=block.buf), block)
+    array = attached[handle]
+    return array[0] if isinstance(array, tuple) else array
+
+
+def step_shards(num_rows, workers):
+    """
+    :return: number of shards to split a step of num_rows rows into: at most workers, with at least
+             MIN_SHARD_ROWS rows in each
+    """
+    return max(1, min(workers, num_rows // MIN_SHARD_ROWS))
+
+
+def shard_bounds(num_rows, num_shards):
+    """
+    :return: num_shards + 1 row offsets splitting num_rows into contiguous shards of (nearly) equal size
+    """
+    return np.linspace(0, num_rows, num_shards + 1).astype(np.int64)
+
+
+def partial_gradient(task):
+    """
+    Sum of the gradient over one shard of a batch (see optimize.batch_gradient)
+    :param task: (features handle, labels handle, weights, rows) where rows is a sorted index array,
+                 or a slice for a full pass
+    :return: gradient vector of length 201 (not divided by the number of rows)
+    """
+    features_handle, labels_handle, w, rows = task
+    return optimize.batch_gradient(w, attach_array(features_handle), attach_array(labels_handle), rows)
+
+
+def fit_parallel(features, labels, w_vector, workers, batch_size=None, epochs=20, learning_rate=0.01,
+                 step_size_function=None, seed=None, likelihood_function=None):
+    """
+    Gradient ascent on the conditional log likelihood, with the gradient of every step spread over worker processes.
+    Each batch is split into contiguous shards of at least MIN_SHARD_ROWS rows, one per worker at most; the partial
+    gradients are added up in shard order, so a run is reproducible for a given seed and number of workers.
+    Every step costs a round trip to the workers, so this only pays off with large steps: full-batch (the default)
+    or batches of many times MIN_SHARD_ROWS rows. Steps too small to split are computed in this process, which
+    is no faster than fit_vectorized; use that for small mini-batches.
+    :param batch_size: rows per step, or None to take one step per epoch over every row (full-batch)
+    :param step_size_function: function of the epoch giving its learning rate, or None for a constant learning_rate
+    :param likelihood_function: function of (w, features, labels) used for progress reports
+    :return: w_vector as a list of length 201
+    """
+    rng = np.random.default_rng(seed)
+    w = np.array(w_vector, dtype=np.float64)
+    num_rows = len(labels)
+    iteration = 0
+    if num_rows == 0:
+        return w.tolist()
+
+    full_batch = batch_size is None or batch_size >= num_rows
+    step_rows = num_rows if full_batch else batch_size
+    if step_shards(step_rows, workers) < min(workers, 2):
+        print('Steps of {} rows are too small to split over worker processes (at least {} rows each); '
+              'computing them in this process'.format(step_rows, MIN_SHARD_ROWS))
+
+    features_handle, features_block = share_array(features)
+    labels_handle, labels_block = share_array(labels)
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor, instrument.stage('gradient_iterations'):
+            for epoch in range(epochs):
+                step_size = step_size_function(epoch) if step_size_function else learning_rate
+                for batch in [None] if full_batch else optimize.epoch_batches(num_rows, batch_size, rng):
+                    rows_in_step = len(batch) if batch is not None else num_rows
+                    num_shards = step_shards(rows_in_step, workers)
+                    bounds = shard_bounds(rows_in_step, num_shards)
+                    shards = []
+                    for shard in range(num_shards):
+                        start, stop = int(bounds[shard]), int(bounds[shard + 1])
+                        shards.append(slice(start, stop) if batch is None else batch[start:stop])
+                    if num_shards > 1:
+                        # executor.map returns the partial gradients in shard order
+                        partials = executor.map(partial_gradient, [(features_handle, labels_handle, w, rows)
+                                                                   for rows in shards])
+                    else:
+                        # a single shard is not worth the round trip to a worker
+                        partials = [optimize.batch_gradient(w, features, labels, shards[0])]
+                    gradient = np.zeros(len(w))
+                    for partial in partials:
+                        gradient += partial
+                    w += step_size * gradient / (num_rows if batch is None else len(batch))
+                    iteration += 1
+                    if likelihood_function and instrument.should_log(iteration):
+                        instrument.report_progress('gradient', iteration, epoch=epoch,
+                                                   likelihood=likelihood_function(w, features, labels))
+    finally:
+        for block in (features_block, labels_block):
+            if block is not None:
+                block.close()
+                block.unlink()
+    return w.tolist()
+
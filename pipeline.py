@@ -0,0 +1,56 @@
+# Pipelined execution of per-protein work: files are read ahead and results written in background threads,
+# so file I/O overlaps with scoring
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Defaults
+PREFETCH = 4
+READERS = 2
+
+
+def run(items, read, process, write, prefetch=0, readers=READERS):
+    """
+    Calls write(item, process(item, read(item))) for every item, in order.
+    With prefetch > 0, up to prefetch items are read ahead by reader threads while the current one is processed,
+    and up to prefetch results wait for a writer thread; both stages block when they are that far ahead,
+    so memory stays bounded. An error in any stage stops the pipeline and is raised here.
+    process always runs in the calling thread, one item after another.
+    :param prefetch: items to read ahead, or 0 to do everything in the calling thread
+    :param readers: number of reader threads
+    """
+    if prefetch <= 0:
+        for item in items:
+            write(item, process(item, read(item)))
+        return
+
+    items = iter(items)
+    reads, writes = deque(), deque()
+    with ThreadPoolExecutor(max_workers=readers) as read_executor, \
+            ThreadPoolExecutor(max_workers=1) as write_executor:
+        try:
+            for item in items:
+                reads.append((item, read_executor.submit(read, item)))
+                if len(reads) >= prefetch:
+                    break
+            while reads:
+                item, future = reads.popleft()
+                data = future.result()
+                # keep the readers prefetch items ahead
+                for next_item in items:
+                    reads.append((next_item, read_executor.submit(read, next_item)))
+                    break
+                result = process(item, data)
+                del data
+                # wait for the writer when it has fallen prefetch results behind
+                while len(writes) >= prefetch:
+                    writes.popleft().result()
+                writes.append(write_executor.submit(write, item, result))
+                del result
+            while writes:
+                writes.popleft().result()
+        except BaseException:
+            for item, future in reads:
+                future.cancel()
+            for future in writes:
+                future.cancel()
+            raise
@@ -0,0 +1,439 @@
+# Vectorized contact scoring for the linear model
+import numpy as np
+import utils
+
+# Smallest sequence separation (j - i) that gets scored
+MIN_SEPARATION = 5
+
+# Named sequence separation bands: (smallest, largest) j - i, where None means no upper limit
+BANDS = {'all': (MIN_SEPARATION, None), 'short': (6, 11), 'medium': (12, 23), 'long': (24, None)}
+
+# Bands that precision is reported for
+REPORT_BANDS = ['short', 'medium', 'long']
+
+# Pairs scored at a time by iter_scored_pairs
+PAIR_CHUNK = 1 << 20
+
+# Bits of the fixed-point weights used by the quantized scoring path
+WEIGHT_BITS = 16
+
+# Pair feature rows built at a time by pair_feature_blocks
+FEATURE_BLOCK_ROWS = 16384
+
+
+def residue_scores(model, windows):
+    """
+    Splits the linear model into per-residue terms. The pair feature is window(i) followed by window(j),
+    so the logit of a pair is w0 + a[i] + b[j].
+    :param windows: L x 100 array from utils.window_matrix
+    :return: (a, b) arrays of length L
+    """
+    weights = np.asarray(model, dtype=np.float64)
+    windows = windows.astype(np.float64)
+    return windows @ weights[1:101], windows @ weights[101:201]
+
+
+def sigmoid(logits):
+    """
+    Numerically stable n / (1 + n) with n = exp(logits)
+    """
+    n = np.exp(-np.abs(logits))
+    return np.where(logits >= 0, 1 / (1 + n), n / (1 + n))
+
+
+def probability_matrix(model, pssm, windows=None):
+    """
+    :param pssm: L x 20 array from utils.read_pssm_array
+    :param windows: window features of the pssm if already built (e.g. by cache.load_pssm)
+    :return: L x L array where [i, j] is the probability that residues i and j are in contact
+    """
+    if windows is None:
+        windows = utils.window_matrix(pssm)
+    a, b = residue_scores(model, windows)
+    return sigmoid(model[0] + a[:, np.newaxis] + b[np.newaxis, :])
+
+
+def parse_band(band):
+    """
+    :param band: a name from BANDS, 'MIN-MAX', 'MIN-' (no upper limit), a (min, max) tuple, or None for 'all'
+    :return: (min_separation, max_separation) where max_separation may be None
+    """
+    if band is None:
+        return BANDS['all']
+    if isinstance(band, str) and band in BANDS:
+        return BANDS[band]
+    min_separation, max_separation = -1, None
+    if isinstance(band, tuple) and len(band) == 2:
+        min_separation, max_separation = band
+    elif isinstance(band, str):
+        low, dash, high = band.partition('-')
+        try:
+            min_separation, max_separation = int(low), int(high) if high else None
+        except ValueError:
+            pass
+    # an inverted band would otherwise reach band_chunks as a negative number of pairs per row
+    if min_separation < 0 or (max_separation is not None and max_separation < min_separation):
+        raise Exception('Unknown separation band: {} (use one of {} or MIN-MAX)'.format(band, ', '.join(BANDS)))
+    return min_separation, max_separation
+
+
+def in_band(i, j, min_separation=MIN_SEPARATION, max_separation=None):
+    """
+    :return: boolean array, True for the pairs whose separation j - i is in the band
+    """
+    separation = np.asarray(j) - np.asarray(i)
+    keep = separation >= min_separation
+    if max_separation is not None:
+        keep &= separation <= max_separation
+    return keep
+
+
+def band_chunks(length, min_separation=MIN_SEPARATION, max_separation=None, chunk_size=PAIR_CHUNK):
+    """
+    Generates the pairs with min_separation <= j - i <= max_separation in row-major order, a block of rows
+    at a time, so at most about chunk_size pairs (or one row) exist at once
+    :return: iterator of (i, j) index arrays
+    """
+    i = 0
+    while i < length - min_separation:
+        # every row i has at most this many pairs, fewer near the end of the sequence
+        row_width = length - i - min_separation
+        if max_separation is not None:
+            row_width = min(row_width, max_separation - min_separation + 1)
+        rows = max(1, chunk_size // max(row_width, 1))
+        stop = min(i + rows, length - min_separation)
+        starts = np.arange(i, stop) + min_separation
+        ends = np.full(stop - i, length) if max_separation is None \
+            else np.minimum(np.arange(i, stop) + max_separation + 1, length)
+        counts = ends - starts
+        row_i = np.repeat(np.arange(i, stop), counts)
+        # j counts up from each row's start: position in the chunk minus the offset of its row
+        offsets = np.repeat(np.cumsum(counts) - counts, counts)
+        row_j = np.repeat(starts, counts) + np.arange(len(row_i)) - offsets
+        yield row_i, row_j
+        i = stop
+
+
+def pair_indices(length, min_separation=MIN_SEPARATION, max_separation=None):
+    """
+    :return: (i, j) index arrays of every pair with min_separation <= j - i <= max_separation, in row-major order
+    """
+    if max_separation is None:
+        return np.triu_indices(length, k=min_separation)
+    chunks = list(band_chunks(length, min_separation, max_separation))
+    if not chunks:
+        return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+    return np.concatenate([i for i, j in chunks]), np.concatenate([j for i, j in chunks])
+
+
+def count_pairs(length, min_separation=MIN_SEPARATION, max_separation=None):
+    """
+    :return: number of pairs with min_separation <= j - i <= max_separation
+    """
+    rows = max(length - min_separation, 0)
+    total = rows * (rows + 1) // 2
+    if max_separation is not None:
+        # take away the pairs past the upper limit
+        total -= count_pairs(length, max_separation + 1)
+    return total
+
+
+def pairs_from_index(index, length, min_separation=MIN_SEPARATION):
+    """
+    Maps positions in the row-major list of pairs (see pair_indices) back to (i, j) without building the list
+    :return: (i, j) arrays
+    """
+    index = np.asarray(index, dtype=np.int64)
+    rows = length - min_separation
+    # Row i starts at position i * rows - i * (i - 1) / 2; invert that with the quadratic formula
+    b = 2 * rows + 1
+    i = np.floor((b - np.sqrt(np.maximum(b * b - 8 * index, 0))) / 2).astype(np.int64)
+    start = i * rows - i * (i - 1) // 2
+    # Correct any floating point rounding at the row boundaries
+    i = np.where(start > index, i - 1, i)
+    start = i * rows - i * (i - 1) // 2
+    i = np.where(index >= start + rows - i, i + 1, i)
+    start = i * rows - i * (i - 1) // 2
+    return i, index - start + i + min_separation
+
+
+def sample_non_contacts(contact_map, length, count, rng, min_separation=MIN_SEPARATION):
+    """
+    Draws count distinct pairs with j >= i + min_separation that are not contacts, by rejection sampling
+    positions in the pair list against the contact bitmap. Takes O(count) time and memory, unless count is
+    more than half of the non-contact pairs, in which case those are listed and shuffled instead.
+    :param contact_map: utils.ContactMap
+    :param rng: numpy Generator
+    :return: (i, j) arrays of the sampled pairs, in the order they were drawn
+    """
+    total = count_pairs(length, min_separation)
+    in_range = (contact_map.j - contact_map.i >= min_separation) & (contact_map.i >= 0) & (contact_map.j < length)
+    available = total - int(np.count_nonzero(in_range))
+    if count > available:
+        raise ValueError('Sample larger than the {} non-contact pairs'.format(available))
+    if count == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    if 2 * count > available:
+        i_all, j_all = pair_indices(length, min_separation)
+        keep = np.flatnonzero(~contact_map.contains(i_all, j_all))
+        chosen = rng.permutation(keep)[:count]
+        return i_all[chosen].astype(np.int64), j_all[chosen].astype(np.int64)
+
+    drawn = np.zeros(0, dtype=np.int64)
+    while len(drawn) < count:
+        # Draw a few extra to cover rejected and repeated positions
+        candidates = rng.integers(0, total, size=2 * (count - len(drawn)) + 16)
+        i, j = pairs_from_index(candidates, length, min_separation)
+        candidates = candidates[~contact_map.contains(i, j)]
+        drawn = np.concatenate([drawn, candidates])
+        # Drop repeats, keeping the first draw of each
+        unique, first = np.unique(drawn, return_index=True)
+        drawn = drawn[np.sort(first)]
+    return pairs_from_index(drawn[:count], length, min_separation)
+
+
+def score_pairs(model, pssm, min_separation=MIN_SEPARATION, windows=None, max_separation=None):
+    """
+    Scores every pair of a protein in O(L) dot products plus one addition per pair.
+    Only pairs with min_separation <= j - i <= max_separation are scored.
+    Every pair is returned at once; use iter_scored_pairs to go through them chunk by chunk.
+    :return: (i, j, probability) arrays in the same order as build_test_matrix
+    """
+    return join_chunks(iter_scored_pairs(model, pssm, min_separation, max_separation, windows))
+
+
+def join_chunks(chunks):
+    """
+    :param chunks: iterable of (i, j, probability) arrays
+    :return: (i, j, probability) arrays of all the chunks together
+    """
+    chunks = list(chunks)
+    if not chunks:
+        return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp), np.zeros(0)
+    if len(chunks) == 1:
+        return chunks[0]
+    return tuple(np.concatenate(arrays) for arrays in zip(*chunks))
+
+
+def scored_chunks(model, pssm, min_separation=MIN_SEPARATION, max_separation=None, windows=None, quantize=False,
+                  blocked=False):
+    """
+    Scores the pairs of a band chunk by chunk: from the per-residue terms of the model (see iter_scored_pairs),
+    with integer arithmetic (quantize, see iter_scored_pairs_quantized) or from blocks of full pair features
+    (blocked, see score_feature_blocks)
+    :return: iterator of (i, j, probability) arrays, in the same order as score_pairs
+    """
+    if quantize and blocked:
+        raise Exception('Quantized scoring works on per-residue terms, not on blocks of pair features; '
+                        'choose one')
+    if windows is None:
+        windows = utils.window_matrix(pssm)
+    if quantize:
+        return iter_scored_pairs_quantized(model, pssm, min_separation, max_separation, windows)
+    if blocked:
+        return score_feature_blocks(model, pair_feature_blocks(windows, min_separation, max_separation))
+    return iter_scored_pairs(model, pssm, min_separation, max_separation, windows)
+
+
+def iter_scored_pairs(model, pssm, min_separation=MIN_SEPARATION, max_separation=None, windows=None,
+                      chunk_size=PAIR_CHUNK):
+    """
+    Scores the pairs of a band chunk by chunk (see band_chunks), without building the L x L matrix
+    :return: iterator of (i, j, probability) arrays
+    """
+    if windows is None:
+        windows = utils.window_matrix(pssm)
+    a, b = residue_scores(model, windows)
+    return iter_term_pairs(float(np.asarray(model, dtype=np.float64)[0]), a, b, min_separation, max_separation,
+                           chunk_size)
+
+
+def iter_term_pairs(bias, a, b, min_separation=MIN_SEPARATION, max_separation=None, chunk_size=PAIR_CHUNK):
+    """
+    Same as iter_scored_pairs, from per-residue terms already computed with residue_scores
+    :return: iterator of (i, j, probability) arrays
+    """
+    for i, j in band_chunks(len(a), min_separation, max_separation, chunk_size):
+        yield i, j, sigmoid(bias + a[i] + b[j])
+
+
+def pair_feature_blocks(windows, min_separation=MIN_SEPARATION, max_separation=None,
+                        block_rows=FEATURE_BLOCK_ROWS):
+    """
+    Generates the full 200-value feature rows of the pairs in a band (window(i) followed by window(j)),
+    in the order of build_test_matrix, at most block_rows pairs at a time
+    :param windows: L x 100 array from utils.window_matrix, built once per protein
+    :return: iterator of (i, j, block_rows x 200 feature array)
+    """
+    for i, j in band_chunks(len(windows), min_separation, max_separation, block_rows):
+        # band_chunks keeps whole rows together, so split any chunk longer than a block
+        for start in range(0, len(i), block_rows):
+            block_i, block_j = i[start:start + block_rows], j[start:start + block_rows]
+            yield block_i, block_j, np.hstack([windows[block_i], windows[block_j]])
+
+
+def score_feature_blocks(model, blocks):
+    """
+    Scores pair feature blocks with the full linear model, sigmoid(w0 + x . w[1:]), without relying on it
+    splitting into per-residue terms
+    :param blocks: iterator of (i, j, features), e.g. from pair_feature_blocks
+    :return: iterator of (i, j, probability) arrays
+    """
+    weights = np.asarray(model, dtype=np.float64)
+    for i, j, features in blocks:
+        yield i, j, sigmoid(weights[0] + features.astype(np.float64) @ weights[1:])
+
+
+def score_pairs_blocked(model, pssm, min_separation=MIN_SEPARATION, windows=None, max_separation=None,
+                        block_rows=FEATURE_BLOCK_ROWS):
+    """
+    Same as score_pairs, scoring block by block from the pair features, so at most block_rows feature
+    rows exist at once
+    :return: (i, j, probability) arrays in the same order as score_pairs
+    """
+    if windows is None:
+        windows = utils.window_matrix(pssm)
+    blocks = score_feature_blocks(model, pair_feature_blocks(windows, min_separation, max_separation, block_rows))
+    return select_top_blocks(blocks, None, ranked=False)
+
+
+def select_top_blocks(blocks, k=None, ranked=True):
+    """
+    Consumes scored blocks one at a time (see TopPairs). With k, only the k most probable pairs seen so far
+    are kept between blocks, so memory depends on k and the block size rather than on the number of pairs.
+    With k=None every pair has to be kept to be sorted.
+    :param blocks: iterator of (i, j, probability) arrays
+    :param ranked: sort the result as select_top does; with ranked=False and k=None the pairs are
+                   returned in block order
+    :return: (i, j, probability) arrays
+    """
+    top = TopPairs(k)
+    for i, j, p in blocks:
+        top.add(i, j, p)
+    return top.result(ranked)
+
+
+def quantize_model(model, bits=WEIGHT_BITS):
+    """
+    Fixed-point version of the window weights: w[1:] is scaled so its largest magnitude fills a signed
+    bits-bit integer, and rounded
+    :return: (integer weights of length 200, scale, float bias w0); w[1:] is about weights / scale
+    """
+    weights = np.asarray(model, dtype=np.float64)
+    largest = np.abs(weights[1:]).max()
+    scale = (2 ** (bits - 1) - 1) / largest if largest > 0 else 1.0
+    dtype = np.int16 if bits <= 16 else np.int32
+    return np.round(weights[1:] * scale).astype(dtype), scale, float(weights[0])
+
+
+def quantize_windows(windows):
+    """
+    :return: the window features as int8, which holds every PSSM score and the -1 padding
+    """
+    if windows.size and (windows.min() < -128 or windows.max() > 127):
+        raise Exception('PSSM values do not fit in int8; use the float scoring path')
+    return windows.astype(np.int8)
+
+
+def score_pairs_quantized(model, pssm, min_separation=MIN_SEPARATION, windows=None, max_separation=None,
+                          bits=WEIGHT_BITS):
+    """
+    Same as score_pairs with integer arithmetic (see iter_scored_pairs_quantized), every pair at once
+    :return: (i, j, probability) arrays in the same order as score_pairs
+    """
+    return join_chunks(iter_scored_pairs_quantized(model, pssm, min_separation, max_separation, windows, bits))
+
+
+def iter_scored_pairs_quantized(model, pssm, min_separation=MIN_SEPARATION, max_separation=None, windows=None,
+                                bits=WEIGHT_BITS, chunk_size=PAIR_CHUNK):
+    """
+    Same as iter_scored_pairs with integer arithmetic: int8 window features times fixed-point weights are summed in
+    int32 per residue, and the two residue terms of a pair are added as integers before the one conversion
+    back to a float logit. With 16-bit weights the per-residue sums stay below 2^29, so nothing overflows.
+    The windows stay int8; only FEATURE_BLOCK_ROWS of them at a time are widened for the sums.
+    :return: iterator of (i, j, probability) arrays, in the same order as iter_scored_pairs
+    """
+    if windows is None:
+        windows = utils.window_matrix(pssm)
+    quantized, scale, bias = quantize_model(model, bits)
+    features = quantize_windows(windows)
+    weights = quantized.astype(np.int32)
+    a = np.empty(len(features), dtype=np.int32)
+    b = np.empty(len(features), dtype=np.int32)
+    for start in range(0, len(features), FEATURE_BLOCK_ROWS):
+        block = features[start:start + FEATURE_BLOCK_ROWS].astype(np.int32)
+        a[start:start + len(block)] = block @ weights[:100]
+        b[start:start + len(block)] = block @ weights[100:]
+    for i, j in band_chunks(len(features), min_separation, max_separation, chunk_size):
+        yield i, j, sigmoid(bias + (a[i] + b[j]) / scale)
+
+
+def top_k_count(top_k, length):
+    """
+    Turns a top-K setting into a number of pairs for a protein of the given length
+    :param top_k: None or 'all' for every pair, 'L/n' for a fraction of the length, or an absolute count
+    :return: number of pairs to keep, or None to keep them all
+    """
+    if top_k is None or top_k == 'all':
+        return None
+    try:
+        if isinstance(top_k, str) and top_k.upper().startswith('L/'):
+            divisor = float(top_k[2:])
+            if divisor > 0:
+                return int(length / divisor)
+        elif int(top_k) >= 0:
+            return int(top_k)
+    except (TypeError, ValueError):
+        pass
+    raise Exception("Unknown top-K setting: {} (use 'all', L/n with n > 0, or a count)".format(top_k))
+
+
+def select_top(i, j, probabilities, k=None):
+    """
+    Ranks pairs by descending probability. When k is given, only the k most probable pairs are
+    partitioned out and sorted, so the cost is O(n + k log k) instead of a sort of every pair.
+    Ties at the cut-off keep the earliest pairs, so the result is always the start of a stable sort of every pair.
+    :return: (i, j, probability) arrays sorted in descending order of probability
+    """
+    if k is None or k >= len(probabilities):
+        order = np.argsort(-probabilities, kind='stable')
+    elif k <= 0:
+        order = np.arange(0)
+    else:
+        # the k-th largest probability; pairs above it are kept, and the first of those equal to it
+        threshold = -np.partition(-probabilities, k - 1)[k - 1]
+        above = np.flatnonzero(probabilities > threshold)
+        ties = np.flatnonzero(probabilities == threshold)[:k - len(above)]
+        keep = np.sort(np.concatenate([above, ties]))
+        order = keep[np.argsort(-probabilities[keep], kind='stable')]
+    return i[order], j[order], probabilities[order]
+
+
+class TopPairs:
+    """
+    Keeps the k most probable of the scored pairs added to it, a chunk at a time, so memory depends on k and
+    the chunk size rather than on the number of pairs. With k=None every pair is kept.
+    The result is the same as select_top of every pair added, in the order they were added.
+    """
+
+    def __init__(self, k=None):
+        self.k = k
+        self.chunks = []
+
+    def add(self, i, j, probabilities):
+        self.chunks.append((i, j, probabilities))
+        if self.k is not None and len(self.chunks) > 1:
+            # kept pairs go first, so ties keep their original order as in a stable sort of every pair
+            self.chunks = [select_top(*join_chunks(self.chunks), self.k)]
+
+    def result(self, ranked=True):
+        """
+        :param ranked: sort by descending probability; with ranked=False and k=None the pairs are returned
+                       in the order they were added
+        :return: (i, j, probability) arrays
+        """
+        i, j, probabilities = join_chunks(self.chunks)
+        if ranked or self.k is not None:
+            return select_top(i, j, probabilities, self.k)
+        return i, j, probabilities
@@ -0,0 +1,290 @@
+# Long-lived scoring server: keeps the model loaded and answers contact predictions over localhost HTTP
+# or a Unix socket, batching requests that arrive together
+import os
+import io
+import json
+import time
+import queue
+import signal
+import argparse
+import threading
+import socketserver
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import utils
+import scoring
+
+# Defaults
+PORT = 8765
+MAX_BATCH = 32
+BATCH_WAIT = 0.005
+LATENCY_WINDOW = 1000
+
+
+def main():
+    args = parse_args()
+    scorer = Scorer(os.path.abspath(args.model), args.max_batch, args.batch_wait)
+    if args.socket:
+        server = UnixHTTPServer(args.socket, RequestHandler)
+        where = args.socket
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), RequestHandler)
+        where = 'http://{}:{}'.format(args.host, args.port)
+    server.scorer = scorer
+    # 'path' requests may only read files under this directory
+    server.data_dir = os.path.realpath(args.data_dir) if args.data_dir else None
+    # stop the same way on SIGTERM as on Ctrl-C, so the socket file is removed
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    print('Scoring server listening on ' + where, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        scorer.stop()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+class UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    """
+    HTTP over a Unix socket, e.g. for curl --unix-socket
+    """
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        socketserver.ThreadingUnixStreamServer.server_bind(self)
+
+
+class Scorer:
+    """
+    Scores proteins on one thread. Requests that arrive within batch_wait seconds of each other are scored
+    together, with the per-residue terms of the whole batch computed in one matrix product.
+    """
+
+    def __init__(self, model_path, max_batch=MAX_BATCH, batch_wait=BATCH_WAIT):
+        self.model_path = model_path
+        self.max_batch = max_batch
+        self.batch_wait = batch_wait
+        # load once now, so a bad model file fails at startup rather than on the first request
+        self.model = utils.load_model(model_path, None)
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.counters = {'requests': 0, 'errors': 0, 'batches': 0, 'proteins': 0, 'pairs': 0}
+        self.latencies = []
+        self.started = time.time()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, windows, top_k=None, band=None):
+        """
+        :return: Future of the (i, j, probability) arrays of the protein, most probable first
+        """
+        future = Future()
+        self.requests.put((windows, top_k, band, future))
+        return future
+
+    def stop(self):
+        self.requests.put(None)
+        self.thread.join()
+
+    def run(self):
+        while True:
+            batch = [self.requests.get()]
+            # collect whatever else arrives shortly after the first request
+            deadline = time.perf_counter() + self.batch_wait
+            while batch[-1] is not None and len(batch) < self.max_batch:
+                try:
+                    batch.append(self.requests.get(timeout=max(0.0, deadline - time.perf_counter())))
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                batch.pop()
+                self.score_batch(batch)
+                return
+            self.score_batch(batch)
+
+    def score_batch(self, batch):
+        if not batch:
+            return
+        try:
+            # picks up a new model when the file changes
+            self.model = utils.load_model(self.model_path, None)
+            weights = np.asarray(self.model, dtype=np.float64)
+            windows = np.vstack([item[0] for item in batch]).astype(np.float64)
+            a_all, b_all = windows @ weights[1:101], windows @ weights[101:201]
+        except Exception as error:
+            for item in batch:
+                item[3].set_exception(error)
+            return
+
+        start = 0
+        pairs = 0
+        for windows, top_k, band, future in batch:
+            a, b = a_all[start:start + len(windows)], b_all[start:start + len(windows)]
+            start += len(windows)
+            try:
+                min_separation, max_separation = scoring.parse_band(band)
+                top = scoring.TopPairs(scoring.top_k_count(top_k, len(windows)))
+                # with a top K, only the pairs kept so far outlive a chunk
+                for i, j, p in scoring.iter_term_pairs(weights[0], a, b, min_separation, max_separation):
+                    top.add(i, j, p)
+                    pairs += len(p)
+                future.set_result(top.result())
+            except Exception as error:
+                future.set_exception(error)
+        with self.lock:
+            self.counters['batches'] += 1
+            self.counters['proteins'] += len(batch)
+            self.counters['pairs'] += pairs
+
+    def record(self, seconds, failed=False):
+        """
+        Counts a finished request and its latency
+        """
+        with self.lock:
+            self.counters['requests'] += 1
+            if failed:
+                self.counters['errors'] += 1
+            self.latencies.append(seconds)
+            if len(self.latencies) > LATENCY_WINDOW:
+                del self.latencies[:len(self.latencies) - LATENCY_WINDOW]
+
+    def stats(self):
+        """
+        :return: request/batch counters, throughput since startup and latency percentiles of recent requests
+        """
+        with self.lock:
+            stats = dict(self.counters)
+            latencies = np.array(self.latencies)
+        uptime = time.time() - self.started
+        stats.update({'uptime_seconds': uptime, 'requests_per_second': stats['requests'] / uptime if uptime else 0.0,
+                      'mean_batch_size': stats['proteins'] / stats['batches'] if stats['batches'] else 0.0,
+                      'model': self.model_path, 'queued': self.requests.qsize()})
+        if len(latencies):
+            stats['latency_seconds'] = {'mean': float(latencies.mean()), 'p50': float(np.percentile(latencies, 50)),
+                                        'p95': float(np.percentile(latencies, 95)),
+                                        'p99': float(np.percentile(latencies, 99)), 'max': float(latencies.max())}
+        return stats
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /score with a JSON body:
+        {"pssm": contents of a .pssm file} or {"path": path of a .pssm file inside the server's --data-dir},
+        optional "top_k" ('L/2', 'L/5', a count, 'all'), "band" (see scoring.parse_band),
+        "format" ('json' (default) or 'rr'), "name"
+    Invalid requests get a 400 response, failures of the server itself a 500.
+    GET /stats for the counters, GET /health to check the server is up
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self.send(200, json.dumps(self.server.scorer.stats()))
+        elif self.path == '/health':
+            self.send(200, json.dumps({'status': 'ok'}))
+        else:
+            self.send(404, json.dumps({'error': 'not found'}))
+
+    def do_POST(self):
+        if self.path != '/score':
+            self.send(404, json.dumps({'error': 'not found'}))
+            return
+        start = time.perf_counter()
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            pssm, residues = self.read_request(body)
+        except Exception as error:
+            status, content_type, response = 400, 'application/json', json.dumps({'error': str(error)})
+        else:
+            # the request is valid, so anything failing from here on is an error of the server
+            try:
+                status, content_type, response = 200, *self.score(body, pssm, residues)
+            except Exception as error:
+                status, content_type, response = 500, 'application/json', json.dumps({'error': str(error)})
+        self.send(status, response, content_type)
+        self.server.scorer.record(time.perf_counter() - start, status != 200)
+
+    def read_request(self, body):
+        """
+        Reads the PSSM of a request and checks its options
+        :return: (pssm matrix, array of the residue letters)
+        """
+        if 'pssm' in body:
+            pssm, residues = utils.parse_pssm_array(io.StringIO(body['pssm']))
+        elif 'path' in body:
+            pssm, residues = utils.read_pssm_array(self.data_path(body['path']))
+        else:
+            raise Exception("Send the PSSM as 'pssm' (file contents) or 'path'")
+        scoring.parse_band(body.get('band'))
+        scoring.top_k_count(body.get('top_k'), len(pssm))
+        if body.get('format', 'json') not in ('json', 'rr'):
+            raise Exception("Unknown format: {} (use 'json' or 'rr')".format(body['format']))
+        return pssm, residues
+
+    def data_path(self, path):
+        """
+        :return: the real path of a requested file, which has to be inside the server's data directory
+        """
+        data_dir = self.server.data_dir
+        if data_dir is None:
+            raise Exception("Reading files by 'path' is disabled; start the server with --data-dir")
+        file_path = os.path.realpath(os.path.join(data_dir, path))
+        if os.path.commonpath([file_path, data_dir]) != data_dir:
+            raise Exception('Path is outside the data directory: {}'.format(path))
+        return file_path
+
+    def score(self, body, pssm, residues):
+        """
+        :return: (content type, response text)
+        """
+        sequence = ''.join(residues.tolist())
+        future = self.server.scorer.submit(utils.window_matrix(pssm), body.get('top_k'), body.get('band'))
+        i, j, p = future.result()
+
+        if body.get('format', 'json') == 'rr':
+            return 'text/plain', ''.join(utils.rr_blocks(i, j, p, sequence))
+        # 1-based residue numbers, as in .rr files
+        contacts = [[a, b, c] for a, b, c in zip((i + 1).tolist(), (j + 1).tolist(), p.tolist())]
+        return 'application/json', json.dumps({'name': body.get('name'), 'L': len(pssm), 'sequence': sequence,
+                                               'contacts': contacts})
+
+    def send(self, status, text, content_type='application/json'):
+        data = text.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        # the counters at /stats replace per-request logging
+        pass
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Serve contact predictions from a model kept in memory.')
+    parser.add_argument('--model', default=os.path.join(utils.parent_directory, utils.MODEL_FILE), help='model file')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: localhost only)')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--socket', default=None, help='listen on this Unix socket instead of TCP')
+    parser.add_argument('--data-dir', default=None,
+                        help="directory that requests may read .pssm files from by 'path' (default: none, "
+                             "only PSSM contents are accepted)")
+    parser.add_argument('--max-batch', type=int, default=MAX_BATCH, help='most proteins scored together')
+    parser.add_argument('--batch-wait', type=float, default=BATCH_WAIT,
+                        help='seconds to wait for more requests to batch with the first one')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,19 @@
 # functions used to create the model
 import utils
+import scoring
+import cache
+import instrument
+import pipeline
 import os
 from random import sample
 import sys
 from math import exp
+import json
+import csv
+import numpy as np
 
 empty_row = [-1] * 20
-acids_list = ['A', 'C', 'E', 'D', 'G', 'I', 'H', 'K', 'F', 'M', 'L', 'N', 'Q', 'P', 'S', 'R', 'T', 'W', 'V', 'Y']
+acids_list = utils.acids_list
 
 # Get the parent directory of this code
 this_script = os.path.abspath(__file__)
@@ -15,118 +22,225 @@ parent_directory = os.path.dirname(this_script)
 # Set the directory for testing output
 rr_output_directory = parent_directory + "/testing-rr-output"
 
-def main(pssm_files, pssm_dir, rr_dir):
-    test(pssm_files, pssm_dir, rr_dir)
-    accuracy(rr_dir)
+# Precision is reported for the top L/10, L/5 and L/2 predictions
+PRECISION_CUTOFFS = [('L10', 10), ('L5', 5), ('L2', 2)]
 
-def test(pssm_files, pssm_dir, rr_dir):
+def main(pssm_files, pssm_dir, rr_dir, top_k=None, model=None, write_rr=True, report_file=None, compress=False,
+         prefetch=0, band=None, quantize=False, blocked=False, quantize_delta=False):
+    results = test(pssm_files, pssm_dir, rr_dir, top_k, model, write_rr, compress, prefetch, band, quantize, blocked,
+                   quantize_delta)
+    report = summarize(results)
+    print_report(report)
+    if report_file:
+        write_report(report, report_file)
+    return report
+
+def test(pssm_files, pssm_dir, rr_dir, top_k=None, model=None, write_rr=True, compress=False, prefetch=0, band=None,
+         quantize=False, blocked=False, quantize_delta=False):
     """
     Test the model. Generate contact probabilities and save them in .rr format sorted in descending order.
+    :param top_k: only write the top K pairs of each protein ('L/2', 'L/5', a count), or None for all of them
+    :param model: utils.Model to score with, or None to load the default model file
+    :param write_rr: whether to write the .rr files at all
+    :param compress: write gzip-compressed .rr.gz files
+    :param prefetch: proteins to read ahead in background threads while scoring (see pipeline.run), 0 for none
+    :param band: sequence separation band to score (see scoring.parse_band), None for every pair
+    :param quantize: score with integer arithmetic (see scoring.iter_scored_pairs_quantized)
+    :param blocked: score from blocks of full pair features (see scoring.score_feature_blocks)
+    :param quantize_delta: with quantize, also score on the float path to record its precision and the largest
+                           probability difference, to measure the accuracy lost. This scores every pair twice.
+    :return: list of per-protein precision results (see evaluate)
     """
-    model = utils.read_model()
-    rr_rows = []
+    if quantize_delta and not quantize:
+        raise Exception('The quantization delta can only be measured when testing with quantize')
+    if model is None:
+        model = utils.load_model()
+    min_separation, max_separation = scoring.parse_band(band)
 
     # create directory for .rr files created by testing
-    try:
-        os.mkdir(rr_output_directory)
-    except FileExistsError:
-        print("Removing old .rr files...")
-        old_rr_files = utils.read_directory_contents(rr_output_directory, '.rr')
-        for old_rr_file in old_rr_files:
-            os.remove(os.path.join(rr_output_directory, old_rr_file))
+    if write_rr:
+        try:
+            os.mkdir(rr_output_directory)
+        except FileExistsError:
+            print("Removing old .rr files...")
+            old_rr_files = utils.read_directory_contents(rr_output_directory, ('.rr', '.rr.gz'))
+            for old_rr_file in old_rr_files:
+                os.remove(os.path.join(rr_output_directory, old_rr_file))
 
     # test
     print("Testing...")
-    for pssm_file in pssm_files:
-        # get the feature values of every pair
-        test_matrix = build_test_matrix(pssm_file, pssm_dir)
-        # get the sequence associated with this pssm
-        sequence = utils.read_rr(pssm_file.replace('.pssm', '.rr'), rr_dir)['sequence']
-        for pair in range(len(test_matrix)):
-            contact_probability = calculate_contact_probability(model, test_matrix[pair])
-            # create row
-            i, j = list(test_matrix[pair].keys())[0][0], list(test_matrix[pair].keys())[0][1]
-            rr_row = [i, j, 0, 8, contact_probability]
-            # rr_rows.append(" ".join([str(x) for x in rr_row]))
-            rr_rows.append(rr_row)
-
-        # sort rows
-        rr_rows.sort(key = lambda row: row[4], reverse = True)
-
-        # write to file
-        file_name = os.path.join(rr_output_directory, pssm_file.replace('.pssm', '.rr'))
-        with open(file_name, 'w') as file:
-            file.write(sequence + "\n")
-            # stringify all rows and put in file
-            for row in rr_rows:
-                file.write(" ".join([str(x) for x in row]) + "\n")
-
-def accuracy(rr_dir):
-    """
-    Determine the average accuracy of the L/10, L/5, and L/2 most probable contact predictions.
-    """
-    # metrics
-    l10_acc, l5_acc, l2_acc = 0.0, 0.0, 0.0
-
-    # get the .rr files created in testing (predictions)
-    rr_outputs = utils.read_directory_contents(rr_output_directory, '.rr')
-
-    # determine the accuracy of each individual .rr file
-    num_files = 0
-    for rr_output in rr_outputs:
-        num_files += 1
-        # create a list of the predictions
-        predictions = utils.read_rr(rr_output, rr_output_directory)
-        predictions_list = listify_rr(predictions)
-        predictions_list.sort(key = lambda row: row[2], reverse = True)
-        # create a list of the actual contact pairs
-        contact_pairs = utils.read_rr(rr_output, rr_dir)
-        contact_pairs_list = listify_rr(contact_pairs)
-
-        # metrics
-        l10_denom, l10_num, l5_denom, l5_num, l2_denom, l2_num = 0, 0, 0, 0, 0, 0
-
-        L = len(contact_pairs['sequence'])
-        for i in range(int(L / 2)):
-            # make prediction
-            predicted_contact = predictions_list[i][2] > 0.5
-            actual_contact = (predictions_list[i][0], predictions_list[i][1]) in contact_pairs
-
-            # update metrics
-            if i <= L / 10 and actual_contact:
-                l10_denom += 1
-                if predicted_contact:
-                    l10_num += 1
-            if i <= L / 5 and actual_contact:
-                l5_denom += 1
-                if predicted_contact:
-                    l5_num += 1
-            if actual_contact:
-                l2_denom += 1
-                if predicted_contact:
-                    l2_num += 1
-
-        # aggregate
-        if l10_denom != 0:
-            l10_acc += l10_num / l10_denom
-        if l5_denom != 0:
-            l5_acc += l5_num / l5_denom
-        if l2_denom != 0:
-            l2_acc += l2_num / l2_denom
-
-    # average
-    l10_acc /= num_files
-    l5_acc /= num_files
-    l2_acc /= num_files
-    print("Accuracy")
-    print("--------")
-    print("L10: " + str(l10_acc))
-    print("L5: " + str(l5_acc))
-    print("L2: " + str(l2_acc))
-
-def listify_rr(rr):
-    pair_keys = [key for key in rr.keys() if key != 'sequence']
-    return [[pair[0], pair[1], rr[pair]] for pair in pair_keys]
+    results = []
+
+    def read(pssm_file):
+        pssm, residues, windows = cache.load_pssm(pssm_file, pssm_dir)
+        contact_map = cache.load_rr(pssm_file.replace('.pssm', '.rr'), rr_dir)
+        return pssm, windows, contact_map
+
+    def process(pssm_file, data):
+        pssm, windows, contact_map = data
+        # the rows to write: only the top K are kept between chunks when asked to
+        output = scoring.TopPairs(scoring.top_k_count(top_k, len(pssm))) if write_rr else None
+        # score the pairs chunk by chunk and evaluate them against the actual contacts as they come
+        with instrument.stage('score', pssm_file):
+            chunks = scoring.scored_chunks(model, pssm, min_separation, max_separation, windows, quantize, blocked)
+            # the float path yields its chunks in the same order, so the two are compared chunk by chunk
+            reference = scoring.iter_scored_pairs(model, pssm, min_separation, max_separation, windows) \
+                if quantize_delta else None
+            result = {'protein': pssm_file.replace('.pssm', '')}
+            result.update(evaluate(chunks, contact_map, (min_separation, max_separation), output, reference))
+        results.append(result)
+        if not write_rr:
+            return None
+
+        with instrument.stage('sort', pssm_file):
+            i_list, j_list, probabilities = output.result()
+        return i_list, j_list, probabilities, contact_map.sequence
+
+    def write(pssm_file, rows):
+        if rows is None:
+            return
+        with instrument.stage('write', pssm_file):
+            file_name = os.path.join(rr_output_directory, pssm_file.replace('.pssm', '.rr'))
+            utils.write_rr(file_name, *rows, compress=compress)
+
+    pipeline.run(pssm_files, read, process, write, prefetch)
+    return results
+
+def protein_precision(i_list, j_list, probabilities, contact_map, prefix=''):
+    """
+    Precision of the L/10, L/5 and L/2 most probable pairs of one protein, where L is the sequence length
+    :param i_list, j_list, probabilities: scored pairs, e.g. from scoring.score_pairs
+    :param contact_map: utils.ContactMap with the actual contacts
+    :param prefix: prepended to the name of each cutoff
+    :return: dictionary with L and the precision for each cutoff
+    """
+    L = len(contact_map.sequence)
+    top_i, top_j, top_p = scoring.select_top(i_list, j_list, probabilities, int(L / 2))
+    correct = np.cumsum(contact_map.contains(top_i, top_j))
+
+    result = {'L': L}
+    for name, divisor in PRECISION_CUTOFFS:
+        k = min(int(L / divisor), len(correct))
+        result[prefix + name] = float(correct[k - 1]) / k if k > 0 else 0.0
+    return result
+
+def evaluate(chunks, contact_map, scored_band=None, output=None, reference=None):
+    """
+    Precision of one protein from its scored pairs, taken chunk by chunk: only the L/2 most probable pairs
+    overall and in each band of scored_bands are kept between chunks, so memory does not grow with L^2
+    :param chunks: iterator of (i, j, probability) arrays, e.g. from scoring.iter_scored_pairs
+    :param contact_map: utils.ContactMap with the actual contacts
+    :param scored_band: the band the pairs were scored in (see scoring.parse_band)
+    :param output: scoring.TopPairs to also add every chunk to, e.g. to keep the pairs to write
+    :param reference: iterator of chunks of the same pairs scored another way, e.g. on the float path when
+                      chunks are quantized, to compare against
+    :return: dictionary with L and the precision for each cutoff (see protein_precision), and e.g. 'long_L5' for
+             the precision of the L/5 most probable long range pairs. Bands not in scored_bands are None.
+             With reference, also its precision ('float_L10', ...) and the largest probability difference.
+    """
+    L = len(contact_map.sequence)
+    overall = scoring.TopPairs(int(L / 2))
+    bands = {band: scoring.TopPairs(int(L / 2)) for band in scored_bands(scored_band)}
+    reference_top = scoring.TopPairs(int(L / 2))
+    max_error = 0.0
+    for i_list, j_list, probabilities in chunks:
+        overall.add(i_list, j_list, probabilities)
+        for band, top in bands.items():
+            keep = scoring.in_band(i_list, j_list, *scoring.BANDS[band])
+            top.add(i_list[keep], j_list[keep], probabilities[keep])
+        if output is not None:
+            output.add(i_list, j_list, probabilities)
+        if reference is not None:
+            reference_i, reference_j, reference_probabilities = next(reference)
+            reference_top.add(reference_i, reference_j, reference_probabilities)
+            if len(probabilities):
+                max_error = max(max_error, float(np.abs(reference_probabilities - probabilities).max()))
+
+    result = protein_precision(*overall.result(), contact_map)
+    for band in scoring.REPORT_BANDS:
+        if band in bands:
+            precision = protein_precision(*bands[band].result(), contact_map, band + '_')
+            del precision['L']
+            result.update(precision)
+        else:
+            result.update({band + '_' + name: None for name, divisor in PRECISION_CUTOFFS})
+    if reference is not None:
+        precision = protein_precision(*reference_top.result(), contact_map, 'float_')
+        del precision['L']
+        result.update(precision)
+        result['max_probability_error'] = max_error
+    return result
+
+def scored_bands(scored_band=None):
+    """
+    :return: the bands of scoring.REPORT_BANDS that lie entirely inside the scored band. A band that was only
+             partly scored (e.g. 'short' when scoring 10-30) is left out, as its precision would not be
+             comparable with that of the whole band.
+    """
+    scored_min, scored_max = scoring.parse_band(scored_band)
+    bands = []
+    for band in scoring.REPORT_BANDS:
+        min_separation, max_separation = scoring.BANDS[band]
+        if min_separation >= scored_min and \
+                (scored_max is None or (max_separation is not None and max_separation <= scored_max)):
+            bands.append(band)
+    return bands
+
+def precision_columns():
+    """
+    :return: names of the precision values in each result, overall first and then by band
+    """
+    names = [name for name, divisor in PRECISION_CUTOFFS]
+    return names + [band + '_' + name for band in scoring.REPORT_BANDS for name in names]
+
+def summarize(results):
+    """
+    :return: the per-protein results together with the mean precision over all proteins
+    (for a band, over the proteins it was scored for)
+    """
+    aggregate = {'proteins': len(results)}
+    for name in precision_columns():
+        values = [result[name] for result in results if result.get(name) is not None]
+        aggregate[name] = float(np.mean(values)) if values else (0.0 if name in dict(PRECISION_CUTOFFS) else None)
+    if results and 'max_probability_error' in results[0]:
+        for name, divisor in PRECISION_CUTOFFS:
+            aggregate['float_' + name] = float(np.mean([result['float_' + name] for result in results]))
+            aggregate['quantized_delta_' + name] = aggregate[name] - aggregate['float_' + name]
+        aggregate['max_probability_error'] = max(result['max_probability_error'] for result in results)
+    return {'proteins': results, 'aggregate': aggregate}
+
+def print_report(report):
+    print("Precision")
+    print("---------")
+    for name, divisor in PRECISION_CUTOFFS:
+        print(name + ": " + str(report['aggregate'][name]))
+    for band in scoring.REPORT_BANDS:
+        values = [report['aggregate'][band + '_' + name] for name, divisor in PRECISION_CUTOFFS]
+        if values[0] is not None:
+            print(band + ": " + ", ".join(name + " " + str(value) for (name, divisor), value
+                                           in zip(PRECISION_CUTOFFS, values)))
+    if 'max_probability_error' in report['aggregate']:
+        print("Quantized - float: " + ", ".join(name + " " + str(report['aggregate']['quantized_delta_' + name])
+                                                for name, divisor in PRECISION_CUTOFFS) +
+              ", max probability error " + str(report['aggregate']['max_probability_error']))
+
+def write_report(report, file_name):
+    """
+    Write a precision report: one row per protein plus a 'mean' row for .csv files, JSON otherwise
+    """
+    columns = ['protein', 'L'] + precision_columns()
+    if 'max_probability_error' in report['aggregate']:
+        columns += ['float_' + name for name, divisor in PRECISION_CUTOFFS] + ['max_probability_error']
+    with open(file_name, 'w', newline='') as file:
+        if not file_name.endswith('.csv'):
+            json.dump(report, file, indent=2)
+            return
+        writer = csv.DictWriter(file, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(report['proteins'])
+        mean_row = {'protein': 'mean', 'L': ''}
+        mean_row.update({name: report['aggregate'][name] for name in columns[2:]})
+        writer.writerow(mean_row)
 
 def calculate_contact_probability(model, pair):
     """
@@ -140,7 +254,7 @@ def build_test_matrix(pssm_file, pssm_dir):
     """
     :return: a list of dictionaries with key = (i, j) and value = a list of feature values
     """
-    pssm = utils.read_pssm(pssm_file, pssm_dir)
+    pssm, residues = utils.read_pssm_array(pssm_file, pssm_dir)
     test_matrix = []
     for i in range(len(pssm)):
         for j in range(i + 5, len(pssm)):
@@ -162,7 +276,7 @@ def get_five(pssm, i):
         elif i + row_offset >= len(pssm):
             values.extend(empty_row)
         else:
-            values.extend([pssm[i + row_offset][k] for k in acids_list])
+            values.extend(pssm[i + row_offset].tolist())
     return values
 
 if __name__ == "__main()__":
@@ -0,0 +1,32 @@
+# The modules live in the repository root rather than in a package
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import benchmark
+import cache
+
+
+@pytest.fixture(autouse=True)
+def feature_cache(tmp_path):
+    """
+    Points the feature cache at a temporary directory, so tests never write into the repository
+    :return: the cache directory
+    """
+    settings = cache.settings()
+    cache.configure(str(tmp_path / 'feature-cache'))
+    yield cache.cache_directory
+    cache.configure(**settings)
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    """
+    Synthetic .pssm and .rr files (see benchmark.generate_corpus), two proteins each of three lengths
+    :return: (pssm directory, rr directory, sorted list of .pssm file names)
+    """
+    pssm_dir, rr_dir, files = benchmark.generate_corpus(str(tmp_path / 'data'), [30, 45, 60], proteins=2, seed=0)
+    return pssm_dir, rr_dir, sorted(name for names in files.values() for name in names)
@@ -0,0 +1,69 @@
+import os
+import threading
+
+import numpy as np
+
+import cache
+import utils
+
+
+def entry_sizes(directory):
+    """
+    :return: dictionary of entry key -> size in bytes of the entries in a cache directory
+    """
+    return {key: sum(os.path.getsize(os.path.join(directory, key, name))
+                     for name in os.listdir(os.path.join(directory, key)))
+            for key in os.listdir(directory) if not key.startswith('.')}
+
+
+def test_cached_entries_match_the_parsed_files(corpus, feature_cache):
+    pssm_dir, rr_dir, pssm_files = corpus
+    for pssm_file in pssm_files:
+        rr_file = pssm_file.replace('.pssm', '.rr')
+        # the first load parses and writes the entry, the second reads it back
+        for _ in range(2):
+            pssm, residues, windows = cache.load_pssm(pssm_file, pssm_dir)
+            contact_map = cache.load_rr(rr_file, rr_dir)
+            expected_pssm, expected_residues = utils.read_pssm_array(pssm_file, pssm_dir)
+            assert np.array_equal(pssm, expected_pssm) and np.array_equal(residues, expected_residues)
+            assert np.array_equal(windows, utils.window_matrix(expected_pssm))
+            expected_map = utils.read_contact_map(rr_file, rr_dir)
+            assert contact_map.sequence == expected_map.sequence
+            assert contact_map.pairs() == expected_map.pairs()
+            assert np.array_equal(contact_map.bitmap, expected_map.bitmap)
+    assert len(entry_sizes(feature_cache)) == 2 * len(pssm_files)
+
+
+def test_eviction_keeps_the_cache_under_the_cap_least_recently_used_first(feature_cache):
+    cache.write_entry('first', {'values': np.zeros(1000, dtype=np.int8)})
+    os.utime(os.path.join(feature_cache, 'first'), (0, 0))
+    entry_size = entry_sizes(feature_cache)['first']
+    cache.configure(max_bytes=5 * entry_size)
+    for number in range(1, 10):
+        if number == 4:
+            # reading an entry marks it as recently used
+            assert cache.read_entry('entry-1', ['values']) is not None
+        cache.write_entry('entry-{}'.format(number), {'values': np.zeros(1000, dtype=np.int8)})
+        os.utime(os.path.join(feature_cache, 'entry-{}'.format(number)), (number, number))
+        sizes = entry_sizes(feature_cache)
+        assert sum(sizes.values()) <= 5 * entry_size
+        assert cache.cache_bytes == sum(sizes.values())
+    assert 'entry-9' in sizes and 'entry-1' in sizes
+    assert 'first' not in sizes and 'entry-2' not in sizes
+
+
+def test_concurrent_writes_keep_the_running_total(feature_cache):
+    cache.write_entry('first', {'values': np.zeros(1000, dtype=np.int8)})
+    cache.configure(max_bytes=40 * entry_sizes(feature_cache)['first'])
+
+    def write(thread):
+        for number in range(25):
+            cache.write_entry('entry-{}-{}'.format(thread, number), {'values': np.zeros(1000, dtype=np.int8)})
+
+    threads = [threading.Thread(target=write, args=(thread,)) for thread in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    sizes = entry_sizes(feature_cache)
+    assert cache.cache_bytes == sum(sizes.values()) <= cache.max_cache_bytes
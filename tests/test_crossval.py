@@ -0,0 +1,53 @@
+import os
+import tempfile
+
+import numpy as np
+import pytest
+
+import crossval
+import feature_store
+
+
+def run(corpus, **settings):
+    pssm_dir, rr_dir, pssm_files = corpus
+    return crossval.cross_validate(pssm_files, pssm_dir, rr_dir, folds=3, seed=2, batch_size=64, epochs=1,
+                                   **settings)
+
+
+def test_folds_hold_out_every_protein_once(corpus):
+    pssm_dir, rr_dir, pssm_files = corpus
+    report = run(corpus)
+    held_out = [result['protein'] + '.pssm' for fold in report['folds'] for result in fold['proteins']]
+    assert sorted(held_out) == pssm_files
+    assert [fold['fold'] for fold in report['folds']] == [0, 1, 2]
+    assert set(report['aggregate']) == {'mean', 'std'}
+
+
+def test_store_is_reused_and_training_rows_exclude_the_held_out_fold(corpus, tmp_path, capsys):
+    store_dir = str(tmp_path / 'store')
+    first = run(corpus, store_dir=store_dir)
+    features, labels = feature_store.open_store(store_dir)
+    assert sum(fold['training_rows'] for fold in first['folds']) == 2 * len(labels)
+    assert 'Reusing' not in capsys.readouterr().out
+
+    second = run(corpus, store_dir=store_dir)
+    assert 'Reusing the feature store' in capsys.readouterr().out
+    assert second == first
+
+
+def test_temporary_store_is_removed(corpus, tmp_path, monkeypatch):
+    temp_root = tmp_path / 'temp'
+    temp_root.mkdir()
+    monkeypatch.setattr(tempfile, 'tempdir', str(temp_root))
+    run(corpus)
+    assert os.listdir(temp_root) == []
+
+    with pytest.raises(Exception):
+        run(corpus, band='30-10')
+    assert os.listdir(temp_root) == []
+
+
+def test_too_few_proteins_for_the_folds(corpus):
+    pssm_dir, rr_dir, pssm_files = corpus
+    with pytest.raises(Exception, match='Cannot split'):
+        crossval.cross_validate(pssm_files[:2], pssm_dir, rr_dir, folds=3)
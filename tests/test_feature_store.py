@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+import feature_store
+
+
+def random_chunks(count, seed=0):
+    rng = np.random.default_rng(seed)
+    return [(rng.integers(-10, 11, (rows, 200)), rng.integers(0, 2, rows)) for rows in rng.integers(0, 40, count)]
+
+
+def test_store_matches_the_chunks(tmp_path, monkeypatch):
+    # a small flush size, so the rows are written in several pieces
+    monkeypatch.setattr(feature_store, 'CHUNK_ROWS', 50)
+    chunks = random_chunks(12)
+    features, labels = feature_store.write_store(str(tmp_path), iter(chunks), 'int8')
+    assert features.dtype == np.int8 and isinstance(features, np.memmap)
+    assert np.array_equal(features, np.concatenate([chunk_features for chunk_features, chunk_labels in chunks]))
+    assert np.array_equal(labels, np.concatenate([chunk_labels for chunk_features, chunk_labels in chunks]))
+    reopened_features, reopened_labels = feature_store.open_store(str(tmp_path))
+    assert np.array_equal(reopened_features, features) and np.array_equal(reopened_labels, labels)
+
+
+def test_empty_store(tmp_path):
+    features, labels = feature_store.write_store(str(tmp_path), iter([]))
+    assert features.shape == (0, 200) and labels.shape == (0,)
+
+
+def test_values_that_do_not_fit_the_dtype_are_rejected(tmp_path):
+    features = np.full((3, 200), 300)
+    with pytest.raises(Exception, match='do not fit'):
+        feature_store.write_store(str(tmp_path / 'int8'), iter([(features, np.ones(3))]), 'int8')
+    stored, labels = feature_store.write_store(str(tmp_path / 'int16'), iter([(features, np.ones(3))]), 'int16')
+    assert np.array_equal(stored, features)
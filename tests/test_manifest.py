@@ -0,0 +1,111 @@
+import hashlib
+import json
+import os
+import shutil
+
+import pytest
+
+import manifest
+
+
+@pytest.fixture
+def reads(monkeypatch):
+    """
+    Records the files manifest.file_entry reads
+    :return: list of file names, in the order they were read
+    """
+    names = []
+    file_entry = manifest.file_entry
+
+    def recording_file_entry(file_path, kind, stat):
+        names.append(os.path.basename(file_path))
+        return file_entry(file_path, kind, stat)
+
+    monkeypatch.setattr(manifest, 'file_entry', recording_file_entry)
+    return names
+
+
+def test_manifest_records_every_file(corpus, tmp_path, reads):
+    pssm_dir, rr_dir, pssm_files = corpus
+    os.remove(os.path.join(rr_dir, pssm_files[0].replace('.pssm', '.rr')))
+    dataset = manifest.load(pssm_dir, rr_dir, str(tmp_path / 'manifest.json'))
+    assert len(reads) == 2 * len(pssm_files) - 1
+    with open(tmp_path / 'manifest.json') as file:
+        assert json.load(file) == dataset
+
+    assert manifest.pssm_files(dataset, paired=False) == pssm_files
+    assert manifest.pssm_files(dataset) == pssm_files[1:]
+    assert manifest.unpaired(dataset) == [pssm_files[0]]
+    for name in pssm_files:
+        with open(os.path.join(pssm_dir, name), 'rb') as file:
+            expected_hash = hashlib.sha256(file.read()).hexdigest()
+        entry = dataset['proteins'][name[:-len('.pssm')]]['pssm']
+        assert entry['sha256'] == expected_hash
+        assert entry['length'] == int(name.split('-')[1])
+    assert manifest.longest_first(pssm_files, dataset)[:2] == sorted(pssm_files)[-2:]
+
+
+def test_refresh_only_reads_changed_files(corpus, tmp_path, reads):
+    pssm_dir, rr_dir, pssm_files = corpus
+    manifest_file = str(tmp_path / 'manifest.json')
+    first = manifest.load(pssm_dir, rr_dir, manifest_file)
+    del reads[:]
+
+    assert manifest.load(pssm_dir, rr_dir, manifest_file) == first
+    assert reads == []
+
+    # a protein of another length copied over the first one, a new protein, and a removed one
+    changed, longer, removed = pssm_files[0], pssm_files[-1], pssm_files[1]
+    shutil.copyfile(os.path.join(pssm_dir, longer), os.path.join(pssm_dir, changed))
+    shutil.copyfile(os.path.join(pssm_dir, longer), os.path.join(pssm_dir, 'added.pssm'))
+    os.remove(os.path.join(pssm_dir, removed))
+    second = manifest.load(pssm_dir, rr_dir, manifest_file)
+    assert sorted(reads) == ['added.pssm', changed]
+
+    new_entry, old_entry = (dataset['proteins'][changed[:-len('.pssm')]]['pssm'] for dataset in (second, first))
+    longer_entry = first['proteins'][longer[:-len('.pssm')]]['pssm']
+    assert new_entry['sha256'] == longer_entry['sha256'] != old_entry['sha256']
+    assert new_entry['length'] == longer_entry['length'] != old_entry['length']
+    assert manifest.unpaired(second) == ['added.pssm', removed.replace('.pssm', '.rr')]
+    assert manifest.hashes(second, [changed]) == [[longer_entry['sha256'],
+                                                   first['proteins'][changed[:-len('.pssm')]]['rr']['sha256']]]
+
+
+def test_same_size_edit_is_read_again(corpus, tmp_path, reads):
+    # the contents change but the size does not, so only the mtime and ctime give the edit away
+    pssm_dir, rr_dir, pssm_files = corpus
+    manifest_file = str(tmp_path / 'manifest.json')
+    first = manifest.load(pssm_dir, None, manifest_file)
+    del reads[:]
+    pssm_path = os.path.join(pssm_dir, pssm_files[0])
+    with open(pssm_path) as file:
+        contents = file.read()
+    edited = contents.replace(' 1 ', ' 2 ', 1) if ' 1 ' in contents else contents.replace(' 2 ', ' 1 ', 1)
+    assert edited != contents and len(edited) == len(contents)
+    with open(pssm_path, 'w') as file:
+        file.write(edited)
+
+    second = manifest.load(pssm_dir, None, manifest_file)
+    assert reads == [pssm_files[0]]
+    protein = pssm_files[0][:-len('.pssm')]
+    assert second['proteins'][protein]['pssm']['sha256'] != first['proteins'][protein]['pssm']['sha256']
+
+
+def test_manifest_of_an_older_version_is_rebuilt(corpus, tmp_path, reads):
+    pssm_dir, rr_dir, pssm_files = corpus
+    manifest_file = str(tmp_path / 'manifest.json')
+    dataset = manifest.load(pssm_dir, rr_dir, manifest_file)
+    dataset['version'] = manifest.MANIFEST_VERSION - 1
+    with open(manifest_file, 'w') as file:
+        json.dump(dataset, file)
+    del reads[:]
+    manifest.load(pssm_dir, rr_dir, manifest_file)
+    assert len(reads) == 2 * len(pssm_files)
+
+
+def test_invalid_file_is_reported(corpus, tmp_path):
+    pssm_dir, rr_dir, pssm_files = corpus
+    with open(os.path.join(pssm_dir, 'broken.pssm'), 'w') as file:
+        file.write('not a pssm\n')
+    with pytest.raises(Exception, match='Not a valid .pssm file'):
+        manifest.load(pssm_dir, rr_dir, str(tmp_path / 'manifest.json'))
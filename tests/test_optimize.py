@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+import feature_store
+import optimize
+import train
+
+
+def logistic_rows(count, seed=0):
+    """
+    :return: (features, labels) with labels drawn from a logistic model of the features, so the likelihood
+             has a finite maximum
+    """
+    rng = np.random.default_rng(seed)
+    features = rng.integers(-3, 4, (count, 200)).astype(np.int8)
+    true_w = rng.normal(0, 0.1, 201)
+    probability = 1 / (1 + np.exp(-(true_w[0] + features @ true_w[1:])))
+    return features, (rng.random(count) < probability).astype(np.int8)
+
+
+def test_chunked_likelihood_matches_the_per_row_likelihood(monkeypatch):
+    # small blocks, so the sums run over several of them
+    monkeypatch.setattr(feature_store, 'CHUNK_ROWS', 16)
+    features, labels = logistic_rows(100)
+    w = np.random.default_rng(1).normal(0, 0.05, 201)
+    rows = np.arange(3, 100, 3)
+    matrix = [dict(enumerate(row), **{'class': label}) for row, label in zip(features.tolist(), labels.tolist())]
+    expected = train.calc_max_conditional_likelihood(w.tolist(), [matrix[row] for row in rows])
+    assert np.isclose(optimize.chunked_likelihood(w, features, labels, rows), expected, rtol=1e-12)
+
+    likelihood, gradient = optimize.chunked_likelihood(w, features, labels, with_gradient=True)
+    assert np.isclose(likelihood, train.calc_max_conditional_likelihood(w.tolist(), matrix), rtol=1e-12)
+    assert np.allclose(gradient, optimize.batch_gradient(w, features, labels, slice(0, 100)), rtol=1e-12)
+    error = labels - 1 / (1 + np.exp(-(w[0] + features @ w[1:])))
+    assert np.allclose(gradient, np.concatenate([[error.sum()], features.T @ error]), rtol=1e-10)
+
+
+def test_epoch_batches_cover_every_row_once():
+    batches = optimize.epoch_batches(103, 25, np.random.default_rng(0))
+    assert [len(batch) for batch in batches] == [25, 25, 25, 25, 3]
+    assert all(np.all(np.diff(batch) > 0) for batch in batches)
+    assert np.array_equal(np.sort(np.concatenate(batches)), np.arange(103))
+
+
+def test_lbfgs_converges_to_the_maximum():
+    features, labels = logistic_rows(2000)
+    w_vector, info = optimize.lbfgs(features, labels, [0.0] * 201, relative_tolerance=0)
+    assert info['stopped'] == 'gradient_norm'
+    likelihood, gradient = optimize.likelihood_and_gradient(np.array(w_vector), features, labels)
+    assert np.linalg.norm(gradient) <= optimize.GRADIENT_TOLERANCE
+    assert info['likelihood'] == likelihood
+
+    # Adam gets close to the same maximum
+    adam_w, adam_info = optimize.adam(features, labels, [0.0] * 201, batch_size=200, max_iterations=100, seed=0)
+    assert adam_info['likelihood'] <= likelihood
+    assert adam_info['likelihood'] > likelihood - 0.01
+
+
+@pytest.mark.parametrize('fit', [optimize.lbfgs, optimize.adam])
+def test_stops_at_max_iterations(fit):
+    features, labels = logistic_rows(500)
+    w_vector, info = fit(features, labels, [0.0] * 201, max_iterations=3, gradient_tolerance=0, relative_tolerance=0)
+    assert info['stopped'] == 'max_iterations' and info['iterations'] == 3
+
+
+@pytest.mark.parametrize('fit', [optimize.lbfgs, optimize.adam])
+def test_early_stopping_keeps_the_best_held_out_weights(fit):
+    # flipped labels: every step that fits the training rows makes the held-out likelihood worse
+    features, labels = logistic_rows(500)
+    validation = (features[:200], 1 - labels[:200])
+    w_vector, info = fit(features, labels, [0.0] * 201, validation=validation, patience=2, gradient_tolerance=0,
+                         relative_tolerance=0)
+    assert info['stopped'] == 'early_stopping' and info['iterations'] == 3
+    assert np.isclose(optimize.likelihood_and_gradient(np.array(w_vector), *validation)[0],
+                      info['held_out_likelihood'])
+    assert info['likelihood'] == optimize.likelihood_and_gradient(np.array(w_vector), features, labels)[0]
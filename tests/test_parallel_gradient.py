@@ -0,0 +1,57 @@
+import sys
+
+import numpy as np
+import pytest
+
+import parallel_gradient
+import train
+
+
+def random_rows(count, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.integers(-10, 11, (count, 200)).astype(np.int8), rng.integers(0, 2, count).astype(np.int8)
+
+
+@pytest.mark.parametrize('batch_size', [None, 300])
+def test_fit_parallel_matches_fit_vectorized(monkeypatch, batch_size):
+    # small shards, so two workers really split every step
+    monkeypatch.setattr(parallel_gradient, 'MIN_SHARD_ROWS', 100)
+    features, labels = random_rows(1000)
+    expected = train.fit_vectorized(features, labels, [0.0] * 201, batch_size or len(labels), 3, 0.01, seed=4)
+    actual = parallel_gradient.fit_parallel(features, labels, [0.0] * 201, 2, batch_size, 3, 0.01, seed=4)
+    assert np.allclose(actual, expected, rtol=1e-10, atol=1e-12)
+
+
+def test_fit_parallel_from_a_feature_store(tmp_path, monkeypatch):
+    monkeypatch.setattr(parallel_gradient, 'MIN_SHARD_ROWS', 100)
+    features, labels = random_rows(700)
+    stored_features, stored_labels = train.feature_store.write_store(str(tmp_path), iter([(features, labels)]))
+    expected = train.fit_vectorized(features, labels, [0.0] * 201, len(labels), 2)
+    actual = parallel_gradient.fit_parallel(stored_features, stored_labels, [0.0] * 201, 3, None, 2)
+    assert np.allclose(actual, expected, rtol=1e-10, atol=1e-12)
+
+
+def test_steps_are_split_into_shards_of_at_least_min_shard_rows():
+    assert parallel_gradient.step_shards(parallel_gradient.MIN_SHARD_ROWS - 1, 8) == 1
+    assert parallel_gradient.step_shards(3 * parallel_gradient.MIN_SHARD_ROWS, 8) == 3
+    assert parallel_gradient.step_shards(100 * parallel_gradient.MIN_SHARD_ROWS, 8) == 8
+
+
+def test_small_steps_are_computed_in_this_process(capsys):
+    features, labels = random_rows(500)
+    expected = train.fit_vectorized(features, labels, [0.0] * 201, 50, 2, seed=1)
+    actual = parallel_gradient.fit_parallel(features, labels, [0.0] * 201, 2, 50, 2, seed=1)
+    assert np.allclose(actual, expected, rtol=1e-10, atol=1e-12)
+    assert 'too small to split' in capsys.readouterr().out
+
+
+def test_parallel_trainer_defaults_to_full_batch_and_rejects_small_batches(corpus, monkeypatch):
+    pssm_dir, rr_dir, pssm_files = corpus
+    monkeypatch.setattr(sys, 'argv', ['train.py', pssm_dir, rr_dir, '--trainer', 'parallel', '--fit-workers', '2'])
+    assert train.parse_args()[4].batch_size is None
+    monkeypatch.setattr(sys, 'argv', ['train.py', pssm_dir, rr_dir])
+    assert train.parse_args()[4].batch_size == train.BATCH_SIZE
+    monkeypatch.setattr(sys, 'argv', ['train.py', pssm_dir, rr_dir, '--trainer', 'parallel', '--fit-workers', '2',
+                                      '--batch-size', '256'])
+    with pytest.raises(SystemExit):
+        train.parse_args()
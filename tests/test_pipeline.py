@@ -0,0 +1,65 @@
+import threading
+import time
+
+import pytest
+
+import pipeline
+
+
+@pytest.mark.parametrize('prefetch', [0, 1, 3])
+def test_results_are_written_in_order(prefetch):
+    written = []
+    pipeline.run(range(20), lambda item: item * 2, lambda item, data: data + 1,
+                 lambda item, result: written.append((item, result)), prefetch)
+    assert written == [(item, item * 2 + 1) for item in range(20)]
+
+
+@pytest.mark.parametrize('prefetch', [1, 2, 4])
+def test_readers_and_writer_stay_at_most_prefetch_items_ahead(prefetch):
+    lock = threading.Lock()
+    counts = {'read': 0, 'processed': 0, 'written': 0}
+    ahead = []
+
+    def read(item):
+        with lock:
+            counts['read'] += 1
+        return item
+
+    def process(item, data):
+        with lock:
+            # reads started for later items, and results not yet written, when this item is processed
+            ahead.append((counts['read'] - counts['processed'] - 1, counts['processed'] - counts['written']))
+            counts['processed'] += 1
+        return data
+
+    def write(item, result):
+        # a slow writer, so results pile up unless process waits for it
+        time.sleep(0.002)
+        with lock:
+            counts['written'] += 1
+
+    pipeline.run(range(30), read, process, write, prefetch)
+    assert counts == {'read': 30, 'processed': 30, 'written': 30}
+    assert max(reads for reads, writes in ahead) <= prefetch
+    assert max(writes for reads, writes in ahead) <= prefetch
+
+
+@pytest.mark.parametrize('stage', ['read', 'process', 'write'])
+@pytest.mark.parametrize('prefetch', [0, 2])
+def test_an_error_in_any_stage_stops_the_pipeline(stage, prefetch):
+    processed = []
+
+    def fail_on(name):
+        def step(item, *args):
+            if name == stage and item == 5:
+                raise ValueError('failed on ' + name)
+            return args[-1] if args else item
+        return step
+
+    def process(item, data):
+        processed.append(item)
+        return fail_on('process')(item, data)
+
+    with pytest.raises(ValueError, match='failed on ' + stage):
+        pipeline.run(range(100), fail_on('read'), process, fail_on('write'), prefetch)
+    assert max(processed) < 5 + 2 * prefetch + 2
@@ -0,0 +1,156 @@
+import numpy as np
+import pytest
+
+import scoring
+import test
+import utils
+
+
+def random_protein(length, seed=0):
+    """
+    :return: (model weights, L x 20 pssm array) with values in the range of real PSSM scores
+    """
+    rng = np.random.default_rng(seed)
+    return rng.normal(0, 0.05, 201), rng.integers(-10, 11, (length, 20))
+
+
+def random_contact_map(length, count, seed=0):
+    rng = np.random.default_rng(seed)
+    i, j = scoring.pairs_from_index(rng.choice(scoring.count_pairs(length), count, replace=False), length)
+    return utils.ContactMap('A' * length, i, j, np.full(count, 5.0))
+
+
+@pytest.mark.parametrize('length', [0, 5, 6, 7, 50, 301])
+@pytest.mark.parametrize('min_separation', [1, 5, 24])
+def test_pairs_from_index_matches_triu_indices(length, min_separation):
+    expected_i, expected_j = np.triu_indices(length, k=min_separation)
+    i, j = scoring.pairs_from_index(np.arange(len(expected_i)), length, min_separation)
+    assert np.array_equal(i, expected_i)
+    assert np.array_equal(j, expected_j)
+
+
+@pytest.mark.parametrize('length', [0, 5, 13, 40, 97])
+@pytest.mark.parametrize('band', ['all', 'short', 'medium', 'long', (5, 5), (3, 200)])
+def test_band_chunks_and_count_pairs_match_pair_indices(length, band):
+    min_separation, max_separation = scoring.parse_band(band)
+    all_i, all_j = np.triu_indices(length, k=min_separation)
+    keep = scoring.in_band(all_i, all_j, min_separation, max_separation)
+    chunks = list(scoring.band_chunks(length, min_separation, max_separation, chunk_size=7))
+    i = np.concatenate([chunk_i for chunk_i, chunk_j in chunks]) if chunks else np.zeros(0, dtype=int)
+    j = np.concatenate([chunk_j for chunk_i, chunk_j in chunks]) if chunks else np.zeros(0, dtype=int)
+    assert np.array_equal(i, all_i[keep]) and np.array_equal(j, all_j[keep])
+    assert scoring.count_pairs(length, min_separation, max_separation) == np.count_nonzero(keep)
+    band_i, band_j = scoring.pair_indices(length, min_separation, max_separation)
+    assert np.array_equal(band_i, all_i[keep]) and np.array_equal(band_j, all_j[keep])
+
+
+@pytest.mark.parametrize('band, expected', [('10-30', (10, 30)), ('24-', (24, None)), ('0-0', (0, 0)),
+                                            ((6, 11), (6, 11)), (None, scoring.BANDS['all'])])
+def test_parse_band(band, expected):
+    assert scoring.parse_band(band) == expected
+
+
+@pytest.mark.parametrize('band', ['30-10', '-5-10', '-1', 'middle', '', (12, 6), (-1, None), [6, 11], 6])
+def test_parse_band_rejects_bad_bands(band):
+    with pytest.raises(Exception, match='Unknown separation band'):
+        scoring.parse_band(band)
+
+
+@pytest.mark.parametrize('top_k, expected', [(None, None), ('all', None), ('L/5', 20), ('l/2', 50), ('L/0.5', 200),
+                                             (7, 7), ('0', 0)])
+def test_top_k_count(top_k, expected):
+    assert scoring.top_k_count(top_k, 100) == expected
+
+
+@pytest.mark.parametrize('top_k', ['L/0', 'L/-2', 'L/', 'L/x', -3, 'many', [5]])
+def test_top_k_count_rejects_bad_settings(top_k):
+    with pytest.raises(Exception, match='Unknown top-K setting'):
+        scoring.top_k_count(top_k, 100)
+
+
+@pytest.mark.parametrize('count', [0, 10, 900])
+def test_sample_non_contacts(count):
+    # 900 is more than half of the non-contact pairs, so it takes the listing path instead of rejection sampling
+    length = 60
+    contact_map = random_contact_map(length, 100)
+    i, j = scoring.sample_non_contacts(contact_map, length, count, np.random.default_rng(1))
+    assert len(i) == count
+    assert np.all(j - i >= scoring.MIN_SEPARATION) and np.all(j < length)
+    assert not contact_map.contains(i, j).any()
+    assert len(set(zip(i.tolist(), j.tolist()))) == count
+
+
+def test_sample_non_contacts_rejects_too_many():
+    length = 20
+    contact_map = random_contact_map(length, 10)
+    with pytest.raises(ValueError):
+        scoring.sample_non_contacts(contact_map, length, scoring.count_pairs(length) - 9, np.random.default_rng(1))
+
+
+def test_score_pairs_matches_the_per_pair_path(corpus):
+    # the original scorer: a feature row per pair from get_five, then the full dot product of each
+    pssm_dir, rr_dir, pssm_files = corpus
+    weights = np.random.default_rng(0).normal(0, 0.05, 201)
+    for pssm_file in pssm_files[:3]:
+        pssm, residues = utils.read_pssm_array(pssm_file, pssm_dir)
+        i, j, probabilities = scoring.score_pairs(weights, pssm)
+        test_matrix = test.build_test_matrix(pssm_file, pssm_dir)
+        assert list(zip(i.tolist(), j.tolist())) == [next(iter(pair)) for pair in test_matrix]
+        assert np.allclose(probabilities, [test.calculate_contact_probability(weights, pair) for pair in test_matrix],
+                           rtol=1e-12, atol=0)
+
+
+@pytest.mark.parametrize('band', ['all', 'short', 'long', (10, 30)])
+def test_scorers_agree(band):
+    # the blocked scorer takes the full dot product of each feature row, without the per-residue terms
+    weights, pssm = random_protein(70)
+    min_separation, max_separation = scoring.parse_band(band)
+    i, j, probabilities = scoring.score_pairs(weights, pssm, min_separation, None, max_separation)
+    assert np.array_equal(i, scoring.pair_indices(70, min_separation, max_separation)[0])
+
+    blocked = scoring.score_pairs_blocked(weights, pssm, min_separation, None, max_separation, block_rows=100)
+    chunks = scoring.join_chunks(scoring.scored_chunks(weights, pssm, min_separation, max_separation, blocked=True))
+    for other_i, other_j, other_probabilities in (blocked, chunks):
+        assert np.array_equal(other_i, i) and np.array_equal(other_j, j)
+        assert np.allclose(other_probabilities, probabilities)
+
+
+def test_quantized_scores_are_close_to_float():
+    weights, pssm = random_protein(80)
+    i, j, probabilities = scoring.score_pairs(weights, pssm)
+    quantized_i, quantized_j, quantized = scoring.score_pairs_quantized(weights, pssm)
+    assert np.array_equal(quantized_i, i) and np.array_equal(quantized_j, j)
+    assert np.abs(quantized - probabilities).max() < 1e-3
+    chunks = scoring.join_chunks(scoring.iter_scored_pairs_quantized(weights, pssm, chunk_size=50))
+    assert np.array_equal(chunks[2], quantized)
+
+
+def test_quantized_and_blocked_scoring_are_exclusive():
+    weights, pssm = random_protein(20)
+    with pytest.raises(Exception):
+        scoring.scored_chunks(weights, pssm, quantize=True, blocked=True)
+
+
+@pytest.mark.parametrize('k', [None, 0, 1, 25, 5000])
+def test_top_pairs_matches_select_top(k):
+    rng = np.random.default_rng(2)
+    # rounded, so there are many ties at the cut-off
+    i, j = np.arange(3000), np.arange(3000) + 5
+    probabilities = np.round(rng.random(3000), 2)
+    expected = scoring.select_top(i, j, probabilities, k)
+    blocks = [(i[start:start + size], j[start:start + size], probabilities[start:start + size])
+              for start, size in zip(range(0, 3000, 700), [700] * 5)]
+    top = scoring.TopPairs(k)
+    for block in blocks:
+        top.add(*block)
+    for result in (top.result(), scoring.select_top_blocks(iter(blocks), k)):
+        for actual, wanted in zip(result, expected):
+            assert np.array_equal(actual, wanted)
+
+
+def test_select_top_is_a_prefix_of_the_stable_sort():
+    probabilities = np.array([0.5, 0.9, 0.5, 0.1, 0.5, 0.9])
+    index = np.arange(6)
+    i, j, top = scoring.select_top(index, index, probabilities, 3)
+    assert i.tolist() == [1, 5, 0]
+    assert top.tolist() == [0.9, 0.9, 0.5]
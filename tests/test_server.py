@@ -0,0 +1,139 @@
+import http.client
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer
+
+import numpy as np
+import pytest
+
+import scoring
+import server
+import utils
+
+
+@pytest.fixture
+def scoring_server(corpus, tmp_path):
+    """
+    A server on a free localhost port, scoring with a random model and reading 'path' requests from the
+    corpus .pssm directory
+    :return: (function sending a request and returning (status, content type, body), the server, model path,
+              pssm_dir)
+    """
+    pssm_dir, rr_dir, pssm_files = corpus
+    model_path = str(tmp_path / 'model.bin')
+    utils.write_model(np.random.default_rng(0).normal(0, 0.05, 201), model_path)
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), server.RequestHandler)
+    httpd.scorer = server.Scorer(model_path, batch_wait=0.001)
+    httpd.data_dir = os.path.realpath(pssm_dir)
+    thread = threading.Thread(target=httpd.serve_forever, kwargs={'poll_interval': 0.01}, daemon=True)
+    thread.start()
+
+    def request(method, path, body=None):
+        connection = http.client.HTTPConnection('127.0.0.1', httpd.server_address[1], timeout=10)
+        data = body if isinstance(body, (bytes, type(None))) else json.dumps(body).encode()
+        connection.request(method, path, data)
+        response = connection.getresponse()
+        result = response.status, response.getheader('Content-Type'), response.read().decode()
+        connection.close()
+        return result
+
+    yield request, httpd, model_path, pssm_dir
+    httpd.shutdown()
+    httpd.server_close()
+    httpd.scorer.stop()
+
+
+def expected_contacts(model_path, pssm_file, pssm_dir, top_k=None, band=None):
+    pssm, residues = utils.read_pssm_array(pssm_file, pssm_dir)
+    min_separation, max_separation = scoring.parse_band(band)
+    i, j, p = scoring.score_pairs(utils.load_model(model_path, None), pssm, min_separation, None, max_separation)
+    return scoring.select_top(i, j, p, scoring.top_k_count(top_k, len(pssm)))
+
+
+@pytest.mark.parametrize('top_k, band', [(None, None), ('L/2', None), (10, 'long'), ('all', '6-20')])
+def test_score_pssm_contents(scoring_server, corpus, top_k, band):
+    request, httpd, model_path, pssm_dir = scoring_server
+    pssm_file = corpus[2][0]
+    with open(os.path.join(pssm_dir, pssm_file)) as file:
+        body = {'pssm': file.read(), 'name': 'p', 'top_k': top_k, 'band': band}
+    status, content_type, text = request('POST', '/score', body)
+    assert status == 200 and content_type == 'application/json'
+    response = json.loads(text)
+    i, j, p = expected_contacts(model_path, pssm_file, pssm_dir, top_k, band)
+    contacts = np.array(response['contacts']).reshape(-1, 3)
+    assert response['name'] == 'p' and response['L'] == len(response['sequence'])
+    assert np.array_equal(contacts[:, 0], i + 1) and np.array_equal(contacts[:, 1], j + 1)
+    assert np.allclose(contacts[:, 2], p)
+
+
+def test_score_by_path_as_rr(scoring_server, corpus):
+    request, httpd, model_path, pssm_dir = scoring_server
+    pssm_file = corpus[2][1]
+    status, content_type, text = request('POST', '/score', {'path': pssm_file, 'format': 'rr', 'top_k': 5})
+    assert status == 200 and content_type == 'text/plain'
+    sequence, *lines = text.splitlines()
+    assert sequence == ''.join(utils.read_pssm_array(pssm_file, pssm_dir)[1].tolist())
+    i, j, p = expected_contacts(model_path, pssm_file, pssm_dir, 5)
+    assert [line.split()[:2] for line in lines] == [[str(a + 1), str(b + 1)] for a, b in zip(i, j)]
+
+
+def test_concurrent_requests_are_answered(scoring_server, corpus):
+    request, httpd, model_path, pssm_dir = scoring_server
+    with ThreadPoolExecutor(max_workers=6) as executor:
+        responses = list(executor.map(lambda pssm_file: request('POST', '/score', {'path': pssm_file, 'top_k': 3}),
+                                      corpus[2]))
+    for pssm_file, (status, content_type, text) in zip(corpus[2], responses):
+        i, j, p = expected_contacts(model_path, pssm_file, pssm_dir, 3)
+        assert status == 200 and np.allclose(np.array(json.loads(text)['contacts'])[:, 2], p)
+
+
+@pytest.mark.parametrize('body, message', [
+    (b'{not json', 'Expecting'),
+    ({}, "Send the PSSM as 'pssm'"),
+    ({'path': 'missing.pssm'}, 'No such file'),
+    ({'band': '30-10'}, 'Unknown separation band'),
+    ({'top_k': 'L/0'}, 'Unknown top-K setting'),
+    ({'format': 'xml'}, 'Unknown format'),
+])
+def test_invalid_requests_get_400(scoring_server, corpus, body, message):
+    request, httpd, model_path, pssm_dir = scoring_server
+    if isinstance(body, dict) and 'path' not in body and body:
+        body = dict(body, path=corpus[2][0])
+    status, content_type, text = request('POST', '/score', body)
+    assert status == 400 and message in json.loads(text)['error']
+
+
+def test_paths_outside_the_data_directory_are_refused(scoring_server, corpus, tmp_path):
+    request, httpd, model_path, pssm_dir = scoring_server
+    outside = tmp_path / 'outside.pssm'
+    with open(os.path.join(pssm_dir, corpus[2][0])) as file:
+        outside.write_text(file.read())
+    os.symlink(str(outside), os.path.join(pssm_dir, 'link.pssm'))
+    for path in [str(outside), '../outside.pssm', '../../outside.pssm', 'link.pssm']:
+        status, content_type, text = request('POST', '/score', {'path': path})
+        assert status == 400 and 'outside the data directory' in json.loads(text)['error']
+
+
+def test_paths_are_refused_without_a_data_directory(scoring_server, corpus):
+    request, httpd, model_path, pssm_dir = scoring_server
+    httpd.data_dir = None
+    status, content_type, text = request('POST', '/score', {'path': corpus[2][0]})
+    assert status == 400 and '--data-dir' in json.loads(text)['error']
+
+
+def test_server_failures_get_500_and_are_counted(scoring_server, corpus):
+    request, httpd, model_path, pssm_dir = scoring_server
+    assert request('POST', '/score', {'path': corpus[2][0]})[0] == 200
+    # the scorer reloads the model for every batch, so a broken model file fails valid requests
+    with open(model_path, 'wb') as file:
+        file.write(b'broken')
+    status, content_type, text = request('POST', '/score', {'path': corpus[2][0]})
+    assert status == 500 and 'error' in json.loads(text)
+
+    assert request('GET', '/health')[:2] == (200, 'application/json')
+    assert request('GET', '/nothing')[0] == 404 and request('POST', '/nothing', {})[0] == 404
+    stats = json.loads(request('GET', '/stats')[2])
+    assert stats['requests'] == 2 and stats['errors'] == 1
+    assert stats['proteins'] == 1 and stats['latency_seconds']['max'] > 0
@@ -0,0 +1,93 @@
+import random
+import sys
+
+import numpy as np
+import pytest
+
+import train
+import utils
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_feature_store_matches_the_feature_arrays(corpus, tmp_path, workers):
+    # each protein samples from a seed of its own, so the rows do not depend on the number of workers
+    pssm_dir, rr_dir, pssm_files = corpus
+    random.seed(3)
+    features, labels = train.build_feature_arrays(pssm_files, pssm_dir, rr_dir)
+    random.seed(3)
+    stored_features, stored_labels = train.build_feature_store(str(tmp_path / 'store'), pssm_files, pssm_dir, rr_dir,
+                                                               workers)
+    assert np.array_equal(stored_features, features) and np.array_equal(stored_labels, labels)
+    assert labels.sum() > 0 and (labels == 0).sum() == labels.sum()
+
+
+def test_featurizing_with_workers_keeps_the_protein_order(corpus):
+    pssm_dir, rr_dir, pssm_files = corpus
+    random.seed(5)
+    serial = list(train.iter_protein_features(pssm_files, pssm_dir, rr_dir))
+    random.seed(5)
+    parallel = list(train.iter_protein_features(pssm_files, pssm_dir, rr_dir, workers=2))
+    assert len(parallel) == len(pssm_files)
+    for (features, labels), (expected_features, expected_labels) in zip(parallel, serial):
+        assert np.array_equal(features, expected_features) and np.array_equal(labels, expected_labels)
+
+
+def run_main(monkeypatch, *argv):
+    """
+    Runs train.main with the given command line arguments, recording the test set instead of testing
+    :return: the test proteins, or None when testing was skipped
+    """
+    tested = []
+    monkeypatch.setattr(train.test, 'main', lambda pssm_test, *args, **kwargs: tested.append(pssm_test))
+    monkeypatch.setattr(train.classify, 'main', lambda *args, **kwargs: None)
+    monkeypatch.setattr(sys, 'argv', ['train.py'] + [str(arg) for arg in argv])
+    train.main()
+    return tested[0] if tested else None
+
+
+@pytest.mark.parametrize('retrain_all', [False, True])
+def test_warm_start(corpus, tmp_path, monkeypatch, retrain_all):
+    pssm_dir, rr_dir, pssm_files = corpus
+    first = train.train_vectorized(pssm_files[:3], pssm_dir, rr_dir, epochs=1, seed=0,
+                                   model_file=str(tmp_path / 'first.bin'))
+    assert first.metadata['proteins_seen'] == sorted(pssm_files[:3])
+
+    argv = [pssm_dir, rr_dir, '--epochs', 1, '--seed', 1, '--warm-start', tmp_path / 'first.bin',
+            '--model', tmp_path / 'second.bin'] + (['--retrain-all'] if retrain_all else [])
+    pssm_test = run_main(monkeypatch, *argv)
+    second = utils.load_model(str(tmp_path / 'second.bin'), None)
+    assert second.metadata['warm_start'] == str(tmp_path / 'first.bin')
+    seen = set(second.metadata['proteins_seen'])
+    assert seen >= set(pssm_files[:3])
+    # proteins either model was trained on stay out of the test set
+    assert not set(pssm_test or []) & seen
+    if retrain_all:
+        assert second.metadata['proteins'] == 4
+    else:
+        # only the 3 proteins the first model has not seen are split into training and test proteins
+        assert second.metadata['proteins'] == 2
+        assert len(seen) == 5 and set(pssm_test) == set(pssm_files) - seen
+
+
+def test_warm_start_with_nothing_new_exits(corpus, tmp_path, monkeypatch):
+    pssm_dir, rr_dir, pssm_files = corpus
+    train.train_vectorized(pssm_files, pssm_dir, rr_dir, epochs=1, model_file=str(tmp_path / 'first.bin'))
+    with pytest.raises(SystemExit) as exit_info:
+        run_main(monkeypatch, pssm_dir, rr_dir, '--warm-start', tmp_path / 'first.bin', '--model',
+                 tmp_path / 'second.bin')
+    assert exit_info.value.code == 1
+    assert not (tmp_path / 'second.bin').exists()
+
+
+@pytest.mark.parametrize('trainer, extra, fit_workers, stopped', [('vectorized', [], 1, False),
+                                                                  ('parallel', ['--fit-workers', 2], 2, False),
+                                                                  ('lbfgs', ['--max-iterations', 3], 1, True),
+                                                                  ('adam', ['--max-iterations', 2], 1, True)])
+def test_main_trainers(corpus, tmp_path, monkeypatch, trainer, extra, fit_workers, stopped):
+    pssm_dir, rr_dir, pssm_files = corpus
+    run_main(monkeypatch, pssm_dir, rr_dir, '--trainer', trainer, '--epochs', 2, '--seed', 0, '--model',
+             tmp_path / 'model.bin', *extra)
+    metadata = utils.load_model(str(tmp_path / 'model.bin'), None).metadata
+    assert metadata['trainer'] == trainer and metadata['fit_workers'] == fit_workers
+    assert metadata['batch_size'] == (None if trainer == 'parallel' else train.BATCH_SIZE)
+    assert (metadata['stopping'] is not None) == stopped and ('stopped' in metadata) == stopped
@@ -0,0 +1,126 @@
+import gzip
+import json
+import os
+import struct
+
+import numpy as np
+import pytest
+
+import utils
+
+
+def baseline_build_small_matrix(pssm):
+    """
+    The window features as train.build_small_matrix built them before PSSM arrays, from the row dictionaries
+    of utils.read_pssm
+    """
+    empty_row = {acid: -1 for acid in utils.acids_list}
+    small_matrix = []
+    for row_num in range(len(pssm)):
+        feature = {}
+        for row_offset in range(-2, 3):
+            if row_num + row_offset < 0 or row_num + row_offset >= len(pssm):
+                values = empty_row
+            else:
+                values = pssm[row_num + row_offset]
+            for val_num, acid in enumerate(utils.acids_list):
+                feature[((row_offset + 2) * 20) + val_num] = values[acid]
+        small_matrix.append(feature)
+    return small_matrix
+
+
+def test_window_matrix_matches_baseline_small_matrix(corpus):
+    pssm_dir, rr_dir, pssm_files = corpus
+    for pssm_file in pssm_files:
+        pssm, residues = utils.read_pssm_array(pssm_file, pssm_dir)
+        rows = utils.read_pssm(pssm_file, pssm_dir)
+        assert residues.tolist() == [row['this-acid'] for row in rows]
+        expected = [[feature[n] for n in range(100)] for feature in baseline_build_small_matrix(rows)]
+        assert utils.window_matrix(pssm).tolist() == expected
+
+
+def test_binary_model_round_trip(tmp_path):
+    weights = np.random.default_rng(0).normal(0, 1, 201)
+    utils.write_model(utils.Model(weights, metadata={'epochs': 3, 'proteins': ['p0.pssm']}), 'model.bin',
+                      str(tmp_path))
+    with open(tmp_path / 'model.bin', 'rb') as file:
+        assert file.read(len(utils.MODEL_MAGIC)) == utils.MODEL_MAGIC
+    model = utils.load_model('model.bin', str(tmp_path))
+    assert np.array_equal(model.weights, weights)
+    assert model.metadata == {'epochs': 3, 'proteins': ['p0.pssm']}
+    assert model.layout == utils.feature_layout()
+    assert utils.read_model('model.bin', str(tmp_path)) == weights.tolist()
+
+
+def test_json_model_round_trip(tmp_path):
+    weights = np.random.default_rng(1).normal(0, 1, 201).tolist()
+    utils.write_model(weights, 'model.json', str(tmp_path))
+    assert json.loads((tmp_path / 'model.json').read_text()) == weights
+    assert utils.read_model('model.json', str(tmp_path)) == weights
+
+
+def test_newer_model_format_is_rejected(tmp_path):
+    utils.write_model([0.0] * 201, 'model.bin', str(tmp_path))
+    contents = bytearray((tmp_path / 'model.bin').read_bytes())
+    struct.pack_into('<H', contents, len(utils.MODEL_MAGIC), utils.MODEL_FORMAT_VERSION + 1)
+    (tmp_path / 'model.bin').write_bytes(bytes(contents))
+    with pytest.raises(Exception, match='newer format'):
+        utils.load_model('model.bin', str(tmp_path))
+
+
+def test_model_with_wrong_number_of_weights_is_rejected(tmp_path):
+    utils.write_model([0.0] * 101, 'model.json', str(tmp_path))
+    with pytest.raises(Exception):
+        utils.load_model('model.json', str(tmp_path))
+
+
+def test_contact_map_bitmap_matches_contact_pairs():
+    rng = np.random.default_rng(3)
+    length = 45
+    pairs = {(int(i), int(j)) for i, j in rng.integers(0, length, (80, 2))}
+    i, j = np.array(sorted(pairs)).T
+    contact_map = utils.ContactMap('A' * length, i, j, np.full(len(i), 5.0))
+    all_i, all_j = np.indices((length, length)).reshape(2, -1)
+    expected = [(a, b) in pairs for a, b in zip(all_i.tolist(), all_j.tolist())]
+    assert contact_map.contains(all_i, all_j).tolist() == expected
+    assert (int(i[0]), int(j[0])) in contact_map
+
+
+def test_contact_map_ignores_out_of_range_pairs():
+    # (-1, 3) would land on (0, 3 - length) if its flat index were used, wrapping onto the previous row
+    length = 10
+    contact_map = utils.ContactMap('A' * length, [-1, 2, 4], [3, 7, length], [5.0, 5.0, 5.0], length)
+    all_i, all_j = np.indices((length, length)).reshape(2, -1)
+    assert contact_map.contains(all_i, all_j).sum() == 1
+    assert (2, 7) in contact_map
+    assert not contact_map.contains([-1, 4, 12], [3, length, 1]).any()
+    assert len(contact_map) == 3
+
+
+def test_read_contact_map(tmp_path):
+    (tmp_path / 'p.rr').write_text('ACDEFGHIKL\n1 6 0 8 3.5\n2 9 0 8 4.0\n1 6 0 8 6.0\n')
+    contact_map = utils.read_contact_map('p.rr', str(tmp_path))
+    assert contact_map.sequence == 'ACDEFGHIKL'
+    assert contact_map.pairs() == [(0, 5), (1, 8)]
+    assert contact_map.distances.tolist() == [6.0, 4.0]
+    assert contact_map.contains([0, 1, 5], [5, 8, 0]).tolist() == [True, True, False]
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_write_rr_round_trip(tmp_path, monkeypatch, compress):
+    # small blocks, so the rows are formatted across several of them
+    monkeypatch.setattr(utils, 'RR_BLOCK_ROWS', 7)
+    rng = np.random.default_rng(4)
+    i = rng.integers(0, 40, 50)
+    j = i + rng.integers(5, 20, 50)
+    probabilities = rng.random(50)
+    file_name = utils.write_rr(str(tmp_path / 'p.rr'), i, j, probabilities, 'ACDEFG', compress=compress)
+    assert file_name == str(tmp_path / ('p.rr.gz' if compress else 'p.rr'))
+    assert os.listdir(tmp_path) == [os.path.basename(file_name)]
+    with (gzip.open(file_name, 'rt') if compress else open(file_name)) as file:
+        lines = file.read().splitlines()
+    assert lines[0] == 'ACDEFG'
+    assert lines[1:] == ['{} {} 0 8 {:.6g}'.format(a + 1, b + 1, p) for a, b, p in zip(i, j, probabilities)]
+    rows = np.array([line.split() for line in lines[1:]], dtype=float)
+    assert np.array_equal(rows[:, 0], i + 1) and np.array_equal(rows[:, 1], j + 1)
+    assert np.allclose(rows[:, 4], probabilities, rtol=1e-5)
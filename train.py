@@ -1,15 +1,25 @@
 # functions used to train and create the model
 import utils
+import scoring
+import cache
+import instrument
+import feature_store
+import parallel_gradient
+import optimize
+import manifest
+import cProfile
 import os
+import argparse
+import random
 from random import sample
+import numpy as np
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import sys
 from math import exp, log
 import test
 import classify
 
-empty_row = {'A': -1, 'C': -1, 'E': -1, 'D': -1, 'G': -1, 'I': -1, 'H': -1, 'K': -1, 'F': -1, 'M': -1, 'L': -1, 'N': -1, 'Q': -1, 'P': -1, 'S': -1, 'R': -1, 'T': -1, 'W': -1, 'V': -1, 'Y': -1}
-acids_list = ['A', 'C', 'E', 'D', 'G', 'I', 'H', 'K', 'F', 'M', 'L', 'N', 'Q', 'P', 'S', 'R', 'T', 'W', 'V', 'Y']
-
 # Get the parent directory of this code
 this_script = os.path.abspath(__file__)
 parent_directory = os.path.dirname(this_script)
@@ -18,18 +28,83 @@ parent_directory = os.path.dirname(this_script)
 SAMPLE_SIZE = 10
 STEP_SIZE = 0.001
 
+# Non-contact pairs sampled per contact when building training rows
+NEGATIVE_RATIO = 1.0
 
-def main():
-    # Read in PSSM/RR files
-    pssm_list, rr_list, pssm_dir, rr_dir = parse_args()
-    pssm_train = sample(pssm_list, int(0.75 * len(pssm_list)))
-    pssm_test = [pssm for pssm in pssm_list if pssm not in pssm_train]
-    train(pssm_train, pssm_dir, rr_dir)
-    test.main(pssm_test, pssm_dir, rr_dir)
-    classify.main(pssm_test, pssm_dir, rr_dir)
+# Proteins featurized ahead per worker process; bounds how many finished results wait to be consumed
+JOBS_PER_WORKER = 2
 
+# Defaults for the vectorized trainer
+BATCH_SIZE = 256
+EPOCHS = 20
+LEARNING_RATE = 0.01
 
-def build_feature_matrix(pssm_files, pssm_dir, rr_dir):
+
+def main():
+    # Read in PSSM/RR files
+    pssm_list, rr_list, pssm_dir, rr_dir, args, dataset = parse_args()
+    cache.configure(args.cache_dir, args.cache_size * 1024 ** 2, not args.no_cache)
+    instrument.configure(args.run_report is not None, args.log_interval)
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if args.seed is not None:
+        random.seed(args.seed)
+    initial_model = None
+    if args.warm_start:
+        initial_model = utils.load_model(os.path.abspath(args.warm_start), None)
+        if not args.retrain_all:
+            pssm_list = unseen_proteins(pssm_list, initial_model)
+            if not pssm_list:
+                print('{} has already been trained on every protein in {}; there is nothing new to train on.'
+                      .format(args.warm_start, pssm_dir))
+                sys.exit(1)
+            print('Training on {} proteins the model has not seen...'.format(len(pssm_list)))
+    pssm_train, pssm_test = utils.split_files(pssm_list, rr_list)
+    if dataset is not None:
+        # featurize the longest proteins first, so parallel workers finish together
+        pssm_train = manifest.longest_first(pssm_train, dataset)
+    if initial_model is not None:
+        # proteins the warm-start model was trained on would inflate the test precision
+        num_test = len(pssm_test)
+        pssm_test = unseen_proteins(pssm_test, initial_model)
+        if len(pssm_test) < num_test:
+            print('Leaving {} proteins {} was trained on out of the test set'.format(num_test - len(pssm_test),
+                                                                                    args.warm_start))
+    with instrument.stage('train'):
+        if args.trainer == 'gradient':
+            model = train(pssm_train, pssm_dir, rr_dir, args.model, args.negative_ratio, initial_model)
+        else:
+            # lbfgs and adam run until convergence; vectorized and parallel for a fixed number of epochs
+            converge = args.trainer in ('lbfgs', 'adam')
+            stopping = {'max_iterations': args.max_iterations, 'gradient_tolerance': args.gradient_tolerance,
+                        'relative_tolerance': args.relative_tolerance, 'patience': args.patience}
+            model = train_vectorized(
+                pssm_train, pssm_dir, rr_dir, batch_size=args.batch_size, epochs=args.epochs,
+                learning_rate=args.learning_rate, schedule=args.schedule, decay=args.decay, seed=args.seed,
+                workers=args.workers, model_file=args.model, negative_ratio=args.negative_ratio,
+                store_dir=args.feature_store, store_dtype=args.store_dtype, initial_model=initial_model,
+                fit_workers=args.fit_workers if args.trainer == 'parallel' else 1,
+                optimizer=args.trainer if converge else 'sgd', stopping=stopping if converge else None,
+                validation_fraction=args.validation_fraction if converge else 0.0)
+    if not pssm_test:
+        print('No test proteins left that the model has not been trained on; skipping testing.')
+    else:
+        with instrument.stage('test'):
+            test.main(pssm_test, pssm_dir, rr_dir, args.top_k, model, not args.no_rr_output, args.report, args.gzip,
+                      args.prefetch, args.band, args.quantize, args.feature_blocks, args.quantize_delta)
+        with instrument.stage('classify'):
+            classify.main(pssm_test, pssm_dir, rr_dir, args.top_k, model, args.gzip, args.prefetch, args.band,
+                          args.quantize, args.feature_blocks)
+
+    if args.profile:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+    if args.run_report:
+        instrument.write_report(args.run_report)
+
+
+def build_feature_matrix(pssm_files, pssm_dir, rr_dir, negative_ratio=NEGATIVE_RATIO):
     """
     Builds a feature matrix based on PSSM and RR files
     :return: List of dictionaries. Keys are feature numbers(0 - 199) and 'class'
@@ -38,75 +113,272 @@ def build_feature_matrix(pssm_files, pssm_dir, rr_dir):
     feature_matrix = []
 
     for pssm_file in pssm_files:
-        # For each training file, read in the PSSM matrix and the RR file
-        pssm = utils.read_pssm(pssm_file, pssm_dir)
-        rr = utils.read_rr(pssm_file.replace('.pssm', '.rr'), rr_dir)
-        intermediate_matrix = build_small_matrix(pssm)
-
-        # Get a random sample of (i, j) pairs to balance data
-        pairs = [(i, j) for i in range(len(intermediate_matrix)) for j in range(i+5, len(intermediate_matrix)) if (i, j) not in rr]
-        pairs = sample(pairs, len(rr))
-
-        def build_row(class_label):
+        features, labels = build_protein_features(pssm_file, pssm_dir, rr_dir, negative_ratio=negative_ratio)
+        for feature_values, class_label in zip(features.tolist(), labels.tolist()):
             # Build row for feature matrix:
             feature_row = {'class': class_label}
-            feature_row.update(intermediate_matrix[i])
-            for feat_num in range(len(intermediate_matrix[j])):
-                feature_row[100 + feat_num] = intermediate_matrix[j][feat_num]
-            # feature_matrix.append(feature_row)
-            return feature_row
-
-        # For each i, j pair, make a row for the feature matrix
-        for i, j in pairs:
-            feature_matrix.append(build_row(0))
-        pair_keys = [key for key in rr.keys() if key != 'sequence']
-        for i, j in pair_keys:
-            feature_matrix.append(build_row(1))
+            feature_row.update(enumerate(feature_values))
+            feature_matrix.append(feature_row)
     return feature_matrix
 
 
+def build_feature_arrays(pssm_files, pssm_dir, rr_dir, workers=1, negative_ratio=NEGATIVE_RATIO):
+    """
+    Builds the same kind of rows as build_feature_matrix, stacked into arrays.
+    Each protein samples its non-contact pairs from its own seed (drawn once from the global random state),
+    so the result is the same for any number of workers.
+    :param workers: number of processes to spread the proteins over
+    :param negative_ratio: number of non-contact pairs to sample per contact
+    :return: (N x 200 feature array, array of N class labels)
+    """
+    print('Building feature matrix...')
+    results = list(iter_protein_features(pssm_files, pssm_dir, rr_dir, workers, negative_ratio))
+    if not results:
+        return np.zeros((0, 200), dtype=np.int16), np.zeros(0, dtype=np.int8)
+    return np.concatenate([features for features, labels in results]), \
+        np.concatenate([labels for features, labels in results])
+
+
+def build_feature_store(store_dir, pssm_files, pssm_dir, rr_dir, workers=1, negative_ratio=NEGATIVE_RATIO,
+                        dtype='int8'):
+    """
+    Builds the same rows as build_feature_arrays, but writes them to a memory-mapped store on disk
+    as they are built instead of holding them all in memory. Only a few proteins per worker are in memory
+    at once (see iter_protein_features).
+    :return: (N x 200 feature array, array of N class labels), memory-mapped from store_dir
+    """
+    print('Building feature store in ' + store_dir + '...')
+    return feature_store.write_store(store_dir, iter_protein_features(pssm_files, pssm_dir, rr_dir, workers,
+                                                                      negative_ratio), dtype)
+
+
+def iter_protein_features(pssm_files, pssm_dir, rr_dir, workers=1, negative_ratio=NEGATIVE_RATIO):
+    """
+    Yields the (features, labels) arrays of each protein in pssm_files order.
+    With workers > 1, at most JOBS_PER_WORKER proteins per worker are submitted ahead of the one being
+    yielded, so results never pile up faster than they are consumed.
+    """
+    base_seed = random.getrandbits(32)
+    cache_settings = cache.settings()
+    jobs = [(pssm_file, pssm_dir, rr_dir, '{}:{}'.format(base_seed, pssm_file), negative_ratio, cache_settings)
+            for pssm_file in pssm_files]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            instrument_settings = instrument.settings()
+            jobs = iter(jobs)
+            pending = deque()
+            for job in jobs:
+                pending.append(executor.submit(protein_features_worker, job, instrument_settings))
+                if len(pending) >= JOBS_PER_WORKER * workers:
+                    break
+            while pending:
+                result, records = pending.popleft().result()
+                # keep the workers busy with the next job
+                for job in jobs:
+                    pending.append(executor.submit(protein_features_worker, job, instrument_settings))
+                    break
+                instrument.add_records(records)
+                yield result
+                del result
+    else:
+        for job in jobs:
+            yield protein_features_job(job)
+
+
+def protein_features_job(job):
+    """
+    Worker entry point for iter_protein_features
+    :param job: (pssm_file, pssm_dir, rr_dir, seed, negative_ratio, cache settings)
+    """
+    pssm_file, pssm_dir, rr_dir, seed, negative_ratio, cache_settings = job
+    cache.configure(**cache_settings)
+    return build_protein_features(pssm_file, pssm_dir, rr_dir, random.Random(seed), negative_ratio)
+
+
+def protein_features_worker(job, instrument_settings):
+    """
+    Runs protein_features_job in a worker process
+    :return: (result of the job, instrumentation records to add in the parent process)
+    """
+    instrument.configure(**instrument_settings)
+    result = protein_features_job(job)
+    return result, instrument.take_records()
+
+
+def build_protein_features(pssm_file, pssm_dir, rr_dir, rng=None, negative_ratio=NEGATIVE_RATIO):
+    """
+    Builds the feature rows of one protein: a random sample of non-contact pairs, then every contact pair
+    :param rng: random.Random to seed the sampling with, or None for the global random state
+    :param negative_ratio: number of non-contact pairs to sample per contact
+    :return: (N x 200 feature array, array of N class labels)
+    """
+    # Read in the PSSM matrix and the RR file
+    pssm, residues, intermediate_matrix = cache.load_pssm(pssm_file, pssm_dir)
+    rr = cache.load_rr(pssm_file.replace('.pssm', '.rr'), rr_dir)
+
+    # Get a random sample of non-contact (i, j) pairs to balance data
+    with instrument.stage('sample_pairs', pssm_file):
+        sample_rng = np.random.default_rng((rng or random).getrandbits(64))
+        negative_i, negative_j = scoring.sample_non_contacts(rr, len(intermediate_matrix),
+                                                             int(round(negative_ratio * len(rr))), sample_rng)
+
+    # Each row is the window around i followed by the window around j
+    with instrument.stage('featurize', pssm_file):
+        i_list = np.concatenate([negative_i, rr.i]).astype(np.intp)
+        j_list = np.concatenate([negative_j, rr.j]).astype(np.intp)
+        features = np.hstack([intermediate_matrix[i_list], intermediate_matrix[j_list]])
+        labels = np.concatenate([np.zeros(len(negative_i), dtype=np.int8), np.ones(len(rr), dtype=np.int8)])
+    return features, labels
+
+
 def build_small_matrix(pssm):
     """
     Builds the 'small' intermediate matrix. Rows are 100 features from sliding window of size 5.
-    :return: List of dictionaries. Keys are feature numbers (0 - 99)
-    """
-    small_matrix = []
-    for row_num in range(len(pssm)):
-        # For each amino acid in the PSSM, build a line for the feature matrix
-        feature = {}
-        for row_offset in range(-2, 3):
-            if row_num + row_offset < 0:
-                # We're at the top of the PSSM
-                values = empty_row
-            elif row_num + row_offset >= len(pssm):
-                # We're at the bottom of the PSSM
-                values = empty_row
-            else:
-                # We're somewhere in the middle
-                values = pssm[row_num + row_offset]
-            for val_num, acid in enumerate(acids_list):
-                feature[((row_offset + 2) * 20) + val_num] = values[acid]
-        small_matrix.append(feature)
-    return small_matrix
-
-
-def train(pssm_list, pssm_dir, rr_dir):
+    :param pssm: L x 20 array from utils.read_pssm_array
+    :return: L x 100 array. Columns are feature numbers (0 - 99)
+    """
+    return utils.window_matrix(pssm)
+
+
+def train(pssm_list, pssm_dir, rr_dir, model_file=utils.MODEL_FILE, negative_ratio=NEGATIVE_RATIO,
+          initial_model=None):
     """
     Train the model using gradient ascent. Save the model.
+    :param initial_model: Model to continue training from, or None to start from new_w_vector()
+    :return: the saved Model
     """
     # Build feature matrix
-    feature_matrix = build_feature_matrix(pssm_list, pssm_dir, rr_dir)
+    feature_matrix = build_feature_matrix(pssm_list, pssm_dir, rr_dir, negative_ratio)
 
-    w_vector = new_w_vector()
+    w_vector = initial_w_vector(initial_model)
     gradient_vector = None
 
     print('Training the model...')
-    while not reached_top(w_vector, gradient_vector):
-        gradient_vector = calc_gradient(w_vector, feature_matrix)
-        w_vector = update_w(w_vector, gradient_vector)
+    iteration = 0
+    with instrument.stage('gradient_iterations'):
+        while not reached_top(w_vector, gradient_vector):
+            gradient_vector = calc_gradient(w_vector, feature_matrix)
+            w_vector = update_w(w_vector, gradient_vector)
+            iteration += 1
+            if instrument.should_log(iteration):
+                instrument.report_progress('gradient', iteration,
+                                           likelihood=calc_max_conditional_likelihood(w_vector, feature_matrix))
 
     # Save the model to the file
-    utils.write_model(w_vector)
+    metadata = training_metadata(pssm_list, initial_model, trainer='gradient', rows=len(feature_matrix),
+                                 iterations=iteration, negative_ratio=negative_ratio)
+    utils.write_model(w_vector, model_file, metadata=metadata)
+    return utils.load_model(model_file)
+
+
+def train_vectorized(pssm_list, pssm_dir, rr_dir, batch_size=BATCH_SIZE, epochs=EPOCHS,
+                     learning_rate=LEARNING_RATE, schedule='constant', decay=0.0, seed=None, workers=1,
+                     model_file=utils.MODEL_FILE, negative_ratio=NEGATIVE_RATIO, store_dir=None,
+                     store_dtype='int8', initial_model=None, fit_workers=1, optimizer='sgd', stopping=None,
+                     validation_fraction=0.0):
+    """
+    Train the model with NumPy mini-batch gradient ascent. Save the model.
+    :param batch_size: rows per gradient step; None for full-batch steps (with fit_workers > 1)
+    :param store_dir: build the training rows in a memory-mapped store in this directory instead of in memory
+    :param store_dtype: integer type of the features in the store
+    :param initial_model: Model to continue training from, or None to start from new_w_vector()
+    :param fit_workers: processes that compute the gradient of each step (see parallel_gradient)
+    :param optimizer: 'sgd' for fixed-epoch gradient ascent, or 'lbfgs' / 'adam' to run until convergence
+    :param stopping: keyword arguments for the convergence checks of optimize.lbfgs / optimize.adam
+                     (max_iterations, gradient_tolerance, relative_tolerance, patience)
+    :param validation_fraction: proteins held out for early stopping on their likelihood (lbfgs and adam)
+    :return: the saved Model
+    """
+    validation = None
+    if optimizer != 'sgd' and validation_fraction > 0:
+        held_out = random.Random(seed).sample(pssm_list, max(1, int(validation_fraction * len(pssm_list))))
+        held_out_set = set(held_out)
+        pssm_list = [pssm_file for pssm_file in pssm_list if pssm_file not in held_out_set]
+        validation = build_feature_arrays(held_out, pssm_dir, rr_dir, workers, negative_ratio)
+    if store_dir:
+        features, labels = build_feature_store(store_dir, pssm_list, pssm_dir, rr_dir, workers, negative_ratio,
+                                               store_dtype)
+    else:
+        features, labels = build_feature_arrays(pssm_list, pssm_dir, rr_dir, workers, negative_ratio)
+
+    print('Training the model...')
+    fit_info = {}
+    if optimizer == 'lbfgs':
+        w_vector, fit_info = optimize.lbfgs(features, labels, initial_w_vector(initial_model), validation=validation,
+                                            **(stopping or {}))
+    elif optimizer == 'adam':
+        w_vector, fit_info = optimize.adam(features, labels, initial_w_vector(initial_model), batch_size or BATCH_SIZE,
+                                           learning_rate, validation=validation, seed=seed, **(stopping or {}))
+    elif fit_workers > 1:
+        w_vector = parallel_gradient.fit_parallel(
+            features, labels, initial_w_vector(initial_model), fit_workers, batch_size, epochs, learning_rate,
+            lambda epoch: scheduled_step_size(learning_rate, schedule, decay, epoch), seed,
+            calc_likelihood_vectorized)
+    else:
+        w_vector = fit_vectorized(features, labels, initial_w_vector(initial_model), batch_size or len(labels),
+                                  epochs, learning_rate, schedule, decay, seed)
+
+    # Save the model to the file
+    if optimizer != 'sgd':
+        trainer = optimizer
+    else:
+        trainer = 'vectorized' if fit_workers == 1 else 'parallel'
+    metadata = training_metadata(pssm_list, initial_model, trainer=trainer,
+                                 rows=len(labels), batch_size=batch_size, epochs=epochs, learning_rate=learning_rate,
+                                 schedule=schedule, decay=decay, seed=seed, negative_ratio=negative_ratio,
+                                 fit_workers=fit_workers, stopping=stopping, validation_fraction=validation_fraction)
+    metadata.update(fit_info)
+    utils.write_model(w_vector, model_file, metadata=metadata)
+    return utils.load_model(model_file)
+
+
+def fit_vectorized(features, labels, w_vector, batch_size=BATCH_SIZE, epochs=EPOCHS,
+                   learning_rate=LEARNING_RATE, schedule='constant', decay=0.0, seed=None, rows=None):
+    """
+    Mini-batch gradient ascent on the conditional log likelihood (see calc_max_conditional_likelihood).
+    Each step uses the mean gradient of a batch (see optimize.batch_gradient).
+    :param features: N x 200 feature array
+    :param labels: array of N class labels
+    :param w_vector: starting weights, list of length 201
+    :param rows: sorted indices of the rows to train on, or None for every row. Each batch is read from
+                 features by index, so a subset of a memory-mapped store is never copied as a whole.
+    :return: w_vector as a list of length 201
+    """
+    rng = np.random.default_rng(seed)
+    w = np.array(w_vector, dtype=np.float64)
+    num_rows = len(labels) if rows is None else len(rows)
+    iteration = 0
+
+    with instrument.stage('gradient_iterations'):
+        for epoch in range(epochs):
+            step_size = scheduled_step_size(learning_rate, schedule, decay, epoch)
+            for batch in optimize.epoch_batches(num_rows, batch_size, rng):
+                gradient = optimize.batch_gradient(w, features, labels, batch if rows is None else rows[batch])
+                w += step_size * gradient / len(batch)
+                iteration += 1
+                if instrument.should_log(iteration):
+                    instrument.report_progress('gradient', iteration, epoch=epoch,
+                                               likelihood=calc_likelihood_vectorized(w, features, labels, rows))
+
+    return w.tolist()
+
+
+def scheduled_step_size(learning_rate, schedule, decay, epoch):
+    """
+    Learning rate for an epoch.
+    'constant' keeps learning_rate, 'inverse' uses learning_rate / (1 + decay * epoch),
+    'exponential' uses learning_rate * exp(-decay * epoch).
+    decay is a rate for both schedules, so decay = 0 keeps the learning rate constant.
+    """
+    if decay < 0:
+        raise Exception('The learning rate decay must not be negative: {}'.format(decay))
+    if schedule == 'constant':
+        return learning_rate
+    if schedule == 'inverse':
+        return learning_rate / (1 + decay * epoch)
+    if schedule == 'exponential':
+        return learning_rate * exp(-decay * epoch)
+    raise Exception('Unknown learning rate schedule: {}'.format(schedule))
 
 
 def calc_gradient(w_vector, matrix):
@@ -165,6 +437,47 @@ def calc_max_conditional_likelihood(w_vector, feature_matrix):
     return sum_mcl
 
 
+def calc_likelihood_vectorized(w_vector, features, labels, rows=None):
+    """
+    Same as calc_max_conditional_likelihood, over feature and label arrays (see optimize.chunked_likelihood)
+    :param rows: sorted indices of the rows to sum over, or None for every row
+    """
+    return optimize.chunked_likelihood(w_vector, features, labels, rows)
+
+
+def initial_w_vector(initial_model=None):
+    """
+    Starting weights: those of initial_model to continue training it, otherwise a new w vector
+    :return: list of length 201
+    """
+    if initial_model is None:
+        return new_w_vector()
+    return initial_model.weights.tolist()
+
+
+def training_metadata(pssm_list, initial_model=None, **values):
+    """
+    Metadata to save with a trained model. 'proteins_seen' lists every protein the model has been trained on,
+    including those seen by the model it was warm-started from.
+    """
+    seen = set(pssm_list)
+    metadata = {'proteins': len(pssm_list)}
+    if initial_model is not None:
+        seen.update(initial_model.metadata.get('proteins_seen', []))
+        metadata['warm_start'] = initial_model.path
+    metadata['proteins_seen'] = sorted(seen)
+    metadata.update(values)
+    return metadata
+
+
+def unseen_proteins(pssm_list, model):
+    """
+    :return: the proteins in pssm_list that model has not been trained on yet
+    """
+    seen = set(model.metadata.get('proteins_seen', []))
+    return [pssm_file for pssm_file in pssm_list if pssm_file not in seen]
+
+
 def new_w_vector():
     """
     Make a new w vector.
@@ -194,21 +507,116 @@ followed by the path to the .rr files.'''
 
 
 def parse_args():
+    parser = argparse.ArgumentParser(description=err_msg)
+    parser.add_argument('pssm_dir', help='directory with the .pssm files')
+    parser.add_argument('rr_dir', help='directory with the .rr files')
+    parser.add_argument('--top-k', default=None,
+                        help="only write the top K pairs of each protein: 'L/2', 'L/5', a count, or 'all' (default)")
+    parser.add_argument('--no-rr-output', action='store_true', help='evaluate the test proteins without writing .rr files')
+    parser.add_argument('--gzip', action='store_true', help='write gzip-compressed .rr.gz files')
+    parser.add_argument('--band', default=None,
+                        help="sequence separation band to test and classify: 'short', 'medium', 'long', "
+                             "'all' (default), MIN-MAX or MIN-")
+    parser.add_argument('--quantize', action='store_true',
+                        help='test and classify with int8 features and fixed-point weights')
+    parser.add_argument('--quantize-delta', action='store_true',
+                        help='with --quantize, also test on the float path and report the precision change and '
+                             'largest probability difference (scores every test pair twice)')
+    parser.add_argument('--feature-blocks', action='store_true',
+                        help='test and classify from blocks of full pair features instead of per-residue terms '
+                             '(without --top-k every probability is still kept to be sorted); not with --quantize')
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='proteins to read ahead while testing and classifying, in background threads (default: none)')
+    parser.add_argument('--report', default=None,
+                        help='write per-protein and mean precision to this file (.csv, otherwise JSON)')
+    parser.add_argument('--trainer', choices=['vectorized', 'parallel', 'lbfgs', 'adam', 'gradient'],
+                        default='vectorized',
+                        help='NumPy mini-batch trainer (default), full-batch gradient ascent with the gradient '
+                             'computed by --fit-workers processes, full-batch L-BFGS or mini-batch Adam run until '
+                             'convergence, or the original per-row gradient ascent')
+    parser.add_argument('--batch-size', type=int, default=None,
+                        help='rows per gradient step (default: {}, or every row for --trainer parallel, whose steps '
+                             'each cost a round trip to the workers and need at least {} rows per worker to pay off)'
+                        .format(BATCH_SIZE, parallel_gradient.MIN_SHARD_ROWS))
+    parser.add_argument('--fit-workers', type=int, default=os.cpu_count() or 1,
+                        help='processes computing the gradient with the parallel trainer, at least 2 '
+                             '(default: one per core)')
+    parser.add_argument('--epochs', type=int, default=EPOCHS)
+    parser.add_argument('--learning-rate', type=float, default=LEARNING_RATE)
+    parser.add_argument('--schedule', choices=['constant', 'inverse', 'exponential'], default='constant')
+    parser.add_argument('--decay', type=float, default=0.0,
+                        help='decay rate of the learning rate schedule: lr / (1 + decay * epoch) for inverse, '
+                             'lr * exp(-decay * epoch) for exponential (default 0: no decay)')
+    parser.add_argument('--max-iterations', type=int, default=optimize.MAX_ITERATIONS,
+                        help='most L-BFGS iterations or Adam epochs')
+    parser.add_argument('--gradient-tolerance', type=float, default=optimize.GRADIENT_TOLERANCE,
+                        help='L-BFGS/Adam stop once the norm of the mean gradient is this small (0 to disable)')
+    parser.add_argument('--relative-tolerance', type=float, default=optimize.RELATIVE_TOLERANCE,
+                        help='L-BFGS/Adam stop once the likelihood changes by less than this fraction (0 to disable)')
+    parser.add_argument('--validation-fraction', type=float, default=0.0,
+                        help='fraction of the training proteins held out for early stopping with L-BFGS/Adam')
+    parser.add_argument('--patience', type=int, default=optimize.PATIENCE,
+                        help='checks without a better held-out likelihood before stopping early')
+    parser.add_argument('--seed', type=int, default=None, help='seed for the data split, sampling and batches')
+    parser.add_argument('--warm-start', default=None,
+                        help='model file to continue training from, on the proteins it has not been trained on yet')
+    parser.add_argument('--retrain-all', action='store_true',
+                        help='with --warm-start, train on every protein again instead of only on those the model '
+                             'has not been trained on')
+    parser.add_argument('--feature-store', default=None,
+                        help='write the training rows to a memory-mapped store in this directory and train from it')
+    parser.add_argument('--store-dtype', choices=['int8', 'int16'], default='int8',
+                        help='integer type of the features in the store')
+    parser.add_argument('--negative-ratio', type=float, default=NEGATIVE_RATIO,
+                        help='non-contact pairs sampled per contact for training')
+    parser.add_argument('--workers', type=int, default=1, help='processes used to build the feature matrix')
+    parser.add_argument('--model', default=utils.MODEL_FILE,
+                        help='model file to write: binary format, or a JSON list of weights if it ends in .json')
+    parser.add_argument('--run-report', default=None,
+                        help='record time and memory of every stage and write them to this file (.csv, otherwise JSON)')
+    parser.add_argument('--log-interval', type=int, default=0,
+                        help='report the likelihood every N gradient iterations of an instrumented run')
+    parser.add_argument('--profile', default=None, help='write cProfile stats of the whole run to this file')
+    parser.add_argument('--manifest', default=None,
+                        help='list the dataset from this manifest file, refreshing it (see manifest.py)')
+    parser.add_argument('--no-cache', action='store_true', help='parse every file instead of using the feature cache')
+    parser.add_argument('--cache-dir', default=cache.cache_directory, help='directory of the feature cache')
+    parser.add_argument('--cache-size', type=int, default=cache.max_cache_bytes // 1024 ** 2,
+                        help='size cap of the feature cache in MB')
     if len(sys.argv) < 3:
         print(err_msg)
         sys.exit()
-
-    try:
-        # Get the lists of pssm and rr file names
-        pssm = utils.read_directory_contents(sys.argv[1], '.pssm')
-        rr = utils.read_directory_contents(sys.argv[2], '.rr')
-    except:
+    args = parser.parse_args()
+    if args.trainer == 'parallel' and args.fit_workers < 2:
+        parser.error('--trainer parallel needs --fit-workers of 2 or more; use --trainer vectorized for one process')
+    if args.trainer == 'parallel' and args.batch_size is not None \
+            and args.batch_size < 2 * parallel_gradient.MIN_SHARD_ROWS:
+        parser.error('--trainer parallel splits each step over its workers, at least {} rows each; batches of {} '
+                     'rows are faster with --trainer vectorized'.format(parallel_gradient.MIN_SHARD_ROWS,
+                                                                        args.batch_size))
+    if args.batch_size is None and args.trainer != 'parallel':
+        args.batch_size = BATCH_SIZE
+    if args.quantize_delta and not args.quantize:
+        parser.error('--quantize-delta compares --quantize with the float path; give both')
+    if args.quantize and args.feature_blocks:
+        parser.error('--quantize and --feature-blocks are different scoring paths; choose one')
+
+    if not os.path.isdir(args.pssm_dir) or not os.path.isdir(args.rr_dir):
         # Given paths are not valid directories
         print(err_msg)
         sys.exit()
 
-    # Return list of pssm & rr files, and their parent directories
-    return pssm, rr, sys.argv[1], sys.argv[2]
+    # Get the lists of pssm and rr file names
+    dataset = None
+    if args.manifest:
+        dataset = manifest.load(args.pssm_dir, args.rr_dir, args.manifest)
+        pssm, rr = manifest.pssm_files(dataset, paired=False), manifest.rr_files(dataset)
+    else:
+        pssm = utils.read_directory_contents(args.pssm_dir, '.pssm')
+        rr = utils.read_directory_contents(args.rr_dir, '.rr')
+
+    # Return list of pssm & rr files, their parent directories, the remaining options and the manifest if any
+    return pssm, rr, args.pssm_dir, args.rr_dir, args, dataset
 
 
 if __name__ == '__main__':
@@ -2,11 +2,30 @@
 import os
 from random import sample
 import json
+import gzip
+import struct
+import numpy as np
 
 # Get the parent directory of this code
 this_script = os.path.abspath(__file__)
 parent_directory = os.path.dirname(this_script)
 
+# Fixed column order of the amino acids in PSSM arrays and feature vectors
+acids_list = ['A', 'C', 'E', 'D', 'G', 'I', 'H', 'K', 'F', 'M', 'L', 'N', 'Q', 'P', 'S', 'R', 'T', 'W', 'V', 'Y']
+
+# Binary model format: magic, format version, header length, JSON header, then little-endian float64 weights
+MODEL_MAGIC = b'P4MODEL\0'
+MODEL_FORMAT_VERSION = 1
+MODEL_FILE = 'model.bin'
+WINDOW_SIZE = 5
+
+# Models already loaded, keyed by path. Values are (modification time, Model)
+loaded_models = {}
+
+# .rr output is formatted this many rows at a time, through a buffer of this size
+RR_BLOCK_ROWS = 65536
+RR_BUFFER_BYTES = 1024 * 1024
+
 
 # Read a biological sequence or RSA sequence from a file:
 def read_sequence(file_path, dir=None):
@@ -61,6 +80,57 @@ def read_pssm(file_path, dir=None):
     return pssm
 
 
+def read_pssm_array(file_path, dir=None):
+    """
+    Reads a .pssm file into an L x 20 integer array, with columns in acids_list order
+    :return: (pssm matrix, array of the residue letters)
+    """
+    if dir:
+        file_path = os.path.join(dir, file_path)
+    with open(file_path, 'r') as f:
+        return parse_pssm_array(f)
+
+
+def parse_pssm_array(lines):
+    """
+    Parses the lines of a .pssm file (an open file, or e.g. io.StringIO of its contents)
+    :return: (L x 20 pssm matrix with columns in acids_list order, array of the residue letters)
+    """
+    lines = iter(lines)
+    residues = []
+    rows = []
+    # Ignore the title line
+    title = next(lines, '')
+    if title in ['', '\n']:
+        title = next(lines, '')
+
+    # Map the header order of the amino acids onto acids_list
+    headers = next(lines, '').strip().split()[:20]
+    columns = [headers.index(acid) + 2 for acid in acids_list]
+
+    for line in lines:
+        if line in ['', '\n']:
+            break
+        line_list = line.split()
+        residues.append(line_list[1])
+        rows.append([int(line_list[col]) for col in columns])
+
+    pssm = np.array(rows, dtype=np.int16).reshape(len(rows), len(acids_list))
+    return pssm, np.array(residues)
+
+
+def window_matrix(pssm):
+    """
+    Builds the sliding window features (size 5) for every residue of a PSSM array.
+    Rows past either end of the protein are padded with -1.
+    :return: L x 100 array. Column (row_offset + 2) * 20 + acid is the window value
+    """
+    length = len(pssm)
+    padded = np.full((length + 4, len(acids_list)), -1, dtype=pssm.dtype)
+    padded[2:length + 2] = pssm
+    return np.hstack([padded[offset:offset + length] for offset in range(5)])
+
+
 def read_rr(file_path, dir=None):
     if dir:
         file_path = os.path.join(dir, file_path)
@@ -84,6 +154,129 @@ def read_rr(file_path, dir=None):
     return rr
 
 
+def read_contact_map(file_path, dir=None):
+    """
+    Reads a .rr file into a ContactMap. Repeated (i, j) lines keep their first position and last distance,
+    the same as read_rr.
+    :return: ContactMap
+    """
+    if dir:
+        file_path = os.path.join(dir, file_path)
+    with open(file_path, 'r') as f:
+        # Read in the sequence from the top of the .rr file
+        sequence = f.readline().strip()
+        lines = []
+        for line in f:
+            if line in ['', '\n']:
+                break
+            lines.append(line.split()[:5])
+
+    fields = np.array(lines, dtype=str).reshape(len(lines), 5)
+    i = fields[:, 0].astype(np.int32) - 1
+    j = fields[:, 1].astype(np.int32) - 1
+    distances = fields[:, 4].astype(np.float64)
+
+    # Drop repeated pairs
+    length = max([len(sequence), int(i.max()) + 1, int(j.max()) + 1] if len(lines) else [len(sequence)])
+    flat = i.astype(np.int64) * length + j
+    unique, first = np.unique(flat, return_index=True)
+    if len(unique) < len(flat):
+        last = len(flat) - 1 - np.unique(flat[::-1], return_index=True)[1]
+        order = np.argsort(first)
+        i, j, distances = i[first[order]], j[first[order]], distances[last[order]]
+    return ContactMap(sequence, i, j, distances, length)
+
+
+class ContactMap:
+    """
+    Contacts of a protein: the sequence, parallel 0-based i / j / distance arrays,
+    and an L x L bit-packed contact map for vectorized membership tests
+    """
+    def __init__(self, sequence, i, j, distances, length=None, bitmap=None):
+        self.sequence = sequence
+        self.i = np.asarray(i, dtype=np.int32)
+        self.j = np.asarray(j, dtype=np.int32)
+        self.distances = np.asarray(distances, dtype=np.float64)
+        if length is None:
+            length = max([len(sequence), int(self.i.max()) + 1, int(self.j.max()) + 1]
+                         if len(self.i) else [len(sequence)])
+        self.length = length
+        if bitmap is None:
+            # Pairs outside the map (e.g. 0-based lines read as 1-based, giving -1) are left out, the same as
+            # contains() treats them, so their flat index cannot wrap around onto another pair
+            inside = (self.i >= 0) & (self.j >= 0) & (self.i < length) & (self.j < length)
+            dense = np.zeros(length * length, dtype=bool)
+            dense[self.i[inside].astype(np.int64) * length + self.j[inside]] = True
+            bitmap = np.packbits(dense)
+        self.bitmap = bitmap
+
+    def __len__(self):
+        return len(self.i)
+
+    def __contains__(self, pair):
+        return bool(self.contains(pair[0], pair[1]))
+
+    def contains(self, i, j):
+        """
+        :return: boolean array, True where (i[n], j[n]) is a contact. Pairs outside the map are not contacts.
+        """
+        i = np.asarray(i, dtype=np.int64)
+        j = np.asarray(j, dtype=np.int64)
+        inside = (i >= 0) & (j >= 0) & (i < self.length) & (j < self.length)
+        flat = np.where(inside, i * self.length + j, 0)
+        bits = (self.bitmap[flat >> 3] >> (7 - (flat & 7))) & 1
+        return inside & (bits == 1)
+
+    def pairs(self):
+        """
+        :return: list of the (i, j) contact tuples
+        """
+        return list(zip(self.i.tolist(), self.j.tolist()))
+
+
+def write_rr(file_name, i, j, probabilities, sequence=None, precision=6, compress=False):
+    """
+    Write predicted contacts in .rr format ("i j 0 8 probability" lines). Rows are formatted in blocks of
+    RR_BLOCK_ROWS with one string operation each. The file is written under a temporary name and then renamed.
+    :param i, j: 0-based residue indices (written 1-based, as read_rr and read_contact_map expect)
+    :param precision: significant digits of the probabilities
+    :param compress: gzip the output, adding .gz to the file name
+    :return: the name of the written file
+    """
+    if compress and not file_name.endswith('.gz'):
+        file_name += '.gz'
+    temp_name = file_name + '.tmp'
+    if compress:
+        file = gzip.open(temp_name, 'wt', compresslevel=6)
+    else:
+        file = open(temp_name, 'w', buffering=RR_BUFFER_BYTES)
+    with file:
+        for block in rr_blocks(i, j, probabilities, sequence, precision):
+            file.write(block)
+    os.replace(temp_name, file_name)
+    return file_name
+
+
+def rr_blocks(i, j, probabilities, sequence=None, precision=6):
+    """
+    Formats predicted contacts as .rr text (see write_rr), RR_BLOCK_ROWS rows at a time
+    :return: iterator of strings: the sequence line, if any, then blocks of rows
+    """
+    row_format = '%d %d 0 8 %.{}g\n'.format(precision)
+    i = np.asarray(i) + 1
+    j = np.asarray(j) + 1
+    probabilities = np.asarray(probabilities)
+    if sequence is not None:
+        yield sequence + '\n'
+    for start in range(0, len(probabilities), RR_BLOCK_ROWS):
+        end = min(start + RR_BLOCK_ROWS, len(probabilities))
+        values = [None] * (3 * (end - start))
+        values[0::3] = i[start:end].tolist()
+        values[1::3] = j[start:end].tolist()
+        values[2::3] = probabilities[start:end].tolist()
+        yield row_format * (end - start) % tuple(values)
+
+
 def parse_rr_line(rr_line):
     """
     Splits a line of the .rr file into i, j, and distance,
@@ -113,36 +306,124 @@ def read_dist(file_path, dir=None):
 def split_files(pssm_list, rr_list):
     test_correct_pssm_files(pssm_list, rr_list)
     pssm_train = sample(pssm_list, int(0.75 * len(pssm_list)))
-    pssm_test = [pssm_name for pssm_name in pssm_list if pssm_name not in pssm_train]
+    train_set = set(pssm_train)
+    pssm_test = [pssm_name for pssm_name in pssm_list if pssm_name not in train_set]
     return pssm_train, pssm_test
 
 
 # make sure each .pssm has a corresponding .rr
 def test_correct_pssm_files(pssm_list, rr_list):
+    rr_set = set(rr_list)
     for pssm_name in pssm_list:
-        if pssm_name.replace('.pssm', '.rr') not in rr_list:
+        if pssm_name.replace('.pssm', '.rr') not in rr_set:
             raise Exception('PSSM files don\'t match up with .rr files: {}'.format(pssm_name))
 
 
-def write_model(model, file_name='model.json', dir=parent_directory):
+def write_model(model, file_name=MODEL_FILE, dir=parent_directory, metadata=None):
     """
-    Write JSON object to a file
+    Write the model weights to a file: a JSON list for .json files, the binary model format otherwise
+    :param model: list of weights or a Model
+    :param metadata: training metadata stored in the header of a binary model
     :return: None
     """
     if dir:
         file_name = os.path.join(dir, file_name)
-    with open(file_name, 'w') as outfile:
-        json.dump(model, outfile)
+    if file_name.endswith('.json'):
+        with open(file_name, 'w') as outfile:
+            json.dump([float(w) for w in model], outfile)
+        return
 
+    if isinstance(model, Model):
+        layout, metadata = model.layout, metadata if metadata is not None else model.metadata
+    else:
+        layout = feature_layout()
+    weights = np.asarray(model, dtype='<f8')
+    header = json.dumps({'layout': layout, 'metadata': metadata or {}, 'num_weights': len(weights)}).encode()
+    with open(file_name, 'wb') as outfile:
+        outfile.write(MODEL_MAGIC)
+        outfile.write(struct.pack('<HI', MODEL_FORMAT_VERSION, len(header)))
+        outfile.write(header)
+        outfile.write(weights.tobytes())
 
-def read_model(file_name='model.json', dir=parent_directory):
+
+def read_model(file_name=MODEL_FILE, dir=parent_directory):
     """
-    Reads in the JSON object from model.json
-    :return: Loaded contents of model file
+    Reads in the model weights from a JSON or binary model file
+    :return: list of weights
+    """
+    return load_model(file_name, dir).weights.tolist()
+
+
+def feature_layout():
+    """
+    :return: description of the features the model weights line up with
+    """
+    return {'features': 'window(i) + window(j)', 'acids': acids_list,
+            'window_size': WINDOW_SIZE, 'num_features': 2 * WINDOW_SIZE * len(acids_list)}
+
+
+class Model:
+    """
+    Weights of the linear model (w0 first), with the feature layout and training metadata they came with.
+    Indexes like the plain list of weights.
+    """
+    def __init__(self, weights, layout=None, metadata=None, path=None):
+        self.weights = np.array(weights, dtype=np.float64)
+        self.layout = layout if layout is not None else feature_layout()
+        self.metadata = metadata or {}
+        self.path = path
+
+    def __len__(self):
+        return len(self.weights)
+
+    def __getitem__(self, index):
+        return self.weights[index]
+
+    def __iter__(self):
+        return iter(self.weights.tolist())
+
+    def __array__(self, dtype=None, copy=None):
+        return self.weights if dtype is None else self.weights.astype(dtype)
+
+    def check_layout(self, layout=None):
+        """
+        Make sure the model was built for the given feature layout (the current one by default)
+        """
+        layout = layout if layout is not None else feature_layout()
+        if self.layout != layout:
+            raise Exception('Model {} was built for a different feature layout: {}'.format(self.path, self.layout))
+        if len(self.weights) != layout['num_features'] + 1:
+            raise Exception('Model {} has {} weights, expected {}'.format(
+                self.path, len(self.weights), layout['num_features'] + 1))
+
+
+def load_model(file_name=MODEL_FILE, dir=parent_directory):
+    """
+    Loads a JSON or binary model file once. Later calls return the same Model until the file changes.
+    :return: Model
     """
     if dir:
         file_name = os.path.join(dir, file_name)
-    with open(file_name, 'r') as file:
-        model = json.load(file)
+    file_name = os.path.abspath(file_name)
+    mtime = os.stat(file_name).st_mtime_ns
+    if file_name in loaded_models and loaded_models[file_name][0] == mtime:
+        return loaded_models[file_name][1]
+
+    with open(file_name, 'rb') as file:
+        contents = file.read()
+    if contents.startswith(MODEL_MAGIC):
+        offset = len(MODEL_MAGIC)
+        version, header_length = struct.unpack_from('<HI', contents, offset)
+        if version > MODEL_FORMAT_VERSION:
+            raise Exception('Model {} uses a newer format version ({})'.format(file_name, version))
+        offset += struct.calcsize('<HI')
+        header = json.loads(contents[offset:offset + header_length].decode())
+        weights = np.frombuffer(contents, dtype='<f8', count=header['num_weights'], offset=offset + header_length)
+        model = Model(weights, header['layout'], header['metadata'], file_name)
+    else:
+        # JSON models are a plain list of weights for the current feature layout
+        model = Model(json.loads(contents.decode()), path=file_name)
+    model.check_layout()
 
+    loaded_models[file_name] = (mtime, model)
     return model